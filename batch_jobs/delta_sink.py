@@ -0,0 +1,167 @@
+import os
+import shutil
+import argparse
+
+from storage import DELTA_ENCODED_COLUMNS, PARTITION_COLUMN, SCHEMA_VERSION, SCHEMA_VERSION_KEY, is_delta_table, to_arrow
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TABLE_PATH = os.path.join(PROJECT_ROOT, 'data', 'stock_data_delta.parquet')
+
+# hours removed files stay on disk for readers of older versions before VACUUM deletes them
+RETENTION_HOURS = 7 * 24
+
+
+def merge_condition(min_date):
+    """Match rows on (Ticker, Date). The Date bound lets MERGE skip files that end before the new bars."""
+    return f"t.Ticker = s.Ticker AND t.Date = s.Date AND t.Date >= CAST('{min_date}' AS TIMESTAMP)"
+
+
+def _replace_plain_parquet(path):
+    # a Delta table cannot be created over the Parquet layout, its files would be left untracked
+    if os.path.exists(path) and not is_delta_table(path):
+        shutil.rmtree(path)
+
+
+def writer_properties():
+    """delta-rs Parquet settings matching storage.write_parquet: snappy, integer columns delta-encoded."""
+    from deltalake import ColumnProperties, WriterProperties
+
+    return WriterProperties(
+        compression='SNAPPY',
+        default_column_properties=ColumnProperties(dictionary_enabled=False),
+        column_properties={
+            name: ColumnProperties(dictionary_enabled=False, encoding='DELTA_BINARY_PACKED') for name in DELTA_ENCODED_COLUMNS
+        },
+    )
+
+
+def write_pandas(df, path, mode='overwrite'):
+    """Write a pandas frame of features to the Delta table without a JVM, through delta-rs.
+
+    overwrite commits a new version holding only df, append adds its rows as they are and
+    merge upserts them on (Ticker, Date).
+    """
+    from deltalake import DeltaTable, write_deltalake
+
+    table = to_arrow(df)
+    if mode == 'overwrite' or not is_delta_table(path):
+        _replace_plain_parquet(path)
+        write_deltalake(
+            path, table, mode='overwrite', partition_by=[PARTITION_COLUMN], schema_mode='overwrite',
+            writer_properties=writer_properties(),
+        )
+        # delta-rs only accepts its own properties when writing, custom ones are set afterwards
+        DeltaTable(path).alter.set_table_properties(
+            {SCHEMA_VERSION_KEY: str(SCHEMA_VERSION)}, raise_if_not_exists=False
+        )
+        return
+    if mode == 'append':
+        write_deltalake(path, table, mode='append', partition_by=[PARTITION_COLUMN], writer_properties=writer_properties())
+        return
+
+    min_date = df['Date'].min()
+    DeltaTable(path).merge(
+        table, merge_condition(min_date), source_alias='s', target_alias='t', writer_properties=writer_properties()
+    ).when_matched_update_all().when_not_matched_insert_all().execute()
+
+
+def write_spark(features, path, mode='overwrite'):
+    """Write a Spark frame of features to the Delta table with the session's Delta Lake.
+
+    overwrite commits a new version holding only features, append adds their rows as they are
+    and merge runs MERGE INTO on (Ticker, Date).
+    """
+    from delta.tables import DeltaTable
+    from pyspark.sql.functions import col, min as min_
+
+    # the same Date type delta-rs writes for pandas frames, so both engines can share the table
+    features = features.withColumn('Date', col('Date').cast('timestamp_ntz'))
+    if mode == 'overwrite' or not is_delta_table(path):
+        _replace_plain_parquet(path)
+        features.repartition(PARTITION_COLUMN) \
+            .sortWithinPartitions(PARTITION_COLUMN, 'Date') \
+            .write.format('delta') \
+            .partitionBy(PARTITION_COLUMN) \
+            .option('overwriteSchema', 'true') \
+            .mode('overwrite') \
+            .save(path)
+        features.sparkSession.sql(
+            f"ALTER TABLE delta.`{path}` SET TBLPROPERTIES ('{SCHEMA_VERSION_KEY}' = '{SCHEMA_VERSION}')"
+        )
+        return
+    if mode == 'append':
+        features.repartition(PARTITION_COLUMN) \
+            .sortWithinPartitions(PARTITION_COLUMN, 'Date') \
+            .write.format('delta') \
+            .partitionBy(PARTITION_COLUMN) \
+            .mode('append') \
+            .save(path)
+        return
+
+    min_date = features.agg(min_('Date')).first()[0]
+    if min_date is None:
+        return
+    DeltaTable.forPath(features.sparkSession, path).alias('t') \
+        .merge(features.alias('s'), merge_condition(min_date)) \
+        .whenMatchedUpdateAll() \
+        .whenNotMatchedInsertAll() \
+        .execute()
+
+
+def delete_tickers(path, tickers):
+    """Delete every row of tickers from the Delta table, through delta-rs."""
+    from deltalake import DeltaTable
+
+    if tickers:
+        listed = ', '.join(f"'{ticker}'" for ticker in tickers)
+        DeltaTable(path).delete(f'{PARTITION_COLUMN} IN ({listed})')
+
+
+def optimize(path, spark=None):
+    """Compact each Ticker partition's small files into Date-ordered ones.
+
+    Ticker is the partition column, which Delta does not allow in ZORDER BY, so partitions are
+    Z-ordered by Date alone.
+    """
+    if spark is not None:
+        return spark.sql(f'OPTIMIZE delta.`{path}` ZORDER BY (Date)').collect()
+
+    from deltalake import DeltaTable
+    return DeltaTable(path).optimize.z_order(['Date'])
+
+
+def vacuum(path, retention_hours=RETENTION_HOURS, spark=None):
+    """Delete files no version newer than retention_hours still references."""
+    if spark is not None:
+        return spark.sql(f'VACUUM delta.`{path}` RETAIN {retention_hours} HOURS').collect()
+
+    from deltalake import DeltaTable
+    return DeltaTable(path).vacuum(retention_hours=retention_hours, dry_run=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compact and vacuum the Delta output table.')
+    parser.add_argument('--path', default=TABLE_PATH)
+    parser.add_argument(
+        '--engine', choices=['spark', 'pandas'], default='spark',
+        help='run OPTIMIZE/VACUUM with Spark\'s Delta Lake, or with delta-rs without a JVM'
+    )
+    parser.add_argument('--retention-hours', type=int, default=RETENTION_HOURS)
+    parser.add_argument('--no-vacuum', action='store_true')
+    args = parser.parse_args()
+
+    if not is_delta_table(args.path):
+        parser.error(f'{args.path} is not a Delta table, write it with stock_etl.py --sink delta first')
+
+    spark = None
+    if args.engine == 'spark':
+        from stock_etl import create_spark_session
+        spark = create_spark_session(os.environ.get('SPARK_REMOTE'))
+
+    print(f'OPTIMIZE: {optimize(args.path, spark)}')
+    if not args.no_vacuum:
+        print(f'VACUUM: {vacuum(args.path, args.retention_hours, spark)}')
+
+
+if __name__ == '__main__':
+    main()
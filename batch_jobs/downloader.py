@@ -0,0 +1,74 @@
+import random
+import threading
+import time
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second with bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def fetch_with_retries(fetch_one, ticker, start_date, end_date, limiter=None, retries=3, backoff=1.0):
+    """Call fetch_one for a ticker, retrying failures with exponential backoff and jitter."""
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            return fetch_one(ticker, start_date, end_date)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+
+
+def download_concurrently(fetch_one, tickers, start_date, end_date, max_workers=8, limiter=None,
+                          retries=3, backoff=1.0):
+    """Fetch tickers one by one on a bounded thread pool.
+
+    At most max_workers requests are in flight and each ticker is retried on its own, so a
+    slow or failing symbol never holds back the others. Returns the concatenated bars (or
+    None) and a dict of the tickers that still failed after the retries, mapped to the error.
+    """
+    frames = []
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {
+            pool.submit(fetch_with_retries, fetch_one, ticker, start_date, end_date, limiter, retries, backoff): ticker
+            for ticker in tickers
+        }
+        for future in as_completed(futures):
+            ticker = futures[future]
+            try:
+                bars = future.result()
+            except Exception as e:
+                failed[ticker] = repr(e)
+                continue
+            if bars is not None:
+                frames.append(bars)
+
+    if not frames:
+        return None, failed
+
+    return pd.concat(frames, ignore_index=True), failed
@@ -0,0 +1,200 @@
+import time
+import numpy as np
+import pandas as pd
+from decimal import Decimal, ROUND_HALF_UP
+
+import rolling
+
+# column order of the Spark engine's output
+OUTPUT_COLUMNS = [
+    'Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume',
+    'Prev_close', 'Daily_return', 'Volatility', 'MA_12', 'MA_26', 'MA_50', 'MA_200',
+    'First_Close', 'Cumulative_Return', 'Close_7_Days_Ago', 'Momentum_7d', 'MACD', 'Signal_line', 'DrawDown',
+    'High_52w', 'Low_52w', 'From_High_52w', 'Max_DrawDown_52w',
+]
+
+# bars per regular 6.5 hour session for each bar interval
+BARS_PER_DAY = {'1d': 1, '1h': 7, '5m': 78, '1m': 390}
+# moving averages and the MACD signal count bars of the interval, as on any intraday chart;
+# momentum looks back 7 sessions whatever the interval, so Momentum_7d keeps its meaning
+MA_WINDOWS = [12, 26, 50, 200]
+SIGNAL_WINDOW = 9
+MOMENTUM_DAYS = 7
+# the 52 week range spans a year of daily sessions; providers serve 1m and 5m bars for 30 to 60
+# days only, so intraday output leaves the RANGE_COLUMNS null
+RANGE_DAYS = 252
+RANGE_COLUMNS = ['High_52w', 'Low_52w', 'From_High_52w', 'Max_DrawDown_52w']
+
+
+def spark_round(values, decimals=2):
+    """Round like Spark's round(): HALF_UP on the decimal representation of each double."""
+    scale = 10.0 ** decimals
+    scaled = np.abs(values * scale)
+    rounded = np.floor(scaled + 0.5) * np.sign(values) / scale + 0.0  # + 0.0 turns -0.0 into 0.0
+
+    # the binary product can land on the wrong side of a tie, settle those on the decimal value
+    fraction = scaled - np.floor(scaled)
+    near_tie = np.flatnonzero(np.abs(fraction - 0.5) < 1e-6)
+    quantum = Decimal(1).scaleb(-decimals)
+    for i in near_tie:
+        rounded[i] = float(Decimal(repr(float(values[i]))).quantize(quantum, rounding=ROUND_HALF_UP)) + 0.0
+
+    return rounded
+
+
+def group_starts(codes):
+    """Index of the first row of each row's group, for rows sorted by group."""
+    n = len(codes)
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = codes[1:] != codes[:-1]
+    return np.maximum.accumulate(np.where(is_start, np.arange(n), 0))
+
+
+def lag(values, starts, periods):
+    """Value `periods` rows back within the group, NaN where the group is shorter."""
+    idx = np.arange(len(values))
+    prev = idx - periods
+    return np.where(prev >= starts, values[np.maximum(prev, 0)], np.nan)
+
+
+def momentum_rows(interval='1d'):
+    """Bars back to the close MOMENTUM_DAYS sessions ago."""
+    return MOMENTUM_DAYS * BARS_PER_DAY[interval]
+
+
+def range_rows():
+    """Daily bars in the 52 week range."""
+    return RANGE_DAYS
+
+
+def range_columns(close, high, low, starts, window):
+    """52 week range of rows sorted by group, each over the last `window` rows of its group.
+
+    High_52w and Low_52w are the highest High and lowest Low, From_High_52w how far Close is below
+    that high in percent, and Max_DrawDown_52w the deepest fall in percent from a Close to a later
+    Close within the window, as DrawDown measures it from the peak Close of the whole history.
+    """
+    high_52w = rolling.rolling_max(high, starts, window)
+    return {
+        'High_52w': high_52w,
+        'Low_52w': rolling.rolling_min(low, starts, window),
+        'From_High_52w': spark_round((close - high_52w) / high_52w * 100),
+        'Max_DrawDown_52w': spark_round(rolling.rolling_max_drawdown(close, starts, window)),
+    }
+
+
+def add_range_group(bars):
+    """applyInPandas body of the Spark engine: one ticker's rows with the RANGE_COLUMNS appended."""
+    bars = bars.sort_values('Date', kind='stable').reset_index(drop=True)
+    columns = range_columns(
+        bars['Close'].to_numpy(dtype='float64'),
+        bars['High'].to_numpy(dtype='float64'),
+        bars['Low'].to_numpy(dtype='float64'),
+        np.zeros(len(bars), dtype='int64'),
+        range_rows(),
+    )
+    return bars.assign(**columns)
+
+
+def add_features(bars, seed=None, interval='1d', timings=None):
+    """Compute the indicator columns of the Spark engine with NumPy, one vectorized pass per column.
+
+    seed optionally carries Seed_first_close and Seed_peak_close per ticker, as in the Spark engine.
+    Windows are those of the bar interval, see BARS_PER_DAY; Daily_return is then the return over
+    the previous bar, and the RANGE_COLUMNS are NaN. timings, a dict, is given the seconds spent on each indicator group.
+    """
+    clock = [time.perf_counter()]
+
+    def lap(group):
+        if timings is not None:
+            now = time.perf_counter()
+            timings[group] = timings.get(group, 0.0) + now - clock[0]
+            clock[0] = now
+
+    df = bars.sort_values(['Ticker', 'Date'], kind='stable').reset_index(drop=True)
+    df['Ticker'] = df['Ticker'].astype(str)
+
+    codes = pd.factorize(df['Ticker'])[0]
+    starts = group_starts(codes)
+    close = df['Close'].to_numpy(dtype='float64')
+    high = df['High'].to_numpy(dtype='float64')
+    low = df['Low'].to_numpy(dtype='float64')
+
+    if seed is not None and not seed.empty:
+        seed = seed.set_index('Ticker')
+        seed_first = df['Ticker'].map(seed['Seed_first_close']).to_numpy(dtype='float64')
+        seed_peak = df['Ticker'].map(seed['Seed_peak_close']).to_numpy(dtype='float64')
+    else:
+        seed_first = np.full(len(df), np.nan)
+        seed_peak = np.full(len(df), np.nan)
+
+    out = {column: df[column].to_numpy() for column in df.columns}
+    lap('sort')
+
+    # compute daily return
+    prev_close = lag(close, starts, 1)
+    out['Prev_close'] = prev_close
+    out['Daily_return'] = spark_round((close - prev_close) / prev_close * 100)
+
+    # calculate daily volutility rate
+    out['Volatility'] = spark_round((high - low) / low * 100)
+    lap('returns')
+
+    # compute moving averages, O(n) whatever the window
+    for window in MA_WINDOWS:
+        out[f'MA_{window}'] = spark_round(rolling.rolling_mean(close, starts, window, decimals=2))
+    lap('moving_averages')
+
+    first_close = np.where(np.isnan(seed_first), close[starts], seed_first)
+    out['First_Close'] = first_close
+    out['Cumulative_Return'] = spark_round((close - first_close) / first_close * 100)
+    lap('cumulative_return')
+
+    # compute 7 day momentum
+    close_7_days_ago = lag(close, starts, momentum_rows(interval))
+    out['Close_7_Days_Ago'] = close_7_days_ago
+    out['Momentum_7d'] = spark_round((close - close_7_days_ago) / close_7_days_ago * 100)
+    lap('momentum')
+
+    # compute MACD and signal lines
+    macd = out['MA_12'] - out['MA_26']
+    out['MACD'] = macd
+    out['Signal_line'] = spark_round(rolling.rolling_mean(macd, starts, SIGNAL_WINDOW, decimals=2))
+    lap('macd')
+
+    # compute draw down
+    running_peak = pd.Series(close).groupby(codes).cummax().to_numpy()
+    peak_close = np.fmax(seed_peak, running_peak)
+    out['DrawDown'] = spark_round((close - peak_close) / peak_close * 100)
+    lap('drawdown')
+
+    # compute the 52 week range of daily bars, O(n) whatever the window
+    if interval == '1d':
+        out.update(range_columns(close, high, low, starts, range_rows()))
+    else:
+        out.update({column: np.full(len(close), np.nan) for column in RANGE_COLUMNS})
+    lap('range_52w')
+
+    # assemble once, inserting columns one by one dominates the time on small groups
+    extra = [column for column in df.columns if column not in OUTPUT_COLUMNS]
+    features = pd.DataFrame({column: out[column] for column in OUTPUT_COLUMNS[:7] + extra + OUTPUT_COLUMNS[7:]})
+    lap('assemble')
+    return features
+
+
+def add_features_partition(batches, interval='1d'):
+    """mapInPandas body of the fused Spark engine.
+
+    The partition holds whole tickers, each carrying its seed in Seed_first_close / Seed_peak_close
+    columns. All of its batches are joined and computed in a single vectorized pass.
+    """
+    batches = list(batches)
+    # a partition the shuffle left without tickers gets no batches at all
+    if not batches:
+        return
+    bars = pd.concat(batches, ignore_index=True)
+    if bars.empty:
+        return
+
+    seed = bars[['Ticker', 'Seed_first_close', 'Seed_peak_close']].drop_duplicates('Ticker')
+    yield add_features(bars.drop(columns=['Seed_first_close', 'Seed_peak_close']), seed, interval)
@@ -0,0 +1,156 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import features_pandas
+import storage
+import universe
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_FILEPATH = os.path.join(PROJECT_ROOT, 'data')
+# one row per ticker, rewritten after each daily ETL run and read by the dashboard as it is
+SUMMARY_PATH = os.path.join(DATA_FILEPATH, 'stock_summary.parquet')
+# weekly (weeks ending Friday) and monthly bars of the daily features, one table per resolution
+ROLLUP_FREQUENCIES = {'weekly': 'W-FRI', 'monthly': 'M'}
+ROLLUP_PATHS = {name: os.path.join(DATA_FILEPATH, f'stock_{name}.parquet') for name in ROLLUP_FREQUENCIES}
+
+# calendar days of the trailing 52 week window
+TRAILING_DAYS = 364
+# latest stored values carried into the summary
+LATEST_COLUMNS = [
+    'Open', 'High', 'Low', 'Close', 'Volume', 'Daily_return', 'Volatility', 'MA_50', 'MA_200',
+    'Cumulative_Return', 'Momentum_7d', 'MACD', 'Signal_line', 'DrawDown',
+] + features_pandas.RANGE_COLUMNS
+SUMMARY_COLUMNS = ['Ticker', 'Date'] + LATEST_COLUMNS + ['Return_52w', 'Volatility_52w', 'Avg_Volume_52w', 'Bars_52w']
+# Period is the start of the week or month, Date its first trading day; the moving averages are
+# the daily ones at the period's last bar, so the overlays trace the daily chart's lines
+ROLLUP_COLUMNS = ['Ticker', 'Period', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'MA_50', 'MA_200', 'Bars']
+# rows per row group of the rollup files, sorted by Ticker so a ticker's rows are a few row groups
+ROLLUP_ROW_GROUP_ROWS = 32_768
+
+
+def summarize(features):
+    """Summary rows of features holding at least the trailing 52 weeks of each ticker.
+
+    The latest row of each ticker is kept as it is stored, 52 week range included. Return_52w is
+    the percent change of Close over the bars within TRAILING_DAYS of it, Volatility_52w the
+    standard deviation of their Daily_return.
+    """
+    if features.empty:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    df = features.astype({'Ticker': str}).sort_values(['Ticker', 'Date'], kind='stable', ignore_index=True)
+    if 'High_52w' not in df.columns:
+        # output stored before the engines computed the 52 week range, features hold the whole history
+        starts = features_pandas.group_starts(pd.factorize(df['Ticker'])[0])
+        df = df.assign(**features_pandas.range_columns(
+            df['Close'].to_numpy(dtype='float64'), df['High'].to_numpy(dtype='float64'),
+            df['Low'].to_numpy(dtype='float64'), starts, features_pandas.range_rows(),
+        ))
+
+    latest = df.groupby('Ticker').tail(1).set_index('Ticker')
+    since = df['Ticker'].map(latest['Date']) - pd.Timedelta(days=TRAILING_DAYS)
+    trailing = df[df['Date'] >= since].groupby('Ticker')
+
+    summary = latest[['Date'] + LATEST_COLUMNS].copy()
+    summary['Return_52w'] = features_pandas.spark_round(
+        ((summary['Close'] / trailing['Close'].first() - 1) * 100).to_numpy()
+    )
+    summary['Volatility_52w'] = features_pandas.spark_round(trailing['Daily_return'].std().to_numpy())
+    summary['Avg_Volume_52w'] = np.rint(trailing['Volume'].mean()).astype('int64')
+    summary['Bars_52w'] = trailing.size()
+    return summary.reset_index()[SUMMARY_COLUMNS]
+
+
+def build_summary(path, last_dates=None, chunk_size=500):
+    """Summary of the features stored at path, reading chunk_size tickers at a time.
+
+    With last_dates, each ticker's last stored Date (e.g. from the indicator state), only the
+    trailing 52 weeks of each chunk are read instead of the whole history.
+    """
+    tickers = sorted(last_dates.index) if last_dates is not None else storage.stored_tickers(path)
+    stored = storage.stored_columns(path)
+    columns = [column for column in ['Ticker', 'Date'] + LATEST_COLUMNS if column in stored]
+    summaries = []
+    for chunk in universe.chunked(tickers, chunk_size):
+        filters = [('Ticker', 'in', chunk)]
+        if last_dates is not None:
+            # the state's Dates are rounded to the day, a day of margin keeps the window whole
+            since = last_dates[chunk].min() - pd.Timedelta(days=TRAILING_DAYS + 1)
+            filters.append(('Date', '>=', since))
+        summaries.append(summarize(storage.read_parquet(path, columns=columns, filters=filters)))
+    if not summaries:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    return pd.concat(summaries, ignore_index=True)
+
+
+def rollup(features, frequency):
+    """OHLCV bars of features per ticker and period of the pandas frequency, e.g. 'W-FRI' or 'M'."""
+    if features.empty:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    df = features.astype({'Ticker': str}).sort_values(['Ticker', 'Date'], kind='stable')
+    period = df['Date'].dt.to_period(frequency).dt.start_time.rename('Period')
+    bars = df.groupby([df['Ticker'], period], sort=True).agg(
+        Date=('Date', 'first'),
+        Open=('Open', 'first'),
+        High=('High', 'max'),
+        Low=('Low', 'min'),
+        Close=('Close', 'last'),
+        Volume=('Volume', 'sum'),
+        MA_50=('MA_50', 'last'),
+        MA_200=('MA_200', 'last'),
+        Bars=('Close', 'size'),
+    )
+    return bars.reset_index()[ROLLUP_COLUMNS]
+
+
+def build_rollup(path, frequency, chunk_size=500, previous=None):
+    """Rollup of the features stored at path, reading chunk_size tickers at a time.
+
+    previous, the rollup of an earlier run when the output has only been appended to since,
+    keeps its closed periods: each chunk only reads the bars from its tickers' earliest last
+    period on and recomputes the periods from there. Tickers new to it are read in full.
+    """
+    columns = ['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'MA_50', 'MA_200']
+    rollups = []
+    for chunk in universe.chunked(storage.stored_tickers(path), chunk_size):
+        filters = [('Ticker', 'in', chunk)]
+        if previous is not None:
+            before = previous[previous['Ticker'].isin(chunk)]
+            last_periods = before.groupby('Ticker')['Period'].max()
+            if len(last_periods) == len(chunk):
+                since = last_periods.min()
+                filters.append(('Date', '>=', since))
+                rollups.append(before[before['Period'] < since])
+        features = storage.read_parquet(path, columns=columns, filters=filters)
+        rollups.append(rollup(features, frequency))
+    if not rollups:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    return pd.concat(rollups, ignore_index=True).sort_values(['Ticker', 'Period'], kind='stable', ignore_index=True)
+
+
+def _replace(df, path, row_group_size=None):
+    """Write df to path in one rename, readers never see a partial file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    df.to_parquet(tmp, index=False, coerce_timestamps='us', allow_truncated_timestamps=True, row_group_size=row_group_size)
+    os.replace(tmp, path)
+
+
+def write_summary(summary, path=SUMMARY_PATH):
+    _replace(summary, path)
+
+
+def load_summary(path=SUMMARY_PATH):
+    return pq.read_table(path).to_pandas(coerce_temporal_nanoseconds=True)
+
+
+def write_rollup(bars, name):
+    _replace(bars, ROLLUP_PATHS[name], ROLLUP_ROW_GROUP_ROWS)
+
+
+def load_rollup(name, tickers=None):
+    """Rollup table of a resolution, only the row groups holding tickers when given."""
+    filters = [('Ticker', 'in', list(tickers))] if tickers is not None else None
+    return pq.read_table(ROLLUP_PATHS[name], filters=filters).to_pandas(coerce_temporal_nanoseconds=True)
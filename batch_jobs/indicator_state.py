@@ -0,0 +1,511 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import rolling
+from features_pandas import (
+    MA_WINDOWS, OUTPUT_COLUMNS, RANGE_COLUMNS, SIGNAL_WINDOW, add_features, momentum_rows, range_rows, spark_round,
+)
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STATE_PATH = os.path.join(PROJECT_ROOT, 'data', 'indicator_state.parquet')
+
+# the state extends daily bars, its windows are those of features_pandas at 1d
+MOMENTUM_ROWS = momentum_rows()
+# Highs, Lows and Closes of the 52 week range
+RANGE_WINDOW = range_rows()
+# closes of the longest moving average, of the momentum lag and of the 52 week drawdown
+CLOSE_WINDOW = max(max(MA_WINDOWS), MOMENTUM_ROWS + 1, RANGE_WINDOW)
+# MACD values of the Signal_line
+MACD_WINDOW = SIGNAL_WINDOW
+
+
+class IndicatorState:
+    """Everything needed to extend each ticker's indicators by one bar, one row per ticker.
+
+    closes holds the last CLOSE_WINDOW closes and macds the last MACD_WINDOW MACD values,
+    oldest first and left-padded with zeros while a ticker has fewer rows. Zero padding leaves
+    the in-order window sums unchanged, so updates reproduce the batch engines bit for bit.
+    highs and lows hold the last RANGE_WINDOW Highs and Lows, left-padded with NaN, which the
+    range's max and min skip.
+
+    While updating, the buffers are rings: a ticker's bar overwrites its oldest value in place,
+    shifts counts the bars written since the buffers were last oldest first (see _unroll). The
+    window sums and the range's max and min are derived from the buffers once and then slid by
+    one value per bar, so an update does not read the whole windows again. Max_DrawDown_52w keeps
+    the row of the window's peak close and of the peak its deepest fall starts from; a window is
+    only read again once one of them leaves it.
+    """
+
+    def __init__(self, tickers, last_date, rows, first_close, peak_close, closes, macds, highs, lows):
+        self.tickers = list(tickers)
+        self.index = {ticker: i for i, ticker in enumerate(self.tickers)}
+        self.last_date = last_date
+        self.rows = rows
+        self.first_close = first_close
+        self.peak_close = peak_close
+        self.closes = closes
+        self.macds = macds
+        self.highs = highs
+        self.lows = lows
+        self.shifts = np.zeros(len(self.tickers), dtype='int64')
+        self.ma_sums = {window: _compensated_sum(closes[:, -window:]) for window in MA_WINDOWS}
+        self.macd_sums = _compensated_sum(macds)
+        self.macd_abs_sums = _compensated_sum(np.abs(macds))
+        self.high_52w = np.fmax.reduce(highs, axis=1)
+        self.low_52w = np.fmin.reduce(lows, axis=1)
+        window = _window_closes(closes, np.arange(len(self.tickers)), np.full(len(self.tickers), -1), rows)
+        self.close_peak, self.close_peak_row, self.max_drawdown_52w, self.drawdown_peak_row = _drawdown_state(window, rows)
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def last_dates(self):
+        return pd.Series(self.last_date, index=self.tickers)
+
+    def last_bars(self):
+        """Date and Close of each ticker's last bar, see stock_etl.check_bars."""
+        self._unroll()
+        return pd.DataFrame({'Ticker': self.tickers, 'Date': self.last_date, 'Close': self.closes[:, -1]})
+
+    def update(self, bars):
+        """Append new bars (dated after each ticker's last_date) and return their feature rows.
+
+        Bars are applied one date at a time, each date as a vector update over the tickers
+        trading that day, so the work per ticker and bar does not grow with the window lengths.
+        """
+        bars = bars.sort_values(['Date', 'Ticker'], kind='stable')
+        positions = bars['Ticker'].astype(str).map(self.index).to_numpy()
+        dates = bars['Date'].to_numpy()
+        close = bars['Close'].to_numpy(dtype='float64')
+        high = bars['High'].to_numpy(dtype='float64')
+        low = bars['Low'].to_numpy(dtype='float64')
+
+        prev_close = np.full(len(bars), np.nan)
+        close_7_days_ago = np.full(len(bars), np.nan)
+        first_close = np.empty(len(bars))
+        peak_close = np.empty(len(bars))
+        mas = {window: np.empty(len(bars)) for window in MA_WINDOWS}
+        macd = np.empty(len(bars))
+        signal = np.empty(len(bars))
+        ranges = {column: np.empty(len(bars)) for column in RANGE_COLUMNS}
+
+        boundaries = np.flatnonzero(np.r_[True, dates[1:] != dates[:-1], True])
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            rows_of_day = slice(start, end)
+            tickers = positions[rows_of_day]
+            shifts = self.shifts[tickers]
+            rows = self.rows[tickers] + 1
+            today = close[rows_of_day]
+
+            # the slot of each ring holding its oldest value, which today's value replaces
+            slot = shifts % CLOSE_WINDOW
+            leaving = {window: self.closes[tickers, (slot - window) % CLOSE_WINDOW] for window in MA_WINDOWS}
+            self.closes[tickers, slot] = today
+
+            prev_close[rows_of_day] = np.where(rows > 1, self.closes[tickers, (slot - 1) % CLOSE_WINDOW], np.nan)
+            close_7_days_ago[rows_of_day] = np.where(
+                rows > MOMENTUM_ROWS, self.closes[tickers, (slot - MOMENTUM_ROWS) % CLOSE_WINDOW], np.nan,
+            )
+
+            for window in MA_WINDOWS:
+                total = _slide(self.ma_sums[window], tickers, today, leaving[window])
+                # closes are positive, the sum of their absolute values is the sum
+                means = _window_means(self.closes, tickers, slot, window, rows, total, total)
+                mas[window][rows_of_day] = spark_round(means)
+
+            slot = shifts % MACD_WINDOW
+            leaving_macd = self.macds[tickers, slot]
+            entering_macd = mas[12][rows_of_day] - mas[26][rows_of_day]
+            self.macds[tickers, slot] = entering_macd
+            macd[rows_of_day] = entering_macd
+            total = _slide(self.macd_sums, tickers, entering_macd, leaving_macd)
+            abs_total = _slide(self.macd_abs_sums, tickers, np.abs(entering_macd), np.abs(leaving_macd))
+            signal[rows_of_day] = spark_round(_window_means(self.macds, tickers, slot, MACD_WINDOW, rows, total, abs_total))
+
+            ranges['Max_DrawDown_52w'][rows_of_day] = spark_round(
+                self._slide_drawdown(tickers, shifts % CLOSE_WINDOW, rows, today)
+            )
+
+            slot = shifts % RANGE_WINDOW
+            high_52w = _slide_extreme(self.high_52w, self.highs, tickers, slot, high[rows_of_day], np.fmax)
+            ranges['High_52w'][rows_of_day] = high_52w
+            ranges['Low_52w'][rows_of_day] = _slide_extreme(self.low_52w, self.lows, tickers, slot, low[rows_of_day], np.fmin)
+            ranges['From_High_52w'][rows_of_day] = spark_round((today - high_52w) / high_52w * 100)
+
+            first = np.where(rows == 1, today, self.first_close[tickers])
+            peak = np.fmax(self.peak_close[tickers], today)
+            first_close[rows_of_day] = first
+            peak_close[rows_of_day] = peak
+
+            self.shifts[tickers] = shifts + 1
+            self.rows[tickers] = rows
+            self.first_close[tickers] = first
+            self.peak_close[tickers] = peak
+            self.last_date[tickers] = dates[rows_of_day]
+
+        features = {column: bars[column].to_numpy() for column in OUTPUT_COLUMNS[:7]}
+        features['Ticker'] = bars['Ticker'].astype(str).to_numpy()
+        features.update({
+            'Prev_close': prev_close,
+            'Daily_return': spark_round((close - prev_close) / prev_close * 100),
+            'Volatility': spark_round((high - low) / low * 100),
+            **{f'MA_{window}': mas[window] for window in MA_WINDOWS},
+            'First_Close': first_close,
+            'Cumulative_Return': spark_round((close - first_close) / first_close * 100),
+            'Close_7_Days_Ago': close_7_days_ago,
+            'Momentum_7d': spark_round((close - close_7_days_ago) / close_7_days_ago * 100),
+            'MACD': macd,
+            'Signal_line': signal,
+            'DrawDown': spark_round((close - peak_close) / peak_close * 100),
+            **ranges,
+        })
+        return pd.DataFrame(features)[OUTPUT_COLUMNS]
+
+    def _slide_drawdown(self, tickers, slot, rows, today):
+        """Add today's closes, already written at slot, to the 52 week drawdowns of tickers; their new values.
+
+        The close leaving the window only changes the drawdown when it is the window's peak or the
+        peak of the deepest fall, those windows are read again. Otherwise today's close is a new
+        peak, or falls from the current one.
+        """
+        leaving_row = rows - 1 - RANGE_WINDOW
+        rescan = (leaving_row == self.close_peak_row[tickers]) | (leaving_row == self.drawdown_peak_row[tickers])
+
+        peak = self.close_peak[tickers]
+        peak_row = self.close_peak_row[tickers]
+        is_peak = today >= peak
+        peak = np.where(is_peak, today, peak)
+        peak_row = np.where(is_peak, rows - 1, peak_row)
+        drawdown = self.max_drawdown_52w[tickers]
+        fall = rolling._drawdown(peak, today)
+        deeper = fall < drawdown
+        drawdown = np.where(deeper, fall, drawdown)
+        drawdown_peak_row = np.where(deeper, peak_row, self.drawdown_peak_row[tickers])
+
+        if rescan.any():
+            rows_rescan = np.flatnonzero(rescan)
+            window = _window_closes(self.closes, tickers[rows_rescan], slot[rows_rescan], rows[rows_rescan])
+            (peak[rows_rescan], peak_row[rows_rescan], drawdown[rows_rescan],
+             drawdown_peak_row[rows_rescan]) = _drawdown_state(window, rows[rows_rescan])
+
+        self.close_peak[tickers] = peak
+        self.close_peak_row[tickers] = peak_row
+        self.max_drawdown_52w[tickers] = drawdown
+        self.drawdown_peak_row[tickers] = drawdown_peak_row
+        return drawdown
+
+    def _unroll(self):
+        """Rotate the rings back to oldest first, the layout the buffers are handed out and saved in."""
+        if not self.shifts.any():
+            return
+        for name in ('closes', 'macds', 'highs', 'lows'):
+            buffer = getattr(self, name)
+            width = buffer.shape[1]
+            order = (self.shifts[:, None] + np.arange(width)) % width
+            setattr(self, name, np.take_along_axis(buffer, order, axis=1))
+        self.shifts[:] = 0
+
+    def drop(self, tickers):
+        """State without the given tickers."""
+        self._unroll()
+        keep = [i for i, ticker in enumerate(self.tickers) if ticker not in set(tickers)]
+        return IndicatorState(
+            [self.tickers[i] for i in keep], self.last_date[keep], self.rows[keep], self.first_close[keep],
+            self.peak_close[keep], self.closes[keep], self.macds[keep], self.highs[keep], self.lows[keep],
+        )
+
+    def merge(self, other):
+        """Add or replace the tickers of another state."""
+        self._unroll()
+        other._unroll()
+        keep = [i for i, ticker in enumerate(self.tickers) if ticker not in other.index]
+        return IndicatorState(
+            [self.tickers[i] for i in keep] + other.tickers,
+            np.concatenate([self.last_date[keep], other.last_date]),
+            np.concatenate([self.rows[keep], other.rows]),
+            np.concatenate([self.first_close[keep], other.first_close]),
+            np.concatenate([self.peak_close[keep], other.peak_close]),
+            np.concatenate([self.closes[keep], other.closes]),
+            np.concatenate([self.macds[keep], other.macds]),
+            np.concatenate([self.highs[keep], other.highs]),
+            np.concatenate([self.lows[keep], other.lows]),
+        )
+
+
+def _window_sum(buffer, window):
+    """Sum the newest `window` columns of each row, oldest to newest like Spark's sliding frame."""
+    total = buffer[:, -window].copy()
+    for column in range(-window + 1, 0):
+        total += buffer[:, column]
+    return total
+
+
+def _two_sum(a, b):
+    """a + b rounded, and the rounding error that makes it exact (Knuth's TwoSum)."""
+    total = a + b
+    b_part = total - a
+    return total, (a - (total - b_part)) + (b - b_part)
+
+
+def _compensated_sum(buffer):
+    """Sum of each row of buffer as (high, low) float64 parts, high + low within an ulp or two of the exact sum."""
+    high = np.zeros(len(buffer))
+    low = np.zeros(len(buffer))
+    for column in range(buffer.shape[1]):
+        high, error = _two_sum(high, buffer[:, column])
+        low += error
+    return high, low
+
+
+def _slide(sums, tickers, entering, leaving):
+    """Add entering to and take leaving from the compensated sums of tickers, in place; their new totals.
+
+    The error of every addition is carried in the low part, so the totals stay within a few ulps
+    of the exact window sums however many bars the sums have slid over.
+    """
+    high, low = sums
+    total, error = _two_sum(high[tickers], entering)
+    total, error_out = _two_sum(total, -leaving)
+    high[tickers] = total
+    low[tickers] += error + error_out
+    return total + low[tickers]
+
+
+def _slide_extreme(extremes, buffer, tickers, slot, entering, reduce):
+    """Write entering into the ring slots of tickers and update their max (np.fmax) or min (np.fmin), in place.
+
+    Only rings whose leaving value was their extreme are scanned again.
+    """
+    leaving = buffer[tickers, slot]
+    buffer[tickers, slot] = entering
+    current = extremes[tickers]
+    updated = reduce(current, entering)
+    rescan = np.flatnonzero(leaving == current)
+    if len(rescan):
+        updated[rescan] = reduce.reduce(buffer[tickers[rescan]], axis=1)
+    extremes[tickers] = updated
+    return updated
+
+
+def _window_means(buffer, tickers, slot, window, rows, totals, abs_totals):
+    """Means of the `window` newest values of the rings of tickers from their running totals, as Spark rounds them.
+
+    slot is where each ring's newest value sits. Spark adds a window's values oldest to newest;
+    means close enough to a rounding tie for the order of those additions to matter are summed
+    that way over the ring.
+    """
+    count = np.minimum(rows, window)
+    means = totals / count
+    bounds = 4 * rolling.UNIT_ROUNDOFF * abs_totals
+    recompute = np.flatnonzero(rolling.near_rounding_tie(means, count, abs_totals, bounds, bounds, 2))
+    if len(recompute):
+        width = buffer.shape[1]
+        order = (slot[recompute, None] + np.arange(1 - window, 1)) % width
+        values = buffer[tickers[recompute, None], order]
+        means[recompute] = _window_sum(values, window) / count[recompute]
+    return means
+
+
+def _window_closes(closes, tickers, slot, rows):
+    """The RANGE_WINDOW newest closes of the rings of tickers, oldest first, NaN before a ticker's first row.
+
+    slot is where each ring's newest close sits, as in _window_means.
+    """
+    order = (slot[:, None] + np.arange(1 - RANGE_WINDOW, 1)) % closes.shape[1]
+    window = closes[tickers[:, None], order]
+    # the zero padding of tickers with fewer closes is no peak
+    window[np.arange(RANGE_WINDOW) < RANGE_WINDOW - np.minimum(rows, RANGE_WINDOW)[:, None]] = np.nan
+    return window
+
+
+def _drawdown_state(window, rows):
+    """Peak close and deepest fall in percent from a close to a later one in each row of window, with the
+    rows of the peak and of the fall's peak; the last column of window is row rows - 1.
+
+    Of equal closes the latest is taken as the peak, it stays in the window longest.
+    """
+    n, width = window.shape
+    if n == 0:
+        return np.empty(0), np.empty(0, dtype='int64'), np.empty(0), np.empty(0, dtype='int64')
+    columns = np.arange(width)
+    first_row = rows - width
+    index = np.arange(n)
+
+    peak = np.fmax.reduce(window, axis=1)
+    peak_column = width - 1 - np.argmax((window == peak[:, None])[:, ::-1], axis=1)
+
+    peaks = np.fmax.accumulate(window, axis=1)
+    falls = rolling._drawdown(peaks, window)
+    trough = np.argmin(np.where(np.isnan(falls), np.inf, falls), axis=1)
+    at_peak = (window == peaks[index, trough][:, None]) & (columns <= trough[:, None])
+    fall_peak_column = width - 1 - np.argmax(at_peak[:, ::-1], axis=1)
+    return peak, first_row + peak_column, falls[index, trough], first_row + fall_peak_column
+
+
+def _tail_matrix(values, starts, ends, width, fill=0.0):
+    """Last `width` values of each [start, end) group as rows, left-padded with fill."""
+    matrix = np.full((len(starts), width), fill)
+    for i, (start, end) in enumerate(zip(starts, ends)):
+        tail = values[max(start, end - width):end]
+        matrix[i, width - len(tail):] = tail
+    return matrix
+
+
+def build_state(features):
+    """Build the state of every ticker from its full feature history (Ticker, Date, High, Low, Close, MACD).
+
+    The history starts at each ticker's first bar, whose close is the first close.
+    """
+    features = features.sort_values(['Ticker', 'Date'], kind='stable')
+    ticker_col = features['Ticker'].astype(str).to_numpy()
+
+    boundaries = np.flatnonzero(np.r_[True, ticker_col[1:] != ticker_col[:-1], True])
+    starts, ends = boundaries[:-1], boundaries[1:]
+    close = features['Close'].to_numpy(dtype='float64')
+
+    return IndicatorState(
+        ticker_col[starts],
+        features['Date'].to_numpy()[ends - 1],
+        (ends - starts).astype('int64'),
+        close[starts],
+        np.maximum.reduceat(close, starts) if len(starts) else np.empty(0),
+        _tail_matrix(close, starts, ends, CLOSE_WINDOW),
+        _tail_matrix(features['MACD'].to_numpy(dtype='float64'), starts, ends, MACD_WINDOW),
+        _tail_matrix(features['High'].to_numpy(dtype='float64'), starts, ends, RANGE_WINDOW, np.nan),
+        _tail_matrix(features['Low'].to_numpy(dtype='float64'), starts, ends, RANGE_WINDOW, np.nan),
+    )
+
+
+# one ticker's state in Spark's state store (see stream_etl.py): dates as epoch nanoseconds, windows
+# as raw float64 bytes (array state cannot be handed back from the state store to Python)
+STREAM_STATE_SCHEMA = (
+    'last_date long, rows long, first_close double, peak_close double, closes binary, macds binary, '
+    'highs binary, lows binary'
+)
+
+
+def ticker_state(state, ticker):
+    """State of a single ticker, or None when state does not hold it."""
+    if state is None or ticker not in state.index:
+        return None
+    state._unroll()
+    i = [state.index[ticker]]
+    return IndicatorState(
+        [ticker], state.last_date[i], state.rows[i], state.first_close[i], state.peak_close[i],
+        state.closes[i], state.macds[i], state.highs[i], state.lows[i],
+    )
+
+
+def to_stream_state(state):
+    """The single ticker of state as a row of STREAM_STATE_SCHEMA."""
+    state._unroll()
+    return (
+        int(state.last_date[0].astype('datetime64[ns]').astype('int64')),
+        int(state.rows[0]),
+        float(state.first_close[0]),
+        float(state.peak_close[0]),
+        state.closes[0].tobytes(),
+        state.macds[0].tobytes(),
+        state.highs[0].tobytes(),
+        state.lows[0].tobytes(),
+    )
+
+
+def from_stream_state(ticker, row):
+    last_date, rows, first_close, peak_close, closes, macds, highs, lows = row
+    return IndicatorState(
+        [ticker],
+        np.array([last_date], dtype='datetime64[ns]'),
+        np.array([rows], dtype='int64'),
+        np.array([first_close]),
+        np.array([peak_close]),
+        np.frombuffer(closes, dtype='float64').reshape(1, CLOSE_WINDOW).copy(),
+        np.frombuffer(macds, dtype='float64').reshape(1, MACD_WINDOW).copy(),
+        np.frombuffer(highs, dtype='float64').reshape(1, RANGE_WINDOW).copy(),
+        np.frombuffer(lows, dtype='float64').reshape(1, RANGE_WINDOW).copy(),
+    )
+
+
+# persisted state read by streaming workers, loaded once per python worker
+_stored_states = {}
+
+
+def update_stream_group(key, batches, group_state, bootstrap_path=STATE_PATH):
+    """applyInPandasWithState body: extend one ticker's indicators by the bars of a micro-batch.
+
+    The ticker's state lives in Spark's state store. A ticker seen for the first time starts
+    from the state the batch ETL persisted at bootstrap_path, or from its first bars when it has
+    none. Bars dated on or before the ticker's last date (replayed or late files) are dropped.
+    """
+    ticker = key[0]
+    bars = pd.concat(list(batches), ignore_index=True).drop_duplicates('Date', keep='last')
+
+    if group_state.exists:
+        state = from_stream_state(ticker, group_state.get)
+    else:
+        if bootstrap_path not in _stored_states:
+            _stored_states[bootstrap_path] = load_state(bootstrap_path)
+        state = ticker_state(_stored_states[bootstrap_path], ticker)
+
+    if state is None:
+        features = add_features(bars)
+        state = build_state(features)
+    else:
+        bars = bars[bars['Date'] > state.last_date[0]]
+        if bars.empty:
+            return
+        features = state.update(bars)
+
+    group_state.update(to_stream_state(state))
+    yield features
+
+
+def load_state(path=STATE_PATH):
+    """Read the persisted state, or None when there is none or it was saved with other windows."""
+    if not os.path.exists(path):
+        return None
+
+    table = pq.read_table(path)
+    widths = {'Closes': CLOSE_WINDOW, 'Macds': MACD_WINDOW, 'Highs': RANGE_WINDOW}
+    # e.g. saved without the 52 week range or before a window of features_pandas changed
+    if any(
+        column not in table.column_names or table.schema.field(column).type.list_size != width
+        for column, width in widths.items()
+    ):
+        return None
+    n = table.num_rows
+    # Arrow hands out read-only views, the state is updated in place
+    return IndicatorState(
+        table.column('Ticker').to_pylist(),
+        table.column('Last_date').to_numpy().astype('datetime64[ns]'),
+        table.column('Rows').to_numpy().copy(),
+        table.column('First_close').to_numpy().copy(),
+        table.column('Peak_close').to_numpy().copy(),
+        table.column('Closes').combine_chunks().flatten().to_numpy().reshape(n, CLOSE_WINDOW).copy(),
+        table.column('Macds').combine_chunks().flatten().to_numpy().reshape(n, MACD_WINDOW).copy(),
+        table.column('Highs').combine_chunks().flatten().to_numpy().reshape(n, RANGE_WINDOW).copy(),
+        table.column('Lows').combine_chunks().flatten().to_numpy().reshape(n, RANGE_WINDOW).copy(),
+    )
+
+
+def save_state(state, path=STATE_PATH):
+    state._unroll()
+    table = pa.table({
+        'Ticker': pa.array(state.tickers, pa.string()),
+        'Last_date': pa.array(state.last_date),
+        'Rows': pa.array(state.rows),
+        'First_close': pa.array(state.first_close),
+        'Peak_close': pa.array(state.peak_close),
+        'Closes': pa.FixedSizeListArray.from_arrays(pa.array(state.closes.ravel()), CLOSE_WINDOW),
+        'Macds': pa.FixedSizeListArray.from_arrays(pa.array(state.macds.ravel()), MACD_WINDOW),
+        'Highs': pa.FixedSizeListArray.from_arrays(pa.array(state.highs.ravel()), RANGE_WINDOW),
+        'Lows': pa.FixedSizeListArray.from_arrays(pa.array(state.lows.ravel()), RANGE_WINDOW),
+    })
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    pq.write_table(table, tmp)
+    os.replace(tmp, path)
@@ -0,0 +1,78 @@
+import json
+import os
+import numpy as np
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LEDGER_PATH = os.path.join(PROJECT_ROOT, 'data', 'ingest_ledger.json')
+
+OK = 'ok'
+EMPTY = 'empty'
+ERROR = 'error'
+
+
+def has_trading_days(start_date, end_date):
+    """True when [start_date, end_date) contains at least one weekday."""
+    return np.busday_count(start_date, end_date) > 0
+
+
+def load_ledger(path=LEDGER_PATH):
+    """Read the per-ticker status of the last ingestion, keyed by ticker."""
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_ledger(ledger, path=LEDGER_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(ledger, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def record_fetch(ledger, tickers, bars, failed, start_date, end_date):
+    """Record the outcome of fetching tickers for [start_date, end_date).
+
+    A ticker is an error when the provider raised for it, empty when no bar with a Close
+    came back for a range that has trading days, and ok otherwise.
+    """
+    if bars is not None:
+        bars = bars.dropna(subset=['Close'])
+        spans = bars.groupby('Ticker', observed=True)['Date'].agg(['size', 'min', 'max'])
+    else:
+        spans = None
+
+    updated_at = datetime.now().isoformat(timespec='seconds')
+    expect_bars = has_trading_days(start_date, end_date)
+
+    for ticker in tickers:
+        entry = {
+            'start_date': start_date,
+            'end_date': end_date,
+            'rows': 0,
+            'first_date': None,
+            'last_date': None,
+            'error': None,
+            'updated_at': updated_at,
+        }
+        if ticker in failed:
+            entry['status'] = ERROR
+            entry['error'] = failed[ticker]
+        elif spans is not None and ticker in spans.index:
+            rows, first_date, last_date = spans.loc[ticker]
+            entry['status'] = OK
+            entry['rows'] = int(rows)
+            entry['first_date'] = first_date.strftime('%Y-%m-%d')
+            entry['last_date'] = last_date.strftime('%Y-%m-%d')
+        else:
+            entry['status'] = EMPTY if expect_bars else OK
+        ledger[ticker] = entry
+
+    return ledger
+
+
+def pending_tickers(ledger, tickers):
+    """Tickers whose last fetch failed or came back empty, plus ones never fetched."""
+    return [ticker for ticker in tickers if ledger.get(ticker, {}).get('status') != OK]
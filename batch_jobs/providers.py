@@ -0,0 +1,356 @@
+import os
+import zlib
+import numpy as np
+import pandas as pd
+
+import raw_cache
+from storage import EXCHANGE_TZ
+from downloader import TokenBucket, download_concurrently
+
+BAR_COLUMNS = ['Ticker', 'Date', 'Open', 'High', 'Low', 'Close', 'Volume']
+
+INTERVALS = ['1d', '1h', '5m', '1m']
+# how far back Yahoo serves intraday bars, and the longest range of one 1m request
+INTRADAY_LOOKBACK_DAYS = {'1h': 730, '5m': 60, '1m': 30}
+MAX_REQUEST_DAYS = {'1m': 7}
+# regular session of the exchange, in its local time
+SESSION_OPEN = '09:30'
+SESSION_MINUTES = 390
+
+
+class MarketDataProvider:
+    """Source of OHLCV bars of one interval, daily unless the provider was built for intraday bars.
+
+    fetch returns a flat frame with BAR_COLUMNS, one row per ticker per bar in
+    [start_date, end_date), or None when there is nothing to return. Tickers the last
+    fetch raised for are left out and listed in failed, mapped to the error. Daily bars are
+    dated by exchange-local day, intraday bars by their start time in UTC without a timezone.
+    """
+
+    def __init__(self):
+        # per instance, a wrapped provider's failures are not its wrapper's nor another run's
+        self.failed = {}
+
+    def fetch(self, tickers, start_date, end_date):
+        raise NotImplementedError
+
+    def fetch_one(self, ticker, start_date, end_date):
+        return self.fetch([ticker], start_date, end_date)
+
+    def refetch(self, tickers, start_date, end_date):
+        """fetch, bypassing any cache, so bars the source has adjusted since (splits, dividends) come back adjusted."""
+        return self.fetch(tickers, start_date, end_date)
+
+    def forget(self, tickers):
+        """Drop whatever is kept about tickers whose whole history is about to be fetched again."""
+
+
+def flatten_bars(raw):
+    """Reshape a group_by='ticker' download (columns ticker x field, one row per date) to flat bars.
+
+    Each field is pulled out as a dates x tickers block and raveled ticker-major, so the long
+    frame is built column by column with a categorical Ticker and no per-ticker frames.
+    """
+    tickers = raw.columns.unique(level=0)
+    dates = raw.index.to_numpy()
+
+    columns = {
+        'Ticker': pd.Categorical.from_codes(np.repeat(np.arange(len(tickers)), len(dates)), categories=tickers),
+        'Date': np.tile(dates, len(tickers)),
+    }
+    for field in BAR_COLUMNS[2:]:
+        block = raw.xs(field, axis=1, level=1).reindex(columns=tickers)
+        columns[field] = block.to_numpy().ravel(order='F')
+
+    return pd.DataFrame(columns)
+
+
+def request_ranges(start_date, end_date, interval):
+    """Split [start_date, end_date) into the ranges a single Yahoo request may ask for."""
+    max_days = MAX_REQUEST_DAYS.get(interval)
+    if max_days is None:
+        return [(start_date, end_date)]
+    bounds = list(pd.date_range(start_date, end_date, freq=f'{max_days}D').strftime('%Y-%m-%d'))
+    if bounds[-1] != end_date:
+        bounds.append(end_date)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _utc_naive(index):
+    """Intraday timestamps come exchange-local with a timezone, store them in UTC without one."""
+    return index.tz_convert('UTC').tz_localize(None)
+
+
+class YFinanceProvider(MarketDataProvider):
+    """Bars downloaded from Yahoo Finance."""
+
+    def __init__(self, timeout=10, interval='1d'):
+        # imported here so the other providers work on hosts without yfinance or network
+        import yfinance as yf
+        super().__init__()
+        self.yf = yf
+        self.timeout = timeout
+        self.interval = interval
+
+    def fetch(self, tickers, start_date, end_date):
+        frames = []
+        for range_start, range_end in request_ranges(start_date, end_date, self.interval):
+            raw = self.yf.download(tickers, start=range_start, end=range_end, interval=self.interval, group_by='ticker')
+            if raw is None or raw.empty:
+                continue
+            if self.interval != '1d':
+                raw.index = _utc_naive(raw.index)
+            frames.append(flatten_bars(raw))
+
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+
+    def fetch_one(self, ticker, start_date, end_date):
+        frames = []
+        for range_start, range_end in request_ranges(start_date, end_date, self.interval):
+            # yf.download keeps its results in module-level state, Ticker.history is safe to call from threads
+            history = self.yf.Ticker(ticker).history(
+                start=range_start, end=range_end, interval=self.interval, timeout=self.timeout, raise_errors=True
+            )
+            if history.empty:
+                continue
+            if self.interval == '1d':
+                # match yf.download, which returns exchange-local dates without a timezone
+                history.index = history.index.tz_localize(None)
+            else:
+                history.index = _utc_naive(history.index)
+            frames.append(history.rename_axis('Date').reset_index())
+
+        if not frames:
+            return None
+        bars = pd.concat(frames, ignore_index=True)
+        bars['Ticker'] = ticker
+        return bars[BAR_COLUMNS]
+
+
+class ConcurrentProvider(MarketDataProvider):
+    """Fetches each ticker separately through provider.fetch_one on a bounded thread pool.
+
+    Requests are throttled by a token bucket of rate_limit per second and retried per ticker
+    with exponential backoff. Tickers still failing after the retries are left out of the
+    result and listed in self.failed.
+    """
+
+    def __init__(self, provider, max_workers=8, rate_limit=5.0, retries=3, backoff=1.0):
+        super().__init__()
+        self.provider = provider
+        self.max_workers = max_workers
+        self.limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.retries = retries
+        self.backoff = backoff
+
+    def fetch(self, tickers, start_date, end_date):
+        bars, self.failed = download_concurrently(
+            self.provider.fetch_one, tickers, start_date, end_date,
+            max_workers=self.max_workers, limiter=self.limiter, retries=self.retries, backoff=self.backoff
+        )
+        if self.failed:
+            print(f'Failed to fetch {len(self.failed)} tickers after {self.retries} retries: {sorted(self.failed)}')
+        return bars
+
+
+class CachedProvider(MarketDataProvider):
+    """Wraps another provider with the on-disk raw bar cache.
+
+    With replay=True the wrapped provider is never called and only cached bars are served.
+    """
+
+    def __init__(self, provider, replay=False, cache_dir=raw_cache.CACHE_DIR):
+        super().__init__()
+        self.provider = provider
+        self.replay = replay
+        self.cache_dir = cache_dir
+
+    def _fetch_missing(self, tickers, start_date, end_date):
+        bars = self.provider.fetch(tickers, start_date, end_date)
+        # the cache may call the provider once per gap, keep the failures of all of them
+        self.failed.update(self.provider.failed)
+        return bars
+
+    def fetch(self, tickers, start_date, end_date, refresh=False):
+        self.failed = {}
+        return raw_cache.cached_download(
+            tickers, start_date, end_date, self._fetch_missing, replay=self.replay, cache_dir=self.cache_dir,
+            refresh=refresh,
+        )
+
+    def refetch(self, tickers, start_date, end_date):
+        # replay never reaches the source, the cache is all there is
+        return self.fetch(tickers, start_date, end_date, refresh=not self.replay)
+
+    def forget(self, tickers):
+        if self.replay:
+            return
+        for ticker in tickers:
+            raw_cache.forget(self.cache_dir, ticker)
+
+
+class LocalFileProvider(MarketDataProvider):
+    """Bars read from <directory>/<TICKER>.parquet or <directory>/<TICKER>.csv files.
+
+    Files hold the columns of a yfinance export: Date, Open, High, Low, Close, Volume.
+    """
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+
+    def _read(self, ticker):
+        parquet_path = os.path.join(self.directory, f'{ticker}.parquet')
+        csv_path = os.path.join(self.directory, f'{ticker}.csv')
+        if os.path.exists(parquet_path):
+            return pd.read_parquet(parquet_path)
+        if os.path.exists(csv_path):
+            return pd.read_csv(csv_path, parse_dates=['Date'])
+        return None
+
+    def fetch(self, tickers, start_date, end_date):
+        frames = []
+        missing = []
+        for ticker in tickers:
+            bars = self._read(ticker)
+            if bars is None:
+                missing.append(ticker)
+                continue
+            in_range = (bars['Date'] >= pd.Timestamp(start_date)) & (bars['Date'] < pd.Timestamp(end_date))
+            frames.append(bars[in_range].assign(Ticker=ticker))
+
+        if missing:
+            print(f'No local files for {missing} in {self.directory}')
+        if not frames:
+            return None
+
+        return pd.concat(frames, ignore_index=True)[BAR_COLUMNS]
+
+
+class SyntheticProvider(MarketDataProvider):
+    """Seeded geometric Brownian motion bars for any number of tickers and years.
+
+    Each ticker's path is generated from a fixed epoch with a generator seeded from
+    (seed, ticker), so a given bar is identical whatever date range asks for it.
+    Intraday bars bridge each day's open to its close over a regular session.
+    """
+
+    EPOCH = '1990-01-01'
+
+    def __init__(self, seed=0, interval='1d'):
+        super().__init__()
+        self.seed = seed
+        self.interval = interval
+
+    def _ticker_rng(self, ticker, stream=0):
+        # one generator per drawn series, so each series' prefix does not depend on its length
+        return np.random.default_rng([self.seed, zlib.crc32(ticker.encode()), stream])
+
+    def fetch(self, tickers, start_date, end_date):
+        daily = self.fetch_daily(tickers, start_date, end_date)
+        if self.interval == '1d' or daily is None:
+            return daily
+        return self.split_sessions(daily)
+
+    def split_sessions(self, daily):
+        """Intraday bars whose session opens, closes and trades the volume of each daily bar."""
+        minutes = int(self.interval[:-1]) * (60 if self.interval.endswith('h') else 1)
+        n = -(-SESSION_MINUTES // minutes)
+        # bar start times of each day, the exchange's local clock converted to UTC
+        days = pd.DatetimeIndex(daily['Date'].unique())
+        opens = (days + pd.Timedelta(SESSION_OPEN + ':00')).tz_localize(EXCHANGE_TZ).tz_convert('UTC').tz_localize(None)
+        starts = dict(zip(days, opens.values))
+        offsets = np.arange(n) * np.timedelta64(minutes, 'm')
+
+        t = np.arange(1, n + 1) / n
+        columns = {field: [] for field in BAR_COLUMNS}
+        for ticker, date, open_, close, volume in daily[['Ticker', 'Date', 'Open', 'Close', 'Volume']].itertuples(index=False):
+            # one generator per ticker and day, so a session does not depend on the requested range
+            rng = np.random.default_rng([self.seed, zlib.crc32(ticker.encode()), 6, date.toordinal()])
+            walk = np.cumsum(rng.standard_normal(n)) * 0.002
+            log_close = np.log(open_) + t * (np.log(close) - np.log(open_)) + walk - t * walk[-1]
+            bar_close = np.exp(log_close)
+            bar_open = np.concatenate(([open_], bar_close[:-1]))
+            wick = np.exp(np.abs(rng.standard_normal((2, n))) * 0.001)
+
+            columns['Date'].append(starts[date] + offsets)
+            columns['Open'].append(bar_open)
+            columns['High'].append(np.maximum(bar_open, bar_close) * wick[0])
+            columns['Low'].append(np.minimum(bar_open, bar_close) / wick[1])
+            columns['Close'].append(bar_close)
+            columns['Volume'].append(rng.multinomial(volume, np.full(n, 1 / n)).astype('int64'))
+
+        tickers = daily['Ticker'].cat.categories
+        return pd.DataFrame({
+            'Ticker': pd.Categorical.from_codes(np.repeat(daily['Ticker'].cat.codes.to_numpy(), n), categories=tickers),
+            **{field: np.concatenate(values) for field, values in columns.items() if field != 'Ticker'},
+        })
+
+    def fetch_daily(self, tickers, start_date, end_date):
+        # business days only, no exchange holidays
+        days = pd.bdate_range(self.EPOCH, pd.Timestamp(end_date) - pd.Timedelta(days=1))
+        first = days.searchsorted(pd.Timestamp(start_date))
+        n_days = len(days)
+        n_out = n_days - first
+        if n_out <= 0:
+            return None
+
+        closes, opens, highs, lows, volumes = [], [], [], [], []
+        for ticker in tickers:
+            rng = self._ticker_rng(ticker)
+            drift = rng.uniform(-0.05, 0.15) / 252
+            sigma = rng.uniform(0.15, 0.6) / np.sqrt(252)
+            start_price = rng.uniform(10, 500)
+
+            noise = [self._ticker_rng(ticker, stream).standard_normal(n_days) for stream in range(1, 5)]
+            log_returns = (drift - 0.5 * sigma ** 2) + sigma * noise[0]
+            close = start_price * np.exp(np.cumsum(log_returns))
+            prev_close = np.concatenate(([start_price], close[:-1]))
+            open_ = prev_close * np.exp(0.2 * sigma * noise[1])
+            high = np.maximum(open_, close) * np.exp(np.abs(0.5 * sigma * noise[2]))
+            low = np.minimum(open_, close) * np.exp(-np.abs(0.5 * sigma * noise[3]))
+            volume = self._ticker_rng(ticker, 5).lognormal(mean=15, sigma=0.5, size=n_days).astype('int64')
+
+            # copy the requested slice so the full path from the epoch can be freed
+            closes.append(close[first:].copy())
+            opens.append(open_[first:].copy())
+            highs.append(high[first:].copy())
+            lows.append(low[first:].copy())
+            volumes.append(volume[first:].copy())
+
+        return pd.DataFrame({
+            'Ticker': pd.Categorical.from_codes(np.repeat(np.arange(len(tickers)), n_out), categories=tickers),
+            'Date': np.tile(days[first:].values, len(tickers)),
+            'Open': np.concatenate(opens),
+            'High': np.concatenate(highs),
+            'Low': np.concatenate(lows),
+            'Close': np.concatenate(closes),
+            'Volume': np.concatenate(volumes),
+        })
+
+
+def synthetic_tickers(count):
+    """Generate placeholder symbols SYN00001, SYN00002, ... for load tests."""
+    return [f'SYN{i:05d}' for i in range(1, count + 1)]
+
+
+def get_provider(name, cache=True, data_dir=None, seed=0, max_workers=8, rate_limit=5.0, retries=3, interval='1d'):
+    """Build the provider selected on the command line."""
+    # each interval has its own raw bar cache, the ranges of one say nothing about the others
+    cache_dir = raw_cache.CACHE_DIR if interval == '1d' else os.path.join(raw_cache.CACHE_DIR, interval)
+    if name == 'yfinance':
+        provider = YFinanceProvider(interval=interval)
+        if max_workers > 1:
+            provider = ConcurrentProvider(provider, max_workers=max_workers, rate_limit=rate_limit, retries=retries)
+        return CachedProvider(provider, cache_dir=cache_dir) if cache else provider
+    if name == 'replay':
+        return CachedProvider(None, replay=True, cache_dir=cache_dir)
+    if name == 'local':
+        if data_dir is None:
+            raise ValueError('the local provider needs a data directory')
+        return LocalFileProvider(data_dir)
+    if name == 'synthetic':
+        return SyntheticProvider(seed=seed, interval=interval)
+    raise ValueError(f'Unknown provider: {name}')
@@ -0,0 +1,94 @@
+import os
+import json
+import shutil
+from datetime import datetime
+from urllib.parse import quote
+
+from storage import CURRENT_FILE, PARTITION_COLUMN, SCHEMA_VERSION, VERSIONS_DIR, compact_partitions, current_path, current_version
+
+# published versions kept on disk, older ones are deleted once nobody should still be reading them
+KEEP_VERSIONS = 3
+
+
+def _version_name(number):
+    return f'{number:06d}'
+
+
+def _link_tree(source, target):
+    """Hard-link every data file under source into target; Parquet files are never modified in place."""
+    for root, dirs, files in os.walk(source):
+        # Spark's _SUCCESS/.crc markers are rewritten on append, never share those
+        dirs[:] = [d for d in dirs if not d.startswith(('_', '.'))]
+        destination = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(destination, exist_ok=True)
+        for name in files:
+            if not name.startswith(('_', '.')):
+                os.link(os.path.join(root, name), os.path.join(destination, name))
+
+
+def stage(path, carry_over=False):
+    """Create the directory of the next version and return it.
+
+    With carry_over the files of the published version are hard-linked into it first, so an
+    append only writes the new files and never touches what readers currently see.
+    """
+    versions = os.path.join(path, VERSIONS_DIR)
+    os.makedirs(versions, exist_ok=True)
+    numbers = [int(name) for name in os.listdir(versions) if name.isdigit()]
+    staging = os.path.join(versions, _version_name(max(numbers, default=0) + 1))
+    os.makedirs(staging)
+
+    if carry_over and os.path.exists(path):
+        _link_tree(current_path(path), staging)
+    return staging
+
+
+def unlink_tickers(staging, tickers):
+    """Remove the partitions of tickers from a staged version; the versions they were linked from keep their files."""
+    for ticker in tickers:
+        shutil.rmtree(os.path.join(staging, f'{PARTITION_COLUMN}={quote(ticker, safe="")}'), ignore_errors=True)
+
+
+def publish(path, staging, keep=KEEP_VERSIONS):
+    """Point readers at the staged version with an atomic swap of the manifest, then prune.
+
+    Partitions that appends left with many small files are merged first, see storage.compact_partitions.
+    """
+    compacted = compact_partitions(staging)
+    if compacted:
+        print(f'Compacted {compacted} partitions into one file each')
+    previous = current_version(path)
+    history = previous['history'] if previous else []
+    number = int(os.path.basename(staging))
+
+    manifest = {
+        'version': number,
+        'path': os.path.join(VERSIONS_DIR, _version_name(number)),
+        # runs only add to output of their own schema, see stock_etl.main
+        'schema_version': SCHEMA_VERSION,
+        'published_at': datetime.now().isoformat(timespec='seconds'),
+        'history': (history + [number])[-keep:],
+    }
+    tmp = os.path.join(path, CURRENT_FILE + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, os.path.join(path, CURRENT_FILE))
+
+    prune(path, manifest['history'])
+
+
+def prune(path, kept):
+    """Delete versions outside kept, failed stagings and files of an older unversioned layout."""
+    versions = os.path.join(path, VERSIONS_DIR)
+    for name in os.listdir(versions):
+        if not name.isdigit() or int(name) not in kept:
+            shutil.rmtree(os.path.join(versions, name))
+
+    for name in os.listdir(path):
+        if name in (VERSIONS_DIR, CURRENT_FILE):
+            continue
+        entry = os.path.join(path, name)
+        if os.path.isdir(entry):
+            shutil.rmtree(entry)
+        else:
+            os.remove(entry)
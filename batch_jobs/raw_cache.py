@@ -0,0 +1,177 @@
+import os
+import shutil
+import pandas as pd
+from datetime import datetime
+
+from ingest_ledger import has_trading_days
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(PROJECT_ROOT, 'data', 'raw_cache')
+
+DATE_FORMAT = "%Y-%m-%d"
+
+# Layout: one directory per ticker holding one Parquet file per fetched [start, end) range,
+# named <start>_<end>.parquet. An empty result is only recorded for ranges without trading
+# days (weekends), otherwise it is treated as a failed fetch and asked for again next run.
+
+# daily incremental runs add one small file per ticker, merge them once there are this many
+COMPACT_AFTER_FILES = 32
+
+
+def _ticker_dir(cache_dir, ticker):
+    return os.path.join(cache_dir, f'ticker={ticker}')
+
+
+def cached_ranges(cache_dir, ticker):
+    """List the (start, end) ranges already cached for a ticker, sorted by start."""
+    path = _ticker_dir(cache_dir, ticker)
+    if not os.path.isdir(path):
+        return []
+
+    ranges = []
+    for name in os.listdir(path):
+        if name.endswith('.parquet'):
+            start, end = name[:-len('.parquet')].split('_')
+            ranges.append((start, end))
+    return sorted(ranges)
+
+
+def missing_ranges(ranges, start_date, end_date):
+    """Return the parts of [start_date, end_date) not covered by ranges."""
+    gaps = []
+    cursor = start_date
+    for start, end in ranges:
+        if end <= cursor:
+            continue
+        if start >= end_date:
+            break
+        if start > cursor:
+            gaps.append((cursor, start))
+        cursor = end if end > cursor else cursor
+    if cursor < end_date:
+        gaps.append((cursor, end_date))
+    return gaps
+
+
+def read_cached(cache_dir, ticker, start_date, end_date):
+    """Load the cached bars of a ticker falling inside [start_date, end_date)."""
+    files = [
+        os.path.join(_ticker_dir(cache_dir, ticker), f'{start}_{end}.parquet')
+        for start, end in cached_ranges(cache_dir, ticker)
+        if start < end_date and end > start_date
+    ]
+    if not files:
+        return None
+
+    frames = [pd.read_parquet(f) for f in files]
+    frames = [frame for frame in frames if not frame.empty]
+    if not frames:
+        return None
+
+    bars = pd.concat(frames, ignore_index=True)
+    in_range = (bars['Date'] >= pd.Timestamp(start_date)) & (bars['Date'] < pd.Timestamp(end_date))
+    bars = bars[in_range].drop_duplicates(subset='Date', keep='last')
+    bars.insert(0, 'Ticker', ticker)
+    return bars
+
+
+def write_cached(cache_dir, ticker, start_date, end_date, bars):
+    """Store the bars fetched for one ticker and range."""
+    path = _ticker_dir(cache_dir, ticker)
+    os.makedirs(path, exist_ok=True)
+
+    target = os.path.join(path, f'{start_date}_{end_date}.parquet')
+    tmp = target + '.tmp'
+    bars.drop(columns='Ticker').to_parquet(tmp, index=False)
+    # rename so an interrupted run never leaves a truncated range behind
+    os.replace(tmp, target)
+
+
+def forget(cache_dir, ticker):
+    """Delete everything cached for a ticker, e.g. once its bars were adjusted for a split or dividend."""
+    shutil.rmtree(_ticker_dir(cache_dir, ticker), ignore_errors=True)
+
+
+def _drop_ranges_within(cache_dir, ticker, start_date, end_date):
+    """Delete the cached ranges of a ticker lying inside [start_date, end_date), except that range itself."""
+    for start, end in cached_ranges(cache_dir, ticker):
+        if start >= start_date and end <= end_date and (start, end) != (start_date, end_date):
+            os.remove(os.path.join(_ticker_dir(cache_dir, ticker), f'{start}_{end}.parquet'))
+
+
+def compact(cache_dir, ticker):
+    """Merge chains of touching ranges of a ticker into one file each."""
+    chains = []
+    for start, end in cached_ranges(cache_dir, ticker):
+        if chains and start <= chains[-1][-1][1]:
+            chains[-1].append((start, end))
+        else:
+            chains.append([(start, end)])
+
+    path = _ticker_dir(cache_dir, ticker)
+    for chain in chains:
+        if len(chain) == 1:
+            continue
+        chain_start = chain[0][0]
+        chain_end = max(end for _, end in chain)
+        bars = read_cached(cache_dir, ticker, chain_start, chain_end)
+        if bars is None:
+            # only empty ranges, nothing to merge
+            continue
+        write_cached(cache_dir, ticker, chain_start, chain_end, bars)
+        for start, end in chain:
+            if (start, end) != (chain_start, chain_end):
+                os.remove(os.path.join(path, f'{start}_{end}.parquet'))
+
+
+def cached_download(tickers, start_date, end_date, fetch, replay=False, cache_dir=CACHE_DIR, refresh=False):
+    """Return flat bars for tickers, fetching only the ranges that are not cached yet.
+
+    fetch(tickers, start_date, end_date) must return a flat frame with a Ticker column, or None.
+    With replay=True the network is never used and only cached bars are served. With refresh the
+    whole range is fetched again and replaces what was cached for it, so bars the source has
+    adjusted since they were cached come back as the source serves them now.
+    """
+    # a range ending in the future would be recorded as covered before its bars exist
+    today = datetime.now().strftime(DATE_FORMAT)
+    if end_date > today:
+        end_date = today
+
+    # group tickers sharing the same gap so each gap is a single fetch
+    gaps = {}
+    for ticker in tickers:
+        for gap in missing_ranges(cached_ranges(cache_dir, ticker), start_date, end_date):
+            gaps.setdefault(gap, []).append(ticker)
+    if refresh and start_date < end_date:
+        gaps = {(start_date, end_date): list(tickers)}
+
+    if replay:
+        if gaps:
+            incomplete = sorted({ticker for group in gaps.values() for ticker in group})
+            print(f'Replay mode: cache does not fully cover {start_date} -> {end_date} for {incomplete}')
+    else:
+        for (gap_start, gap_end), group in gaps.items():
+            fetched = fetch(group, gap_start, gap_end)
+            if fetched is not None:
+                # multi-ticker downloads pad every ticker to the union of dates with NaN rows
+                fetched = fetched.dropna(subset=['Close'])
+            expect_bars = has_trading_days(gap_start, gap_end)
+            for ticker in group:
+                bars = fetched[fetched['Ticker'] == ticker] if fetched is not None else None
+                if bars is None or bars.empty:
+                    if expect_bars:
+                        continue
+                    bars = pd.DataFrame({'Ticker': pd.Series(dtype=str), 'Date': pd.Series(dtype='datetime64[ns]')})
+                write_cached(cache_dir, ticker, gap_start, gap_end, bars)
+                if refresh:
+                    # ranges overlapping it read before it, those inside it would come back after it
+                    _drop_ranges_within(cache_dir, ticker, gap_start, gap_end)
+                if len(cached_ranges(cache_dir, ticker)) > COMPACT_AFTER_FILES:
+                    compact(cache_dir, ticker)
+
+    frames = [read_cached(cache_dir, ticker, start_date, end_date) for ticker in tickers]
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return None
+
+    return pd.concat(frames, ignore_index=True)
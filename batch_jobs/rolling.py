@@ -0,0 +1,241 @@
+import numpy as np
+import pandas as pd
+
+# Rolling-window kernels over rows sorted by group, each row's window ending at the row and never
+# reaching into the previous group (starts holds the index of each row's first group row, see
+# features_pandas.group_starts). The cost is O(n) whatever the window length.
+#
+# Shipped to Spark's Python workers next to features_pandas, so it only depends on NumPy and pandas.
+
+# unit roundoff of float64
+UNIT_ROUNDOFF = 2.0 ** -53
+# bits of each value's integer part below, sums of up to 2**37 rows stay exact in int64
+INTEGER_BITS = 26
+
+
+def window_bounds(starts, window):
+    """First row and row count of each row's window."""
+    idx = np.arange(len(starts))
+    first = np.maximum(starts, idx - window + 1)
+    return first, idx - first + 1
+
+
+def prefix_sums(values, starts):
+    """Exclusive prefix sums of values split as (integers + remainders) * quantum, and error bounds.
+
+    Each group gets a power of two quantum from its largest value, so the int64 integer parts hold
+    INTEGER_BITS bits of every value and their prefix sums are exact. Remainders, below half a
+    quantum, are summed in quanta, so a group's sums carry rounding errors relative to its own
+    values, whatever the groups before it hold. A window sum taken as a difference of prefix sums
+    is then within a few ulps of the exact sum, whatever the window length.
+    """
+    n = len(values)
+    is_start = starts == np.arange(n)
+    group = np.cumsum(is_start) - 1
+    largest = np.maximum.reduceat(np.abs(values), np.flatnonzero(is_start)) if n else np.zeros(0)
+    exponents = np.frexp(largest)[1] - INTEGER_BITS
+    quanta = np.ldexp(1.0, np.where(largest > 0, exponents, 0))[group] if n else np.zeros(0)
+
+    scaled = values / quanta
+    integers = np.rint(scaled)
+    integer_sums = np.zeros(n + 1, dtype='int64')
+    np.cumsum(integers.astype('int64'), out=integer_sums[1:])
+    remainder_sums = np.zeros(n + 1)
+    np.cumsum(scaled - integers, out=remainder_sums[1:])
+    # each step of cumsum rounds its running total once
+    errors = np.zeros(n + 1)
+    np.cumsum(UNIT_ROUNDOFF * np.abs(remainder_sums[1:]), out=errors[1:])
+    return integer_sums, remainder_sums, quanta, errors
+
+
+def _window_sums(values, starts, first, last):
+    """Sums of values[first:last] and a bound on their error."""
+    integer_sums, remainder_sums, quanta, errors = prefix_sums(values, starts)
+    units = (integer_sums[last] - integer_sums[first]) + (remainder_sums[last] - remainder_sums[first])
+    totals = units * quanta
+    bounds = 2 * (errors[last] + errors[first]) * quanta + 2 * UNIT_ROUNDOFF * np.abs(totals)
+    return totals, bounds
+
+
+def _finite(values, first, last):
+    """Values with non-finite entries zeroed, and whether each window holds a non-finite one."""
+    finite = np.isfinite(values)
+    if finite.all():
+        return values, np.zeros(len(first), dtype=bool)
+    bad = np.zeros(len(values) + 1, dtype='int64')
+    np.cumsum(~finite, out=bad[1:])
+    return np.where(finite, values, 0.0), bad[last] > bad[first]
+
+
+def in_order_sums(values, starts, window, rows):
+    """Window sums of the given rows added oldest to newest, as Spark's sliding frame adds them.
+
+    Costs O(len(rows) * window), it settles the few rows where the order of the additions matters.
+    """
+    rows = np.asarray(rows)
+    first = np.maximum(starts[rows], rows - window + 1)
+    totals = np.zeros(len(rows))
+    for offset in range(window - 1, -1, -1):
+        idx = rows - offset
+        totals += np.where(idx >= first, values[np.maximum(idx, 0)], 0.0)
+    return totals
+
+
+def near_rounding_tie(means, count, abs_totals, abs_bounds, bounds, decimals):
+    """Where means of window sums within bounds of the exact ones may round otherwise than Spark's means.
+
+    Spark's in-order sum is off the exact one by at most (count - 1) roundings of the running
+    total, so means close enough to a tie of their decimals for those ulps to matter are flagged.
+    abs_totals (within abs_bounds) are the window sums of the absolute values.
+    """
+    spread = UNIT_ROUNDOFF * (count + 1) * (abs_totals + abs_bounds) + bounds
+    margin = (2 * spread / count + 4 * UNIT_ROUNDOFF * np.abs(means)) * 10.0 ** decimals
+    scaled = np.abs(means) * 10.0 ** decimals
+    # spark_round settles values within 1e-6 of a tie on their decimal digits, keep clear of those too
+    return np.abs(scaled - np.floor(scaled) - 0.5) <= margin + 1e-6
+
+
+def rolling_sum(values, starts, window):
+    """Sum of the last `window` rows of each row's group."""
+    first, count = window_bounds(starts, window)
+    last = first + count
+    finite_values, bad = _finite(values, first, last)
+    totals, _ = _window_sums(finite_values, starts, first, last)
+    if bad.any():
+        rows = np.flatnonzero(bad)
+        totals[rows] = in_order_sums(values, starts, window, rows)
+    return totals
+
+
+def rolling_mean(values, starts, window, decimals=None):
+    """Mean of the last `window` rows of each row's group, like avg() over rowsBetween(-(window - 1), 0).
+
+    Means taken from prefix sums are within a few ulps of the in-order sums Spark's sliding frame
+    computes. With decimals, the means are meant to be rounded to that many decimals: rows whose
+    mean is close enough to a rounding tie for those ulps to matter are summed in order instead,
+    so the rounded means match Spark's bit for bit.
+    """
+    first, count = window_bounds(starts, window)
+    last = first + count
+    finite_values, bad = _finite(values, first, last)
+    totals, bounds = _window_sums(finite_values, starts, first, last)
+    means = totals / count
+
+    recompute = bad
+    if decimals is not None:
+        if (finite_values >= 0).all():
+            abs_totals, abs_bounds = totals, bounds
+        else:
+            abs_totals, abs_bounds = _window_sums(np.abs(finite_values), starts, first, last)
+        recompute = recompute | near_rounding_tie(means, count, abs_totals, abs_bounds, bounds, decimals)
+
+    if recompute.any():
+        rows = np.flatnonzero(recompute)
+        means[rows] = in_order_sums(values, starts, window, rows) / count[rows]
+    return means
+
+
+def _first_finite(values, starts):
+    """First finite value of each row's group, 0 where the group has none."""
+    n = len(values)
+    if n == 0:
+        return values
+    rows = np.where(np.isfinite(values), np.arange(n), n)
+    group_first = np.flatnonzero(starts == np.arange(n))
+    found = np.minimum.reduceat(rows, group_first)
+    firsts = np.where(found < n, values[np.minimum(found, n - 1)], 0.0)
+    return firsts[np.cumsum(starts == np.arange(n)) - 1]
+
+
+def rolling_var(values, starts, window, ddof=1):
+    """Variance of the last `window` rows of each row's group, NaN where a window has ddof rows or fewer.
+
+    ddof=1 is Spark's var_samp. Values are shifted by their group's first finite value before the sums of
+    values and squares are taken, which keeps the cancellation in sum(x^2) - sum(x)^2 / n small.
+    Windows holding a NaN or infinite value are NaN, as their variance is in Spark.
+    """
+    first, count = window_bounds(starts, window)
+    last = first + count
+    finite_values, bad = _finite(values, first, last)
+    shifted = np.where(np.isfinite(values), finite_values - _first_finite(values, starts), 0.0)
+    sums, _ = _window_sums(shifted, starts, first, last)
+    squares, _ = _window_sums(shifted * shifted, starts, first, last)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = np.maximum(squares - sums * sums / count, 0.0) / (count - ddof)
+    return np.where((count > ddof) & ~bad, variance, np.nan)
+
+
+def _block_accumulate(values, blocks, how):
+    """Running cummax/cummin of values within each block, skipping NaN like np.fmax/np.fmin."""
+    running = pd.Series(values).groupby(blocks, sort=False)
+    result = running.cummax() if how == 'max' else running.cummin()
+    if np.isnan(values).any():
+        # a NaN row takes the running value of the rows before it
+        result = result.groupby(blocks, sort=False).ffill()
+    return result.to_numpy()
+
+
+def _rolling_extreme(values, starts, window, how):
+    """Max or min of each row's window in O(n), from running extremes over blocks of window rows.
+
+    Blocks are cut every window rows from the start of each group (van Herk / Gil-Werman). A
+    window either lies in one block, where it ends the running extreme from the block's start, or
+    spans the end of one block and the start of the next, whose running extremes from either side
+    combine to the window's. About three comparisons a row, like a monotonic deque, but vectorized.
+    """
+    n = len(values)
+    if n == 0:
+        return np.empty(0)
+    idx = np.arange(n)
+    first, _ = window_bounds(starts, window)
+    blocks = np.cumsum((idx - starts) % window == 0) - 1
+
+    forward = _block_accumulate(values, blocks, how)
+    backward = _block_accumulate(values[::-1], blocks[::-1], how)[::-1]
+    combine = np.fmax if how == 'max' else np.fmin
+    return np.where(blocks[first] == blocks, forward, combine(backward[first], forward))
+
+
+def rolling_max(values, starts, window):
+    """Largest of the last `window` rows of each row's group, ignoring NaN (NaN when all are)."""
+    return _rolling_extreme(values, starts, window, 'max')
+
+
+def rolling_min(values, starts, window):
+    """Smallest of the last `window` rows of each row's group, ignoring NaN (NaN when all are)."""
+    return _rolling_extreme(values, starts, window, 'min')
+
+
+def _drawdown(peak, trough):
+    """How far trough lies below peak, in percent."""
+    return (trough - peak) / peak * 100
+
+
+def rolling_max_drawdown(values, starts, window):
+    """Deepest fall, in percent, from a peak to a later value within the last `window` rows of each row's group.
+
+    Cut into blocks like _rolling_extreme: within a block the running peak gives the drawdown of
+    each row from the block's start. A window spanning two blocks combines the deepest fall inside
+    its part of the earlier block, taken from the block's end backwards, the deepest fall inside
+    its part of the later block, and the fall from the earlier part's peak to the later part's low.
+    NaN rows are skipped, a window of NaN only is NaN.
+    """
+    n = len(values)
+    if n == 0:
+        return np.empty(0)
+    idx = np.arange(n)
+    first, _ = window_bounds(starts, window)
+    blocks = np.cumsum((idx - starts) % window == 0) - 1
+
+    peaks = _block_accumulate(values, blocks, 'max')
+    lows = _block_accumulate(values, blocks, 'min')
+    drawdowns = _block_accumulate(_drawdown(peaks, values), blocks, 'min')
+
+    # from each row to its block's end: the peak, and the deepest fall from a row to a later low
+    back_peaks = _block_accumulate(values[::-1], blocks[::-1], 'max')[::-1]
+    back_lows = _block_accumulate(values[::-1], blocks[::-1], 'min')[::-1]
+    falls = _drawdown(values, back_lows)
+    back_drawdowns = _block_accumulate(falls[::-1], blocks[::-1], 'min')[::-1]
+
+    spanning = np.fmin(np.fmin(back_drawdowns[first], drawdowns), _drawdown(back_peaks[first], lows))
+    return np.where(blocks[first] == blocks, drawdowns, spanning)
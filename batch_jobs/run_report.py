@@ -0,0 +1,186 @@
+import io
+import os
+import json
+import time
+import uuid
+import contextlib
+from datetime import datetime
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# one JSON line per ETL run, newest last; read by the dashboard's Pipeline health panel
+REPORT_PATH = os.path.join(PROJECT_ROOT, 'data', 'run_reports.jsonl')
+
+# runs kept in the report file, older ones are dropped when a run is appended
+MAX_RUNS = 200
+
+
+def frame_bytes(df):
+    """In-memory size of a pandas frame, strings and categories included."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def dir_bytes(path):
+    """Bytes of all files under path, 0 when it does not exist yet."""
+    if not os.path.exists(path):
+        return 0
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def _millis(option):
+    """Epoch milliseconds of a Scala Option[Date] from the status store, None when unset."""
+    return option.get().getTime() if option.isDefined() else None
+
+
+def spark_jobs(sc, group):
+    """Jobs Spark ran under a job group, with their stages' durations, tasks and I/O.
+
+    Job and stage ids come from the status tracker, timings and metrics from the status store
+    behind the Spark UI. Stages whose shuffle output was reused are listed as SKIPPED.
+    """
+    # the store is fed by the listener bus, let it catch up with the jobs that just ended
+    sc._jsc.sc().listenerBus().waitUntilEmpty()
+    store = sc._jsc.sc().statusStore()
+    tracker = sc.statusTracker()
+
+    jobs = []
+    for job_id in sorted(tracker.getJobIdsForGroup(group)):
+        job = store.job(job_id)
+        submitted, completed = _millis(job.submissionTime()), _millis(job.completionTime())
+        stages = []
+        for stage_id in sorted(tracker.getJobInfo(job_id).stageIds):
+            try:
+                stage = store.lastStageAttempt(stage_id)
+            except Exception:
+                continue
+            started, ended = _millis(stage.submissionTime()), _millis(stage.completionTime())
+            stages.append({
+                'stage_id': stage_id,
+                'name': stage.name(),
+                'status': stage.status().toString(),
+                'seconds': (ended - started) / 1000 if started and ended else None,
+                'tasks': stage.numTasks(),
+                'executor_run_seconds': stage.executorRunTime() / 1000,
+                'input_bytes': stage.inputBytes(),
+                'output_bytes': stage.outputBytes(),
+                'output_records': stage.outputRecords(),
+                'shuffle_read_bytes': stage.shuffleReadBytes(),
+                'shuffle_write_bytes': stage.shuffleWriteBytes(),
+            })
+        jobs.append({
+            'job_id': job_id,
+            'status': job.status().toString(),
+            'seconds': (completed - submitted) / 1000 if submitted and completed else None,
+            'stages': stages,
+        })
+    return jobs
+
+
+def physical_plan(spark_df):
+    """Formatted physical plan of a Spark frame, as DataFrame.explain prints it."""
+    buffer = io.StringIO()
+    with contextlib.redirect_stdout(buffer):
+        spark_df.explain('formatted')
+    return buffer.getvalue()
+
+
+class RunReport:
+    """Timings and sizes of the stages of one ETL run.
+
+    Each stage (download, flatten, create_dataframe, features, write, ...) is recorded once per
+    chunk with its wall time, rows and bytes. On a local Spark session the stage's actions run
+    in their own job group, so the jobs and stages Spark ran for it are recorded as well.
+    Spark evaluates lazily: the features of a Spark engine are computed by the write's jobs.
+    """
+
+    def __init__(self, spark=None, **run):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.run = dict(run, run_id=self.run_id, started_at=datetime.now().isoformat(timespec='seconds'))
+        self.stages = []
+        self.plans = {}
+        self.chunk = None
+        self._start = time.perf_counter()
+        self.sc = None
+        self.attach(spark)
+
+    def attach(self, spark):
+        """Record Spark jobs of stages from now on; Spark Connect sessions have no status tracker."""
+        try:
+            self.sc = spark.sparkContext if spark is not None else None
+        except Exception:
+            self.sc = None
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        """Time the block as stage name of the current chunk; the block may fill in rows, bytes, ..."""
+        entry = dict({'stage': name, 'chunk': self.chunk, 'rows': None, 'bytes': None}, **fields)
+        group = f'{self.run_id}-{len(self.stages)}'
+        if self.sc is not None:
+            self.sc.setJobGroup(group, f'{name} (chunk {self.chunk})')
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            entry['seconds'] = round(time.perf_counter() - start, 4)
+            if self.sc is not None:
+                self.sc._jsc.clearJobGroup()
+                entry['spark_jobs'] = spark_jobs(self.sc, group)
+                if entry['rows'] is None:
+                    # rows a Spark write stored, the frame itself is never counted
+                    written = sum(stage['output_records'] for job in entry['spark_jobs'] for stage in job['stages'])
+                    entry['rows'] = written or None
+            self.stages.append(entry)
+
+    def record_plan(self, name, spark_df):
+        """Keep the physical plan of a Spark frame, once per name (chunks share their plan)."""
+        if name not in self.plans:
+            self.plans[name] = physical_plan(spark_df)
+
+    def totals(self):
+        """Seconds, rows and bytes per stage summed over chunks, in the order stages first ran."""
+        totals = {}
+        for entry in self.stages:
+            total = totals.setdefault(entry['stage'], {'seconds': 0.0, 'rows': 0, 'bytes': 0, 'chunks': 0, 'spark_jobs': 0})
+            total['seconds'] = round(total['seconds'] + entry['seconds'], 4)
+            total['rows'] += entry['rows'] or 0
+            total['bytes'] += entry['bytes'] or 0
+            total['chunks'] += 1
+            total['spark_jobs'] += len(entry.get('spark_jobs', []))
+            for group, seconds in entry.get('groups', {}).items():
+                groups = total.setdefault('groups', {})
+                groups[group] = round(groups.get(group, 0.0) + seconds, 4)
+        return totals
+
+    def to_dict(self, status):
+        return dict(
+            self.run,
+            status=status,
+            finished_at=datetime.now().isoformat(timespec='seconds'),
+            seconds=round(time.perf_counter() - self._start, 4),
+            totals=self.totals(),
+            stages=self.stages,
+            plans=self.plans,
+        )
+
+    def save(self, status='ok', path=REPORT_PATH, max_runs=MAX_RUNS):
+        """Append the run to the report file, keeping the last max_runs runs."""
+        reports = load_reports(path)[-(max_runs - 1):] if max_runs > 1 else []
+        reports.append(self.to_dict(status))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            for report in reports:
+                f.write(json.dumps(report) + '\n')
+        os.replace(tmp, path)
+        return reports[-1]
+
+    def print_summary(self):
+        for name, total in self.totals().items():
+            print(f"  {name:<17} {total['seconds']:>9.2f}s {total['rows']:>12,} rows {total['bytes'] / 2 ** 20:>10.1f} MB")
+
+
+def load_reports(path=REPORT_PATH):
+    """Runs recorded in the report file, oldest first."""
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,227 @@
+import os
+import glob
+import time
+import shutil
+import signal
+import socket
+import argparse
+import tempfile
+import subprocess
+from importlib import metadata
+from urllib.parse import urlparse
+
+import pyspark
+from pyspark.sql import SparkSession
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Delta jars resolved once by `spark_runtime.py vendor`, so sessions start without Ivy or network
+JARS_DIR = os.path.join(PROJECT_ROOT, 'jars')
+CONNECT_DIR = os.path.join(PROJECT_ROOT, 'data', 'spark_connect')
+CONNECT_URL = 'sc://localhost:15002'
+
+SCALA_VERSION = '2.13'
+
+# settings every session of the ETL runs with, also applied to the Spark Connect server
+SESSION_CONF = {
+    'spark.sql.extensions': 'io.delta.sql.DeltaSparkSessionExtension',
+    'spark.sql.catalog.spark_catalog': 'org.apache.spark.sql.delta.catalog.DeltaCatalog',
+    'spark.sql.session.timeZone': 'UTC',
+    'spark.sql.execution.arrow.pyspark.enabled': 'true',
+    'spark.sql.execution.arrow.pyspark.fallback.enabled': 'false',
+}
+
+# execution profiles by rows of bars: (upper bound, name, driver memory); local mode runs all in the driver
+PROFILES = [
+    (1_000_000, 'small', '1g'),
+    (10_000_000, 'medium', '2g'),
+    (None, 'large', '4g'),
+]
+# rows per shuffle partition, about 64 MB of bars plus indicator columns
+ROWS_PER_PARTITION = 250_000
+# caps output files of very long (intraday) histories
+MAX_RECORDS_PER_FILE = 1_000_000
+TRADING_DAYS_PER_YEAR = 252
+
+# lets Spark Connect clients use DeltaTable (MERGE, OPTIMIZE, ...) on the server
+DELTA_CONNECT_CONF = {
+    'spark.connect.extensions.relation.classes': 'org.apache.spark.sql.connect.delta.DeltaRelationPlugin',
+    'spark.connect.extensions.command.classes': 'org.apache.spark.sql.connect.delta.DeltaCommandPlugin',
+}
+
+
+def delta_packages(connect=False):
+    """Maven coordinates of the Delta jars matching the installed delta-spark."""
+    version = metadata.version('delta-spark')
+    packages = [f'io.delta:delta-spark_{SCALA_VERSION}:{version}']
+    if connect:
+        packages.append(f'io.delta:delta-connect-server_{SCALA_VERSION}:{version}')
+    return packages
+
+
+def _physical_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+
+
+def execution_profile(rows, tickers, cores=None):
+    """Pick Spark settings for a run over rows of bars and tickers.
+
+    Every shuffle is partitioned by Ticker, so there are never more shuffle partitions than
+    tickers; otherwise there is one per ROWS_PER_PARTITION rows and at least one per core.
+    Adaptive execution coalesces whatever ends up smaller than the advisory size.
+    """
+    cores = cores or os.cpu_count() or 1
+    name, driver_memory = next((name, memory) for limit, name, memory in PROFILES if limit is None or rows <= limit)
+    # leave half of the host to Python, which holds the bars as pandas frames
+    driver_memory_mb = min(int(driver_memory[:-1]) * 1024, _physical_memory_mb() // 2)
+    partitions = max(1, min(tickers, max(cores, -(-rows // ROWS_PER_PARTITION))))
+
+    return {
+        'name': name,
+        'rows': rows,
+        'tickers': tickers,
+        'driver_memory': f'{driver_memory_mb}m',
+        'conf': {
+            'spark.sql.shuffle.partitions': str(partitions),
+            'spark.sql.adaptive.enabled': 'true',
+            'spark.sql.adaptive.coalescePartitions.enabled': 'true',
+            'spark.sql.adaptive.coalescePartitions.initialPartitionNum': str(partitions),
+            'spark.sql.adaptive.advisoryPartitionSizeInBytes': '64m',
+            'spark.sql.files.maxRecordsPerFile': str(MAX_RECORDS_PER_FILE),
+        },
+    }
+
+
+def estimated_profile(tickers, years, bars_per_day=1):
+    """Profile for a full run over years of bars, known before any bar is fetched."""
+    return execution_profile(int(tickers * years * TRADING_DAYS_PER_YEAR * bars_per_day), tickers)
+
+
+def log_profile(profile):
+    conf = profile['conf']
+    print(
+        f"Spark profile {profile['name']} for {profile['rows']} rows over {profile['tickers']} tickers: "
+        f"{conf['spark.sql.shuffle.partitions']} shuffle partitions, AQE on, "
+        f"driver memory {profile['driver_memory']}"
+    )
+
+
+def apply_profile(spark, profile):
+    """Set the profile's SQL settings on a running session; driver memory only applies at startup."""
+    for key, value in profile['conf'].items():
+        spark.conf.set(key, value)
+    log_profile(profile)
+
+
+def vendored_jars(jars_dir=JARS_DIR):
+    return sorted(glob.glob(os.path.join(jars_dir, '*.jar')))
+
+
+def with_delta(builder, offline=False):
+    """Put Delta on the session's classpath, from the vendored jars when they are there.
+
+    Without vendored jars this falls back to resolving the packages through Ivy, which needs
+    network on a cold cache; offline refuses to do that.
+    """
+    jars = vendored_jars()
+    if jars:
+        return builder.config('spark.jars', ','.join(jars))
+    if offline:
+        raise SystemExit(f'No vendored Delta jars in {JARS_DIR}, run `python batch_jobs/spark_runtime.py vendor` on a host with network')
+    return builder.config('spark.jars.packages', ','.join(delta_packages()))
+
+
+def vendor(jars_dir=JARS_DIR):
+    """Resolve the Delta packages and their dependencies through Ivy once and copy the jars to jars_dir."""
+    with tempfile.TemporaryDirectory() as ivy_dir:
+        spark = SparkSession.builder \
+            .master('local[1]') \
+            .config('spark.jars.packages', ','.join(delta_packages(connect=True))) \
+            .config('spark.jars.ivy', ivy_dir) \
+            .getOrCreate()
+        spark.stop()
+
+        os.makedirs(jars_dir, exist_ok=True)
+        for jar in glob.glob(os.path.join(ivy_dir, 'jars', '*.jar')):
+            shutil.copy2(jar, jars_dir)
+
+    return vendored_jars(jars_dir)
+
+
+def _port_open(host, port):
+    with socket.socket() as sock:
+        sock.settimeout(0.5)
+        return sock.connect_ex((host, port)) == 0
+
+
+def start_connect_server(url=CONNECT_URL, timeout=120):
+    """Start a long-lived local Spark Connect server with the ETL's session settings and Delta."""
+    address = urlparse(url.replace('sc://', 'http://'))
+    if _port_open(address.hostname, address.port):
+        print(f'Spark Connect server already listening on {url}')
+        return
+
+    command = [
+        os.path.join(os.path.dirname(pyspark.__file__), 'bin', 'spark-submit'),
+        '--class', 'org.apache.spark.sql.connect.service.SparkConnectServer',
+        '--name', 'StockETL Connect',
+        '--conf', f'spark.connect.grpc.binding.port={address.port}',
+    ]
+    conf = {**SESSION_CONF, **DELTA_CONNECT_CONF}
+    jars = vendored_jars()
+    if jars:
+        conf['spark.jars'] = ','.join(jars)
+    else:
+        conf['spark.jars.packages'] = ','.join(delta_packages(connect=True))
+    for key, value in conf.items():
+        command += ['--conf', f'{key}={value}']
+    command.append('spark-internal')
+
+    os.makedirs(CONNECT_DIR, exist_ok=True)
+    with open(os.path.join(CONNECT_DIR, 'server.log'), 'a') as log:
+        # own session, so the server outlives this process and the terminal it came from
+        process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    with open(os.path.join(CONNECT_DIR, 'server.pid'), 'w') as f:
+        f.write(str(process.pid))
+
+    deadline = time.monotonic() + timeout
+    while not _port_open(address.hostname, address.port):
+        if process.poll() is not None or time.monotonic() > deadline:
+            raise SystemExit(f'Spark Connect server did not start, see {CONNECT_DIR}/server.log')
+        time.sleep(1)
+    print(f'Spark Connect server listening on {url}, attach with --spark-remote {url}')
+
+
+def stop_connect_server():
+    pid_file = os.path.join(CONNECT_DIR, 'server.pid')
+    if not os.path.exists(pid_file):
+        print('No Spark Connect server started from here')
+        return
+    with open(pid_file, 'r') as f:
+        pid = int(f.read())
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+    os.remove(pid_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prepare the Spark runtime of the ETL.')
+    subcommands = parser.add_subparsers(dest='command', required=True)
+    subcommands.add_parser('vendor', help=f'download the Delta jars once into {JARS_DIR} for offline runs')
+    start = subcommands.add_parser('start-connect', help='start a local Spark Connect server for stock_etl.py --spark-remote')
+    start.add_argument('--url', default=CONNECT_URL)
+    subcommands.add_parser('stop-connect', help='stop the Spark Connect server started by start-connect')
+    args = parser.parse_args()
+
+    if args.command == 'vendor':
+        jars = vendor()
+        print(f'Vendored {len(jars)} jars into {JARS_DIR}')
+    elif args.command == 'start-connect':
+        start_connect_server(args.url)
+    else:
+        stop_connect_server()
+
+
+if __name__ == '__main__':
+    main()
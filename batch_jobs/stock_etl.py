@@ -1,136 +1,919 @@
 import findspark
 import os
+import builtins
+import shutil
+import argparse
 from pyspark.sql import SparkSession
+# shadows min, max and round, plain Python ones are called as builtins.min etc.
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
-import yfinance as yf
+import functools
 import pandas as pd
-from delta import configure_spark_with_delta_pip
 from datetime import datetime, timedelta
 from pyspark.sql import Window
 
+from providers import BAR_COLUMNS, INTERVALS, INTRADAY_LOOKBACK_DAYS, get_provider, synthetic_tickers
+import ingest_ledger
+import features_pandas
+import rolling
+import indicator_state
+import delta_sink
+import publish
+import spark_runtime
+import storage
+import universe
+import run_report
+import gold_tables
+
 findspark.init()
 findspark.find()
 
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 DATA_FILEPATH = os.path.join(PROJECT_ROOT, 'data')
+OUTPUT_PATH = os.path.join(DATA_FILEPATH, "stock_data_delta.parquet")
+LANDING_PATH = os.path.join(DATA_FILEPATH, 'landing', 'bars.parquet')
+
+# years of history pulled on a full run
+HISTORY_YEARS = 3
+
+# tickers fetched, computed and written together; a run holds one chunk of bars in memory at a time
+CHUNK_SIZE = 500
+# bars a chunk may hold, which caps the tickers per chunk of intraday runs
+CHUNK_ROWS = 2_000_000
 
-tickers = [
-    "AAPL", "MSFT", "NVDA", "GOOGL", "AMZN", "META", "AVGO", "BRK-B", "TSLA", "TSM",
-    "JPM", "WMT", "LLY", "ORCL", "V", "MA", "NFLX", "XOM", "COST", "JNJ",
-    "ABBV", "SAP", "BABA", "GS", "HD", "VRTX", "UNH", "MRK", "PEP", "TMO"
+BARS_SCHEMA = StructType([
+    StructField('Ticker', StringType()),
+    StructField('Date', TimestampType()),
+    StructField('Open', DoubleType()),
+    StructField('High', DoubleType()),
+    StructField('Low', DoubleType()),
+    StructField('Close', DoubleType()),
+    StructField('Volume', LongType()),
+])
+
+# indicator columns appended after the bars by add_features
+FEATURE_FIELDS = [
+    StructField(name, DoubleType()) for name in features_pandas.OUTPUT_COLUMNS if name not in BARS_SCHEMA.fieldNames()
 ]
+RANGE_FIELDS = [field for field in FEATURE_FIELDS if field.name in features_pandas.RANGE_COLUMNS]
+
+# rows of stored history needed in front of new daily bars so every window is complete: the 52 week
+# range looks back range_rows() - 1 rows, which also covers MA_200, MA_26 -> Signal_line and the 7 day lag
+WARMUP_ROWS = features_pandas.range_rows() - 1
+
+# Parquet row-group size of the Spark writer, roughly storage.ROW_GROUP_ROWS rows of stored features
+ROW_GROUP_BYTES = 3 * 1024 * 1024
+# Parquet v2 pages delta-encode the integer columns, as storage.write_parquet does
+PARQUET_OPTIONS = {
+    'parquet.writer.version': 'PARQUET_2_0',
+    'parquet.enable.dictionary': 'false',
+    'parquet.block.size': ROW_GROUP_BYTES,
+}
+
+# stored columns the indicator state is rebuilt from
+STATE_COLUMNS = ['Ticker', 'Date', 'High', 'Low', 'Close', 'MACD']
+
+# relative change of a refetched Close that marks a ticker's stored history as adjusted since it
+# was stored; yfinance serves split- and dividend-adjusted bars, a dividend moves them by 1e-4 or more
+ADJUSTMENT_TOLERANCE = 1e-6
+
+
+def interval_output_path(interval):
+    """Output of a bar interval: the daily features, or an intraday dataset next to them."""
+    if interval == '1d':
+        return OUTPUT_PATH
+    return os.path.join(DATA_FILEPATH, f'stock_bars_{interval}.parquet')
+
+
+def warmup_rows(interval='1d'):
+    """Rows of history in front of new bars that complete every window of the interval.
+
+    Intraday bars have no 52 week range, their longest windows are MA_200 and the 7 session momentum lag.
+    """
+    if interval == '1d':
+        return WARMUP_ROWS
+    return builtins.max(builtins.max(features_pandas.MA_WINDOWS) - 1, features_pandas.momentum_rows(interval))
+
+
+def load_history(output_path, tickers=None, interval='1d'):
+    """Read the raw bars of a previous run, only those of tickers if given, or None when there is no output yet.
+
+    Intraday history is only read from the last trading days holding the warm-up rows; twice
+    the sessions the windows span, so sessions missing up to half their bars are still covered.
+    """
+    if not os.path.exists(output_path):
+        return None
+
+    filters = [('Ticker', 'in', list(tickers))] if tickers is not None else []
+    if interval != '1d':
+        sessions = 2 * -(-warmup_rows(interval) // features_pandas.BARS_PER_DAY[interval])
+        days = storage.stored_days(output_path, tickers or storage.stored_tickers(output_path))
+        if days:
+            filters.append(('Day', '>=', builtins.min(stored[-sessions:][0] for stored in days.values() if stored)))
+
+    history = storage.read_parquet(output_path, columns=BAR_COLUMNS, filters=filters or None)
+    # partition values come back as a categorical of every stored ticker, not only the ones read
+    history['Ticker'] = history['Ticker'].astype(str)
+    if interval == '1d':
+        # older runs stored dates shifted by the local UTC offset, snap them back to the trading day
+        history['Date'] = history['Date'].dt.round('D')
+        # daily history is read in full, its first close is the one Cumulative_Return is anchored to
+        first_close = history.sort_values('Date', kind='stable').groupby('Ticker')['Close'].first()
+    else:
+        first_close = storage.first_close(output_path, history['Ticker'].unique())
+    history['First_Close'] = history['Ticker'].map(first_close)
+    return history
+
+
+def fetch_bars(provider, ledger, tickers, start_date, end_date, report=None, refresh=False):
+    """Fetch bars through the provider and record each ticker's outcome in the ledger.
+
+    refresh bypasses the provider's cache, see MarketDataProvider.refetch.
+    """
+    report = report or run_report.RunReport()
+    with report.stage('download', tickers=len(tickers)) as stage:
+        if refresh:
+            bars = provider.refetch(tickers, start_date, end_date)
+        else:
+            bars = provider.fetch(tickers, start_date, end_date)
+        if bars is not None:
+            stage['rows'], stage['bytes'] = len(bars), run_report.frame_bytes(bars)
+    ingest_ledger.record_fetch(ledger, tickers, bars, provider.failed, start_date, end_date)
+    if bars is None:
+        return None
+
+    with report.stage('flatten') as stage:
+        # a ticker with no data comes back as NaN rows, never store those
+        bars = bars.dropna(subset=['Close'])
+        # NaN padding turns Volume into floats, keep it int64 like the stored output
+        bars = bars.astype({'Volume': 'int64'})
+        stage['rows'], stage['bytes'] = len(bars), run_report.frame_bytes(bars)
+    return bars
+
+
+def check_bars(history):
+    """Stored bar of each ticker that its next fetch gets again: the first bar of its last stored day.
+
+    Daily history has one bar a day. An intraday session may have been stored while its last bar
+    was still forming, its first bar was complete.
+    """
+    last_day = history.groupby('Ticker')['Date'].transform('max').dt.normalize()
+    checks = history[history['Date'] >= last_day].sort_values('Date', kind='stable').groupby('Ticker').head(1)
+    return checks[['Ticker', 'Date', 'Close']]
+
+
+def restated_tickers(checks, bars):
+    """Tickers whose refetched bars differ from the stored check bars: the provider adjusted their history since."""
+    if checks is None or bars is None:
+        return []
+    both = checks.astype({'Ticker': str}).merge(
+        bars[['Ticker', 'Date', 'Close']].astype({'Ticker': str}), on=['Ticker', 'Date'], suffixes=('_stored', '')
+    )
+    changed = (both['Close'] / both['Close_stored'] - 1).abs() > ADJUSTMENT_TOLERANCE
+    return sorted(both.loc[changed, 'Ticker'].unique())
+
+
+def fetch_new_bars(last_dates, tickers, start_date, end_date, provider, ledger, interval='1d', report=None, checks=None):
+    """Fetch the days from each ticker's last stored date on, plus full history for tickers new to the universe.
+
+    Known tickers are fetched in one group per last stored day, so the download grows with the
+    new days only. The last stored day is fetched again, bypassing the provider's cache: when its bars differ
+    from checks (see check_bars), the provider has adjusted the ticker's history for a split or
+    dividend since it was stored, and new bars cannot be appended to it. Such restated tickers
+    are forgotten by the provider and fetched in full like new ones. Intraday sessions stored
+    while still trading are fetched again the same way. Returns the bars after each ticker's
+    last stored date, the full history of new and restated tickers, and the restated tickers.
+    """
+    known = [ticker for ticker in tickers if ticker in last_dates.index]
+    unknown = [ticker for ticker in tickers if ticker not in last_dates.index]
+
+    frames = []
+    restated = []
+    # tickers sharing a last stored day share a fetch, one lagging ticker does not widen the others' window
+    fetch_starts = last_dates[known].dt.normalize().dt.strftime("%Y-%m-%d")
+    for fetch_start, group in fetch_starts.groupby(fetch_starts, sort=True):
+        if fetch_start >= end_date:
+            continue
+        bars = fetch_bars(provider, ledger, list(group.index), fetch_start, end_date, report, refresh=True)
+        group_restated = restated_tickers(checks, bars)
+        if group_restated:
+            bars = bars[~bars['Ticker'].astype(str).isin(group_restated)]
+            restated += group_restated
+        frames.append(bars)
+    if restated:
+        print(f'{len(restated)} tickers were adjusted since they were stored, refetching their history: {restated}')
+        provider.forget(restated)
+        unknown += restated
+    if unknown:
+        frames.append(fetch_bars(provider, ledger, unknown, start_date, end_date, report))
+
+    frames = [frame for frame in frames if frame is not None]
+    if not frames:
+        return None, restated
+
+    new_df = pd.concat(frames, ignore_index=True)
+    # the last stored day is fetched again, keep only the bars after it
+    stored_until = last_dates.drop(restated)
+    is_new = new_df['Date'] > new_df['Ticker'].astype(str).map(stored_until).fillna(pd.Timestamp.min)
+    return new_df[is_new], restated
+
+
+def build_incremental_input(history, new_df, interval='1d', peaks=None):
+    """Stack the warm-up tail of each ticker's history in front of its new bars.
+
+    Returns the combined bars and a per-ticker seed frame carrying the first close
+    and peak close of the full stored history, which the warm-up rows alone cannot give.
+    peaks overrides the peak close of history that only holds the warm-up (intraday).
+    """
+    touched = history[history['Ticker'].isin(new_df['Ticker'].unique())]
+
+    warmup = touched.sort_values(['Ticker', 'Date']).groupby('Ticker').tail(warmup_rows(interval))
+    warmup = warmup[BAR_COLUMNS].assign(Is_new=False)
+
+    new_rows = new_df[BAR_COLUMNS].assign(Is_new=True)
+    # no warm-up when every touched ticker is new to the universe
+    combined = pd.concat([warmup, new_rows], ignore_index=True) if not warmup.empty else new_rows
+
+    seed = touched.groupby('Ticker').agg(
+        Seed_first_close=('First_Close', 'first'),
+        Seed_peak_close=('Close', 'max'),
+    ).reset_index()
+    if peaks is not None:
+        seed['Seed_peak_close'] = seed['Ticker'].map(peaks).fillna(seed['Seed_peak_close'])
+
+    return combined, seed
+
+
+def create_spark_session(remote=None, offline=False, profile=None):
+    """Start a local Spark session, or attach to the Spark Connect server at remote.
+
+    Attaching skips JVM startup and jar resolution entirely; see spark_runtime.py start-connect.
+    profile (see spark_runtime.execution_profile) sizes the local driver and shuffles.
+    """
+    if remote:
+        spark = SparkSession.builder.remote(remote).config('spark.sql.session.timeZone', 'UTC').getOrCreate()
+        # python workers need the NumPy kernels for the fused engine and the 52 week range
+        add_worker_modules(spark, [features_pandas, rolling], remote=True)
+        return spark
+
+    builder = SparkSession.builder \
+        .appName("StockETL") \
+        .master("local[*]")
+    for key, value in spark_runtime.SESSION_CONF.items():
+        builder = builder.config(key, value)
+    if profile is not None:
+        builder = builder.config('spark.driver.memory', profile['driver_memory'])
+        for key, value in profile['conf'].items():
+            builder = builder.config(key, value)
+        spark_runtime.log_profile(profile)
+
+    spark = spark_runtime.with_delta(builder, offline).getOrCreate()
+    add_worker_modules(spark, [features_pandas, rolling])
+    return spark
+
+
+def add_worker_modules(spark, modules, remote=False):
+    """Ship modules to the session's python workers, as artifacts when attached to Spark Connect."""
+    for module in modules:
+        if remote:
+            spark.addArtifacts(module.__file__, pyfile=True)
+        else:
+            spark.sparkContext.addPyFile(module.__file__)
+
+
+def write_landing(bars, path):
+    """Write a pandas frame of bars to a Parquet file for Spark to scan with a declared schema."""
+    # microsecond UTC timestamps are what Spark reads back as TimestampType
+    landing = bars.assign(Date=bars['Date'].dt.tz_localize('UTC'))
+    landing.to_parquet(path, index=False, coerce_timestamps='us', allow_truncated_timestamps=True)
+
+
+def to_spark(spark, bars, handoff='arrow'):
+    """Hand a pandas frame of bars (plus an optional Is_new flag) over to Spark with the declared schema.
+
+    arrow ships the frame as Arrow record batches; Arrow fallback is disabled on the session so
+    this can never silently turn into row-by-row conversion. landing writes the frame to a
+    Parquet file that Spark then scans natively.
+    """
+    schema = BARS_SCHEMA
+    if 'Is_new' in bars.columns:
+        schema = StructType(BARS_SCHEMA.fields + [StructField('Is_new', BooleanType())])
+    bars = bars[schema.fieldNames()]
+
+    if handoff == 'arrow':
+        return spark.createDataFrame(bars, schema=schema)
+
+    os.makedirs(os.path.dirname(LANDING_PATH), exist_ok=True)
+    write_landing(bars, LANDING_PATH)
+    return spark.read.schema(schema).parquet(LANDING_PATH)
+
+
+def add_features(spark_df, seed_df=None, interval='1d'):
+    """Compute the indicator columns per ticker.
+
+    seed_df optionally carries Seed_first_close and Seed_peak_close per ticker, so that
+    Cumulative_Return and DrawDown stay anchored to history that is not part of spark_df.
+    Windows count bars of the interval, momentum spans 7 sessions (see features_pandas.BARS_PER_DAY),
+    and the 52 week range is left null on intraday bars.
+    """
+    ## Feature engineering
+    # set windows
+    window_spec = Window.partitionBy('Ticker').orderBy('Date')
+    ma_window_12 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-11, 0)
+    ma_window_26 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-25, 0)
+    ma_window_50 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-49, 0)
+    ma_window_200 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-199, 0)
+    window_cum = Window.partitionBy("Ticker").orderBy("Date").rowsBetween(Window.unboundedPreceding, 0)
+    signal_window = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-8, 0)
+
+    # the 52 week range would be a sliding max/min over a year of rows, which Spark recomputes
+    # for every row; one O(n) pass per ticker with the NumPy kernels instead
+    if interval == '1d':
+        spark_df = spark_df.groupBy('Ticker').applyInPandas(
+            features_pandas.add_range_group,
+            schema=StructType(spark_df.schema.fields + RANGE_FIELDS),
+        )
+    else:
+        # intraday bars only go back weeks, they have no 52 week range
+        for field in RANGE_FIELDS:
+            spark_df = spark_df.withColumn(field.name, lit(None).cast('double'))
+
+    if seed_df is None:
+        spark_df = spark_df.withColumn('Seed_first_close', lit(None).cast('double')) \
+            .withColumn('Seed_peak_close', lit(None).cast('double'))
+    else:
+        spark_df = spark_df.join(seed_df, on='Ticker', how='left')
+
+    # compute daily return
+    spark_df = spark_df.withColumn('Prev_close', lag('Close').over(window_spec))
+
+    spark_df = spark_df.withColumn(
+        'Daily_return',
+        round(((col('Close') - col('Prev_close')) / col('Prev_close') * 100), 2)
+    )
+
+    # calculate daily volutility rate
+    spark_df = spark_df.withColumn(
+        'Volatility',
+        round(((col('High') - col('Low')) / col('Low') * 100), 2)
+    )
+
+    # compute moving averages
+    spark_df = spark_df.withColumn(
+        'MA_12',
+        round(avg('Close').over(ma_window_12), 2)
+    ).withColumn(
+        'MA_26',
+        round(avg('Close').over(ma_window_26), 2)
+    ).withColumn(
+        'MA_50',
+        round(avg('Close').over(ma_window_50), 2)
+    ).withColumn(
+        'MA_200',
+        round(avg('Close').over(ma_window_200), 2)
+    )
+
+    spark_df = spark_df.withColumn(
+        "First_Close",
+        coalesce(col('Seed_first_close'), first("Close").over(window_cum))
+    )
+    spark_df = spark_df.withColumn("Cumulative_Return", round(((col("Close") - col("First_Close")) / col("First_Close")) * 100, 2))
+
+    # compute 7 day momentum
+    spark_df = spark_df.withColumn("Close_7_Days_Ago", lag("Close", features_pandas.momentum_rows(interval)).over(window_spec))
+    spark_df = spark_df.withColumn(
+        "Momentum_7d",
+        round(((col("Close") - col("Close_7_Days_Ago")) / col("Close_7_Days_Ago")) * 100, 2)
+    )
+
+    # compute MACD and signal lines
+    spark_df = spark_df.withColumn(
+        'MACD',
+        col('MA_12') - col('MA_26')
+    )
+
+    spark_df = spark_df.withColumn(
+        'Signal_line',
+        round(avg(col('MACD')).over(signal_window), 2)
+    )
+
+    # compute draw down
+    # measure draw from peak close price
+    peak_close = greatest(col('Seed_peak_close'), max(col('Close')).over(window_cum))
+
+    spark_df = spark_df.withColumn(
+        'DrawDown',
+        round(((col('Close') - peak_close) / peak_close * 100), 2)
+    )
+
+    # range columns last, as in features_pandas.OUTPUT_COLUMNS
+    columns = [name for name in spark_df.columns if name not in features_pandas.RANGE_COLUMNS + ['Seed_first_close', 'Seed_peak_close']]
+    return spark_df.select(*columns, *features_pandas.RANGE_COLUMNS)
+
+
+def add_features_fused(spark_df, seed_df=None, interval='1d'):
+    """Same columns as add_features, computed in one pass per partition.
+
+    Rows are shuffled by Ticker once, so every partition holds whole tickers, and each partition
+    is processed by the NumPy kernels of the pandas engine instead of a chain of window operators.
+    """
+    if seed_df is None:
+        spark_df = spark_df.withColumn('Seed_first_close', lit(None).cast('double')) \
+            .withColumn('Seed_peak_close', lit(None).cast('double'))
+    else:
+        spark_df = spark_df.join(seed_df, on='Ticker', how='left')
+
+    input_fields = [field for field in spark_df.schema.fields if not field.name.startswith('Seed_')]
+    schema = StructType(input_fields + FEATURE_FIELDS)
+
+    compute = functools.partial(features_pandas.add_features_partition, interval=interval)
+    return spark_df.repartition('Ticker').mapInPandas(compute, schema=schema)
+
+
+def compute_features(spark, bars, seed=None, handoff='arrow', fused=False, interval='1d', report=None):
+    """Run the feature section on Spark, or on the pandas engine when spark is None.
+
+    The pandas engine reports the time of each indicator group. Spark features are only planned
+    here; their plan is reported and they are computed by the jobs of the write.
+    """
+    report = report or run_report.RunReport()
+    if spark is None:
+        with report.stage('features', engine='pandas', groups={}) as stage:
+            features = features_pandas.add_features(bars, seed, interval, stage['groups'])
+            stage['rows'], stage['bytes'] = len(features), run_report.frame_bytes(features)
+        return features
+
+    # size shuffles for the bars actually fetched
+    spark_runtime.apply_profile(spark, spark_runtime.execution_profile(len(bars), bars['Ticker'].nunique()))
+
+    # store data in spark dataframe
+    with report.stage('create_dataframe', handoff=handoff) as stage:
+        spark_df = to_spark(spark, bars, handoff)
+        seed_df = None
+        if seed is not None:
+            # explicit schema, seed is empty when every touched ticker is new to the universe
+            seed_df = spark.createDataFrame(seed, schema='Ticker string, Seed_first_close double, Seed_peak_close double')
+        stage['rows'], stage['bytes'] = len(bars), run_report.frame_bytes(bars)
+
+    with report.stage('features', engine='fused' if fused else 'spark'):
+        if fused:
+            features = add_features_fused(spark_df, seed_df, interval)
+        else:
+            features = add_features(spark_df, seed_df, interval)
+    report.record_plan('features', features)
+    return features
+
+
+def open_output(mode, sink='parquet', path=None):
+    """Where a run writes its chunks: a staged version of the Parquet output, or the Delta table itself.
+
+    An append stages a version carrying over the published files, so readers keep seeing the
+    previous version until close_output publishes every chunk at once.
+    """
+    path = path or OUTPUT_PATH
+    if sink == 'delta':
+        return path
+    return publish.stage(path, carry_over=mode == 'append')
+
+
+def close_output(target, sink='parquet', written=True, path=None):
+    """Publish the staged version, or drop it when no chunk wrote anything."""
+    if sink == 'delta':
+        return
+    if written:
+        publish.publish(path or OUTPUT_PATH, target)
+    else:
+        shutil.rmtree(target)
+
+
+def drop_tickers(target, tickers, sink='parquet'):
+    """Remove every stored row of tickers from the staged version or the Delta table, before they are rewritten."""
+    if sink == 'delta':
+        delta_sink.delete_tickers(target, tickers)
+    else:
+        publish.unlink_tickers(target, tickers)
+
+
+def write_features(features, target, mode, sink='parquet', interval='1d', report=None):
+    """Write features to target partitioned by Ticker and sorted by Date, the same layout from either engine.
+
+    Parquet chunks are added to the staged version target (see open_output). With the delta sink,
+    overwrite replaces the table, append adds rows no other chunk holds (those of a full run) and
+    merge upserts on (Ticker, Date). Intraday bars also store the exchange's trading Day.
+    """
+    report = report or run_report.RunReport()
+    with report.stage('write', sink=sink) as stage:
+        before = run_report.dir_bytes(target)
+        _write_features(features, target, mode, sink, interval, report)
+        stage['bytes'] = run_report.dir_bytes(target) - before
+        if isinstance(features, pd.DataFrame):
+            stage['rows'] = len(features)
+
+
+def compact_columns(features):
+    """Spark features in the stored schema, as storage.compact does for Arrow tables."""
+    features = features.drop(*storage.SCRATCH_COLUMNS)
+    return features.withColumns({
+        name: round(col(name) * storage.SCALE).cast('int') for name in storage.SCALED_COLUMNS
+    })
+
+
+def _write_features(features, target, mode, sink, interval, report):
+    if not isinstance(features, pd.DataFrame):
+        features = compact_columns(features)
+    if sink == 'delta':
+        if isinstance(features, pd.DataFrame):
+            delta_sink.write_pandas(features, target, mode)
+        else:
+            delta_sink.write_spark(features, target, mode)
+        return
+
+    if isinstance(features, pd.DataFrame):
+        storage.write_parquet(features, target, 'append', interval)
+    else:
+        options = dict(PARQUET_OPTIONS)
+        if interval != '1d':
+            day = date_format(from_utc_timestamp(col('Date'), storage.EXCHANGE_TZ), 'yyyy-MM-dd')
+            features = features.withColumn(storage.DAY_COLUMN, day)
+            # as storage.write_parquet does, a run per session
+            options[f'parquet.enable.dictionary#{storage.DAY_COLUMN}'] = 'true'
+        # timestamp_ntz is stored as INT64 micros with min/max statistics, unlike the default INT96
+        features = features.withColumn('Date', col('Date').cast('timestamp_ntz')) \
+            .repartition('Ticker') \
+            .sortWithinPartitions('Ticker', 'Date')
+        report.record_plan('write', features)
+        features.write.format('parquet') \
+            .partitionBy('Ticker') \
+            .options(**options) \
+            .mode('append') \
+            .save(target)
+
+
+def run_full(spark, args, tickers, start_date, end_date, provider, ledger, report=None):
+    report = report or run_report.RunReport(spark)
+    path = interval_output_path(args.interval)
+    target = open_output('overwrite', args.sink, path)
+    # the first chunk replaces a Delta table, later ones hold other tickers and are added without a MERGE
+    mode = 'overwrite'
+    chunks = list(universe.chunked(tickers, args.chunk_size))
+    for number, chunk in enumerate(chunks, 1):
+        report.chunk = number
+        flat_df = fetch_bars(provider, ledger, chunk, start_date, end_date, report)
+        if flat_df is None or flat_df.empty:
+            print(f'Chunk {number}/{len(chunks)}: no bars for {len(chunk)} tickers')
+            continue
+
+        features = compute_features(
+            spark, flat_df, handoff=args.handoff, fused=args.engine == 'fused', interval=args.interval, report=report
+        )
+        write_features(features, target, mode, args.sink, args.interval, report)
+        mode = 'append'
+        print(f'Chunk {number}/{len(chunks)}: wrote {len(flat_df)} rows for {flat_df["Ticker"].nunique()} tickers')
+
+    close_output(target, args.sink, written=mode == 'append', path=path)
+    if mode == 'overwrite':
+        raise SystemExit(f'No bars available for {start_date} -> {end_date}')
+
+
+def run_incremental(spark, args, tickers, start_date, end_date, provider, ledger, report=None):
+    """Append the bars after each ticker's stored history; returns the tickers rewritten in full as restated."""
+    report = report or run_report.RunReport(spark)
+    path = interval_output_path(args.interval)
+    target = open_output('append', args.sink, path)
+    appended = 0
+    all_restated = []
+    chunks = list(universe.chunked(tickers, args.chunk_size))
+    for number, chunk in enumerate(chunks, 1):
+        report.chunk = number
+        with report.stage('load_history') as stage:
+            history = load_history(target, chunk, args.interval)
+            stage['rows'], stage['bytes'] = len(history), run_report.frame_bytes(history)
+        last_dates = history.groupby('Ticker')['Date'].max()
+        new_df, restated = fetch_new_bars(
+            last_dates, chunk, start_date, end_date, provider, ledger, args.interval, report, check_bars(history)
+        )
+        if restated:
+            # their stored history no longer matches the provider's, it is rewritten from the full refetch
+            drop_tickers(target, restated, args.sink)
+            history = history[~history['Ticker'].isin(restated)]
+            all_restated += restated
+        if new_df is None or new_df.empty:
+            continue
+
+        # intraday history only holds the warm-up, the peak close is scanned from the whole output
+        peaks = storage.peak_close(target, chunk) if args.interval != '1d' else None
+        combined, seed = build_incremental_input(history, new_df, args.interval, peaks)
+        features = compute_features(
+            spark, combined, seed, args.handoff, fused=args.engine == 'fused', interval=args.interval, report=report
+        )
+
+        # warm-up rows are already stored, only append the new days
+        if isinstance(features, pd.DataFrame):
+            features = features[features['Is_new']].drop(columns='Is_new')
+        else:
+            features = features.filter(col('Is_new')).drop('Is_new')
+        write_features(features, target, 'merge', args.sink, args.interval, report)
+        appended += len(new_df)
+        print(f'Chunk {number}/{len(chunks)}: appended {len(new_df)} new rows for {new_df["Ticker"].nunique()} tickers')
+
+    close_output(target, args.sink, written=appended > 0 or bool(all_restated), path=path)
+    if not appended:
+        print('No new bars to ingest, output is up to date')
+    return all_restated
+
+
+def run_incremental_from_state(state, tickers, start_date, end_date, provider, ledger, sink='parquet', chunk_size=CHUNK_SIZE, report=None):
+    """Incremental run that extends each ticker from its persisted indicator state.
+
+    Neither the stored output nor Spark is touched: known tickers are updated bar by bar from
+    the state and tickers new to the universe are computed in full by the pandas engine, as are
+    restated ones (see fetch_new_bars) once their stored rows are dropped. Returns the updated
+    state and the restated tickers.
+    """
+    report = report or run_report.RunReport()
+    target = open_output('append', sink)
+    appended = 0
+    all_restated = []
+    for number, chunk in enumerate(universe.chunked(tickers, chunk_size), 1):
+        report.chunk = number
+        new_df, restated = fetch_new_bars(
+            state.last_dates(), chunk, start_date, end_date, provider, ledger, report=report, checks=state.last_bars()
+        )
+        if restated:
+            drop_tickers(target, restated, sink)
+            state = state.drop(restated)
+            all_restated += restated
+        if new_df is None or new_df.empty:
+            continue
+
+        with report.stage('features', engine='state', groups={}) as stage:
+            is_known = new_df['Ticker'].astype(str).isin(state.index)
+            parts = []
+            if is_known.any():
+                parts.append(state.update(new_df[is_known]))
+            if not is_known.all():
+                fresh = features_pandas.add_features(new_df[~is_known], timings=stage['groups'])
+                state = state.merge(indicator_state.build_state(fresh))
+                parts.append(fresh)
+            features = pd.concat(parts, ignore_index=True)
+            stage['rows'], stage['bytes'] = len(features), run_report.frame_bytes(features)
+
+        write_features(features, target, 'merge', sink, report=report)
+        appended += len(new_df)
+
+    close_output(target, sink, written=appended > 0 or bool(all_restated))
+    if appended:
+        print(f'Appended {appended} new rows')
+    else:
+        print('No new bars to ingest, output is up to date')
+    return state, all_restated
+
+
+def rebuild_state(chunk_size=CHUNK_SIZE, report=None):
+    """Rebuild the indicator state from the stored output, reading chunk_size tickers at a time."""
+    report = report or run_report.RunReport()
+    state = None
+    for number, chunk in enumerate(universe.chunked(storage.stored_tickers(OUTPUT_PATH), chunk_size), 1):
+        report.chunk = number
+        with report.stage('rebuild_state') as stage:
+            features = storage.read_parquet(OUTPUT_PATH, columns=STATE_COLUMNS, filters=[('Ticker', 'in', chunk)])
+            features['Date'] = features['Date'].dt.round('D')
+            chunk_state = indicator_state.build_state(features)
+            state = chunk_state if state is None else state.merge(chunk_state)
+            stage['rows'] = len(features)
+    return state
+
+
+def state_matches(state, output_path):
+    """Whether the state holds exactly the stored tickers, each up to its last stored Date."""
+    # older runs stored dates shifted by the local UTC offset, as in load_history
+    stored = storage.last_dates(output_path).dt.round('D')
+    return state.last_dates().sort_index().equals(stored)
+
+
+def write_gold_tables(output_path, state, appended, chunk_size=CHUNK_SIZE, report=None, restated=()):
+    """Rewrite the dashboard's per-ticker summary and weekly/monthly rollups from the stored daily output.
+
+    With appended, the output only gained bars since the last run and the rollups recompute their
+    latest periods onwards; otherwise they are rebuilt from the whole history. The history of
+    restated tickers was rewritten, their periods are all recomputed.
+    """
+    report = report or run_report.RunReport()
+    report.chunk = None
+    with report.stage('summary') as stage:
+        summary = gold_tables.build_summary(output_path, state.last_dates(), chunk_size)
+        gold_tables.write_summary(summary)
+        stage['rows'] = len(summary)
+
+    for name, frequency in gold_tables.ROLLUP_FREQUENCIES.items():
+        with report.stage(f'rollup_{name}') as stage:
+            previous = None
+            if appended and os.path.exists(gold_tables.ROLLUP_PATHS[name]):
+                previous = gold_tables.load_rollup(name)
+                previous = previous[~previous['Ticker'].isin(restated)]
+            bars = gold_tables.build_rollup(output_path, frequency, chunk_size, previous)
+            gold_tables.write_rollup(bars, name)
+            stage['rows'] = len(bars)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download stock prices and compute indicators.')
+    parser.add_argument(
+        '--mode', choices=['full', 'incremental'], default='full',
+        help='full refetches the whole history, incremental only appends days missing from the output'
+    )
+    parser.add_argument(
+        '--provider', choices=['yfinance', 'replay', 'local', 'synthetic'], default='yfinance',
+        help='where bars come from; replay serves only the raw bar cache and never touches the network'
+    )
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='always download from yfinance instead of going through the raw bar cache'
+    )
+    parser.add_argument('--data-dir', help='directory of <TICKER>.csv/.parquet files for the local provider')
+    parser.add_argument(
+        '--universe', default=universe.DEFAULT_UNIVERSE,
+        help='tickers to process: a file in universes/ or the path of a .txt (one symbol per line) '
+             'or .csv (Symbol column) list, e.g. an S&P 500 or Russell 3000 constituents export'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int,
+        help=f'tickers fetched, computed and written at a time; bounds memory for large universes '
+             f'(default {CHUNK_SIZE}, fewer for intraday so a chunk holds at most {CHUNK_ROWS} bars)'
+    )
+    parser.add_argument(
+        '--interval', choices=INTERVALS, default='1d',
+        help='bar size; intraday bars go to their own dataset partitioned by Ticker and trading Day, '
+             'Yahoo serves 1m bars for the last 30 days, 5m for 60 and 1h for 730'
+    )
+    parser.add_argument(
+        '--synthetic-tickers', type=int,
+        help='replace the ticker list with this many generated symbols (synthetic provider)'
+    )
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic provider')
+    parser.add_argument('--years', type=int, default=HISTORY_YEARS, help='years of history on a full run')
+    parser.add_argument(
+        '--max-workers', type=int, default=8,
+        help='yfinance requests in flight at once, 1 falls back to a single multi-ticker download'
+    )
+    parser.add_argument('--rate-limit', type=float, default=5.0, help='yfinance requests started per second')
+    parser.add_argument('--retries', type=int, default=3, help='retries per ticker before giving up on it')
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='only refetch tickers the ingest ledger marks as failed or empty and merge them into the output'
+    )
+    parser.add_argument(
+        '--handoff', choices=['arrow', 'landing'], default='arrow',
+        help='pass bars to Spark as Arrow batches or through a landing Parquet file'
+    )
+    parser.add_argument(
+        '--engine', choices=['spark', 'fused', 'pandas'], default='spark',
+        help='compute features with Spark windows, on Spark in one NumPy pass per Ticker partition, '
+             'or with pandas/NumPy in-process for small universes (no JVM)'
+    )
+    parser.add_argument(
+        '--sink', choices=['parquet', 'delta'], default='parquet',
+        help='publish each run as a new version of Ticker-partitioned Parquet, or write a Delta table '
+             'upserted with MERGE on (Ticker, Date); compact and vacuum it with delta_sink.py'
+    )
+    parser.add_argument(
+        '--spark-remote', default=os.environ.get('SPARK_REMOTE'),
+        help='attach to a running Spark Connect server (e.g. sc://localhost:15002) instead of starting local[*]'
+    )
+    parser.add_argument(
+        '--offline', action='store_true',
+        help='only use the Delta jars vendored by spark_runtime.py vendor, never resolve them over the network'
+    )
+    parser.add_argument(
+        '--no-state', action='store_true',
+        help='run incremental mode from warm-up history instead of the persisted indicator state'
+    )
+    args = parser.parse_args()
+
+    if args.provider == 'local' and args.data_dir is None:
+        parser.error('--provider local needs --data-dir')
+    intraday = args.interval != '1d'
+    if intraday and args.sink == 'delta':
+        parser.error('intraday bars are only stored as Parquet, run them with --sink parquet')
+
+    provider = get_provider(
+        args.provider, cache=not args.no_cache, data_dir=args.data_dir, seed=args.seed,
+        max_workers=args.max_workers, rate_limit=args.rate_limit, retries=args.retries, interval=args.interval
+    )
+    tickers = synthetic_tickers(args.synthetic_tickers) if args.synthetic_tickers else universe.load_universe(args.universe)
+    output_path = interval_output_path(args.interval)
+
+    # Get yesterday's date
+    today = datetime.now()
+    end_date = today.strftime("%Y-%m-%d")
+
+    # Get start date (years of history before yesterday)
+    history_days = args.years * 365
+    if intraday and args.provider in ('yfinance', 'replay'):
+        history_days = builtins.min(history_days, INTRADAY_LOOKBACK_DAYS[args.interval])
+    start_date = (today - timedelta(days=history_days)).strftime("%Y-%m-%d")
+
+    bars_per_day = features_pandas.BARS_PER_DAY[args.interval]
+    if args.chunk_size is None:
+        ticker_rows = history_days * spark_runtime.TRADING_DAYS_PER_YEAR // 365 * bars_per_day
+        args.chunk_size = builtins.max(1, builtins.min(CHUNK_SIZE, CHUNK_ROWS // builtins.max(1, ticker_rows)))
+
+    # each interval keeps its own ledger, a ticker can be complete in one and failing in another
+    ledger_path = ingest_ledger.LEDGER_PATH if not intraday else ingest_ledger.LEDGER_PATH.replace('.json', f'_{args.interval}.json')
+    ledger = ingest_ledger.load_ledger(ledger_path)
+
+    stored_as = storage.output_format(output_path)
+    if stored_as not in (None, args.sink):
+        # appending to output stored another way would mix two layouts
+        print(f'Output is stored as {stored_as}, rewriting it in full as {args.sink}')
+        args.mode, args.resume = 'full', False
+    elif stored_as is not None and storage.schema_version(output_path) != storage.SCHEMA_VERSION:
+        # rows of two schemas cannot share a table or a version
+        print(f'Output has schema version {storage.schema_version(output_path)}, '
+              f'rewriting it in full as version {storage.SCHEMA_VERSION}')
+        args.mode, args.resume = 'full', False
+    elif stored_as == 'parquet' and storage.partitioning(storage.current_path(output_path)) is storage.DAY_PARTITIONING:
+        # files of the new layout cannot be added under the Day directories of the older one
+        print('Output is partitioned by trading Day, rewriting it in full partitioned by Ticker only')
+        args.mode, args.resume = 'full', False
+
+    if args.resume and os.path.exists(output_path):
+        tickers = ingest_ledger.pending_tickers(ledger, tickers)
+        if not tickers:
+            print('Ingest ledger has no failed or empty tickers, nothing to resume')
+            return
+        print(f'Resuming {len(tickers)} failed or empty tickers: {tickers}')
+
+    report = run_report.RunReport(
+        mode=args.mode, engine=args.engine, interval=args.interval, sink=args.sink, provider=args.provider,
+        tickers=len(tickers), chunk_size=args.chunk_size, start_date=start_date, end_date=end_date,
+    )
+    try:
+        state, restated = run(args, tickers, start_date, end_date, history_days, provider, ledger, report)
+        if state is not None:
+            # appends leave closed weeks and months as they are, full runs may rewrite any of them
+            write_gold_tables(
+                output_path, state, args.mode == 'incremental' or args.resume, args.chunk_size, report, restated
+            )
+    except BaseException:
+        report.save('failed')
+        raise
+
+    # only trust the ledger and state once the bars they describe are stored
+    if state is not None:
+        indicator_state.save_state(state)
+    ingest_ledger.save_ledger(ledger, ledger_path)
+    report.save()
+
+    print(f'Data succesfully stored prcessed data at -> {output_path}')
+    report.print_summary()
+    print(f'Run report appended to {run_report.REPORT_PATH}')
+
+
+def run(args, tickers, start_date, end_date, history_days, provider, ledger, report):
+    """Run the ETL the arguments ask for, chunk by chunk.
+
+    Returns the indicator state to persist and the tickers an incremental run rewrote in full as restated.
+    """
+    intraday = args.interval != '1d'
+    output_path = interval_output_path(args.interval)
+    state = None
+    restated = []
+    # the indicator state holds daily windows, intraday increments always start from warm-up history
+    if args.mode == 'incremental' and not args.resume and not args.no_state and not intraday and os.path.exists(OUTPUT_PATH):
+        state = indicator_state.load_state()
+        # a run stopped between publishing its output and saving the state leaves the state behind
+        # the output, appending from it would store the bars since its last dates twice
+        if state is not None and not state_matches(state, OUTPUT_PATH):
+            print('Indicator state does not match the stored output, rebuilding it')
+            state = rebuild_state(args.chunk_size, report)
+
+    if state is not None:
+        state, restated = run_incremental_from_state(
+            state, tickers, start_date, end_date, provider, ledger, args.sink, args.chunk_size, report
+        )
+    else:
+        incremental = (args.mode == 'incremental' or args.resume) and os.path.exists(output_path)
+
+        spark = None
+        if args.engine != 'pandas':
+            # the session only ever holds one chunk of the universe
+            profile = spark_runtime.estimated_profile(
+                builtins.min(len(tickers), args.chunk_size), history_days / 365, features_pandas.BARS_PER_DAY[args.interval]
+            )
+            spark = create_spark_session(args.spark_remote, args.offline, profile)
+            report.attach(spark)
+
+        if incremental:
+            restated = run_incremental(spark, args, tickers, start_date, end_date, provider, ledger, report)
+        else:
+            run_full(spark, args, tickers, start_date, end_date, provider, ledger, report)
+
+        if not intraday:
+            state = rebuild_state(args.chunk_size, report)
+
+    return state, restated
+
 
-# Get yesterday's date
-today = datetime.now()
-end_date = today.strftime("%Y-%m-%d")
-
-# Get start date (3 years before yesterday)
-start_date = (today - timedelta(days=3*365)).strftime("%Y-%m-%d")
-
-# Download stock data
-raw = yf.download(tickers, start=start_date, end=end_date, group_by='ticker')
-
-# convert multi-index DataFrame to flat DataFrame
-df_list = []
-
-for ticker in tickers:
-    ticker_df = raw[ticker].reset_index()
-    ticker_df['Ticker'] = ticker
-    df_list.append(ticker_df)
-
-flat_df = pd.concat(df_list, ignore_index=True)
-
-# reorder columns 
-cols = ['Ticker', 'Date'] + [col for col in flat_df.columns if col not in ['Ticker', 'Date']]
-flat_df = flat_df[cols]
-
-builder = SparkSession.builder \
-    .appName("StockETL") \
-    .master("local[*]") \
-    .config("spark.sql.extensions", "io.delta.sql.DeltaSparkSessionExtension") \
-    .config("spark.sql.catalog.spark_catalog", "org.apache.spark.sql.delta.catalog.DeltaCatalog") 
-
-spark = configure_spark_with_delta_pip(builder).getOrCreate()
-
-# store data in spark dataframe
-spark_df = spark.createDataFrame(flat_df)
-
-## Feature engineering
-# set windows 
-window_spec = Window.partitionBy('Ticker').orderBy('Date')
-ma_window_12 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-11, 0)
-ma_window_26 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-25, 0)
-ma_window_50 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-49, 0)
-ma_window_200 = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-199, 0)
-window_cum = Window.partitionBy("Ticker").orderBy("Date").rowsBetween(Window.unboundedPreceding, 0)
-signal_window = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-8, 0)
-
-
-# compute daily return
-spark_df = spark_df.withColumn('Prev_close', lag('Close').over(window_spec))
-
-spark_df = spark_df.withColumn(
-    'Daily_return',
-    round(((col('Close') - col('Prev_close')) / col('Prev_close') * 100), 2)
-)
-
-# calculate daily volutility rate 
-spark_df = spark_df.withColumn(
-    'Volatility',
-    round(((col('High') - col('Low')) / col('Low') * 100), 2)
-)
-
-
-# compute moving averages
-spark_df = spark_df.withColumn(
-    'MA_12',
-    round(avg('Close').over(ma_window_12), 2)
-).withColumn(
-    'MA_26',
-    round(avg('Close').over(ma_window_26), 2)
-).withColumn(
-    'MA_50',
-    round(avg('Close').over(ma_window_50), 2)
-).withColumn(
-    'MA_200',
-    round(avg('Close').over(ma_window_200), 2)
-)
-
-spark_df = spark_df.withColumn("First_Close", first("Close").over(window_cum))
-spark_df = spark_df.withColumn("Cumulative_Return", round(((col("Close") - col("First_Close")) / col("First_Close")) * 100, 2))
-
-
-# compute 7 day momentum
-spark_df = spark_df.withColumn("Close_7_Days_Ago", lag("Close", 7).over(window_spec))
-spark_df = spark_df.withColumn(
-    "Momentum_7d", 
-    round(((col("Close") - col("Close_7_Days_Ago")) / col("Close_7_Days_Ago")) * 100, 2)
-)
-
-# compute MACD and signal lines 
-spark_df = spark_df.withColumn(
-    'MACD',
-    col('MA_12') - col('MA_26')
-)
-
-spark_df = spark_df.withColumn(
-    'Signal_line',
-    round(avg(col('MACD')).over(signal_window), 2)
-)
-
-# compute draw down
-# measure draw from peak close price
-peak_close = max(col('Close')).over(Window.partitionBy('Ticker').orderBy('Date').rowsBetween(Window.unboundedPreceding, 0))
-
-spark_df = spark_df.withColumn(
-    'DrawDown',
-    round(((col('Close') - peak_close) / peak_close * 100), 2)
-)
-
-# write to deltalake
-output_path = os.path.join(DATA_FILEPATH, "stock_data_delta.parquet")
-
-spark_df.write.format('parquet').mode('overwrite').save(output_path)
-
-print(f'Data succesfully stored prcessed data at -> {output_path}')
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from urllib.parse import unquote
+
+from features_pandas import OUTPUT_COLUMNS
+
+# How the features are stored, whichever engine computed them: the stored schema, the Parquet
+# layout and the versioned output publish.py swaps in. Spark's Python workers only load features_pandas.
+
+# stored schema: 1 is OUTPUT_COLUMNS as computed, all float64; 2 drops the scratch columns and keeps
+# the indicators rounded to cents/hundredths of a percent as int32 hundredths (see compact and upcast);
+# 3 adds the 52 week range columns; 4 takes Max_DrawDown_52w from Close peaks within the window and
+# leaves the range of intraday bars null
+SCHEMA_VERSION = 4
+# where writers record SCHEMA_VERSION: Parquet key-value metadata and Delta table properties; the
+# _CURRENT manifest of versioned Parquet has it as schema_version
+SCHEMA_VERSION_KEY = 'stock_etl.schema_version'
+SCRATCH_COLUMNS = ['Prev_close', 'First_Close', 'Close_7_Days_Ago']
+STORED_COLUMNS = [column for column in OUTPUT_COLUMNS if column not in SCRATCH_COLUMNS]
+# MACD is MA_12 - MA_26, a whole number of hundredths as well
+SCALED_COLUMNS = [
+    'Daily_return', 'Volatility', 'MA_12', 'MA_26', 'MA_50', 'MA_200',
+    'Cumulative_Return', 'Momentum_7d', 'MACD', 'Signal_line', 'DrawDown', 'From_High_52w', 'Max_DrawDown_52w',
+]
+SCALE = 100
+# integer columns change little from one bar to the next, delta encoding without dictionary pages
+# stores them in a fraction of the bytes
+DELTA_ENCODED_COLUMNS = ['Date', 'Volume'] + SCALED_COLUMNS
+
+# output layout: one Ticker=<T>/ directory per ticker, rows sorted by Date inside each file
+PARTITION_COLUMN = 'Ticker'
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor='hive')
+# intraday output stores each bar's trading session as a Day column (YYYY-MM-DD), sorted like Date
+DAY_COLUMN = 'Day'
+# intraday output of earlier runs had a Ticker=<T>/Day=<YYYY-MM-DD>/ directory per session, a few
+# bars per file; it is still read, and rewritten in full by the next run (see stock_etl.main)
+DAY_PARTITIONING = ds.partitioning(
+    pa.schema([(PARTITION_COLUMN, pa.string()), (DAY_COLUMN, pa.string())]), flavor='hive'
+)
+# intraday Dates are stored in UTC, trading days are those of the exchange
+EXCHANGE_TZ = 'America/New_York'
+# versioned Parquet output: each run is written under _versions/ and published by swapping _CURRENT
+VERSIONS_DIR = '_versions'
+CURRENT_FILE = '_CURRENT'
+
+# rows per row group, small enough that Date statistics can skip parts of long (intraday) histories
+ROW_GROUP_ROWS = 32_768
+# appends add a part file to each ticker's partition, one holding more is rewritten as a single file
+COMPACT_AFTER_FILES = 16
+
+
+def is_partitioned(path):
+    """True when path holds the Ticker-partitioned layout rather than the older single directory of part files."""
+    return os.path.isdir(path) and any(name.startswith(f'{PARTITION_COLUMN}=') for name in os.listdir(path))
+
+
+def partitioning(path):
+    """Partitioning of the layout at path: Ticker, Ticker and Day for older intraday output, or None."""
+    if not is_partitioned(path):
+        return None
+    ticker_dir = next(entry.path for entry in os.scandir(path) if entry.name.startswith(f'{PARTITION_COLUMN}='))
+    by_day = any(name.startswith(f'{DAY_COLUMN}=') for name in os.listdir(ticker_dir))
+    return DAY_PARTITIONING if by_day else PARTITIONING
+
+
+def trading_days(dates, tz=EXCHANGE_TZ):
+    """Exchange-local session day (YYYY-MM-DD) of each UTC bar timestamp."""
+    local = pd.DatetimeIndex(dates).tz_localize('UTC').tz_convert(tz).tz_localize(None)
+    days = local.normalize()
+    # format each distinct day once, there are hundreds of bars per day
+    codes, uniques = pd.factorize(days)
+    return pd.Categorical.from_codes(codes, categories=uniques.strftime('%Y-%m-%d'))
+
+
+def is_delta_table(path):
+    return os.path.isdir(os.path.join(path, '_delta_log'))
+
+
+def current_version(path):
+    """Manifest of the published version of a versioned Parquet output, or None."""
+    manifest = os.path.join(path, CURRENT_FILE)
+    if not os.path.exists(manifest):
+        return None
+    with open(manifest, 'r') as f:
+        return json.load(f)
+
+
+def current_path(path):
+    """Directory holding the published version's files, path itself for unversioned output."""
+    manifest = current_version(path)
+    return os.path.join(path, manifest['path']) if manifest else path
+
+
+def output_format(path):
+    """How the output at path is stored: 'delta', 'parquet' (versioned), 'legacy' (unversioned Parquet) or None."""
+    if not os.path.exists(path):
+        return None
+    if is_delta_table(path):
+        return 'delta'
+    return 'parquet' if current_version(path) else 'legacy'
+
+
+def stored_tickers(path):
+    """Sorted tickers of the stored output, from partition names where the layout has them."""
+    if is_delta_table(path):
+        from deltalake import DeltaTable
+        return sorted({partition[PARTITION_COLUMN] for partition in DeltaTable(path).partitions()})
+    path = current_path(path)
+    if is_partitioned(path):
+        prefix = f'{PARTITION_COLUMN}='
+        return sorted(unquote(name[len(prefix):]) for name in os.listdir(path) if name.startswith(prefix))
+    return sorted(pq.read_table(path, columns=[PARTITION_COLUMN]).column(PARTITION_COLUMN).unique().to_pylist())
+
+
+def stored_days(path, tickers):
+    """Sorted trading days stored for each of tickers in intraday output.
+
+    Only the Day column is read, a few bytes per session once dictionary and run-length encoded;
+    Delta tables, which have none, are given the days of their Dates.
+    """
+    has_days = DAY_COLUMN in stored_columns(path)
+    table = read_table(
+        path, columns=[PARTITION_COLUMN, DAY_COLUMN if has_days else 'Date'],
+        filters=[(PARTITION_COLUMN, 'in', list(tickers))],
+    )
+    table = table.set_column(0, PARTITION_COLUMN, table[PARTITION_COLUMN].cast(pa.string()))
+    if not has_days:
+        days = trading_days(table['Date'].to_numpy())
+        table = pa.table({PARTITION_COLUMN: table[PARTITION_COLUMN], DAY_COLUMN: pa.array(np.asarray(days, dtype=object))})
+    pairs = table.group_by([PARTITION_COLUMN, DAY_COLUMN]).aggregate([]).sort_by(DAY_COLUMN)
+    days = {}
+    for ticker, day in zip(pairs[PARTITION_COLUMN].to_pylist(), pairs[DAY_COLUMN].cast(pa.string()).to_pylist()):
+        days.setdefault(ticker, []).append(day)
+    return days
+
+
+def first_close(path, tickers):
+    """Close of the earliest stored bar of each of tickers, scanned batch by batch like peak_close."""
+    if len(tickers) == 0:
+        return pd.Series(dtype='float64')
+    path = current_path(path)
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning(path))
+    firsts = []
+    columns = [PARTITION_COLUMN, 'Date', 'Close']
+    for batch in dataset.to_batches(columns=columns, filter=ds.field(PARTITION_COLUMN).isin(list(tickers))):
+        if batch.num_rows:
+            bars = batch.to_pandas()
+            firsts.append(bars.sort_values('Date').groupby(PARTITION_COLUMN, observed=True).head(1))
+    if not firsts:
+        return pd.Series(dtype='float64')
+    firsts = pd.concat(firsts).astype({PARTITION_COLUMN: str}).sort_values('Date', kind='stable')
+    return firsts.groupby(PARTITION_COLUMN)['Close'].first()
+
+
+def peak_close(path, tickers):
+    """Highest stored Close of each of tickers, scanned batch by batch so long histories never sit in memory."""
+    path = current_path(path)
+    dataset = ds.dataset(path, format='parquet', partitioning=partitioning(path))
+    peaks = pd.Series(dtype='float64')
+    for batch in dataset.to_batches(columns=[PARTITION_COLUMN, 'Close'], filter=ds.field(PARTITION_COLUMN).isin(list(tickers))):
+        if batch.num_rows:
+            batch_peaks = batch.to_pandas().groupby(PARTITION_COLUMN, observed=True)['Close'].max()
+            peaks = pd.concat([peaks, batch_peaks]).groupby(level=0).max()
+    return peaks
+
+
+def last_dates(path):
+    """Latest stored Date of each ticker, sorted by ticker; only the Ticker and Date columns are read."""
+    table = read_table(path, columns=[PARTITION_COLUMN, 'Date'])
+    table = table.set_column(0, PARTITION_COLUMN, table[PARTITION_COLUMN].cast(pa.string()))
+    latest = table.group_by(PARTITION_COLUMN).aggregate([('Date', 'max')])
+    dates = latest['Date_max'].to_numpy().astype('datetime64[ns]')
+    return pd.Series(dates, index=latest[PARTITION_COLUMN].to_pylist()).sort_index()
+
+
+def compact(table):
+    """Arrow table of features in the stored schema: scratch columns dropped, SCALED_COLUMNS as int32 hundredths.
+
+    The engines round these columns to 2 decimals, so the hundredths are exact and upcast gives back
+    the same float64 values. Missing and non-finite values are stored as nulls.
+    """
+    table = table.drop_columns([column for column in SCRATCH_COLUMNS if column in table.column_names])
+    for name in SCALED_COLUMNS:
+        if name not in table.column_names:
+            continue
+        hundredths = np.rint(table[name].to_numpy() * SCALE)
+        missing = ~np.isfinite(hundredths)
+        # a safe cast, values beyond int32 fail the write like Spark's ANSI cast does
+        values = pa.array(np.where(missing, 0, hundredths), mask=missing).cast(pa.int32())
+        table = table.set_column(table.schema.get_field_index(name), name, values)
+    return table
+
+
+def upcast(table):
+    """Widen the int32 hundredths of a stored table back to the float64 values the engines computed.
+
+    Hundredths / 100 is the float64 closest to the rounded value, as the engines' rounding gives.
+    MACD is recomputed as MA_12 - MA_26 when both are read, the exact float64 the engines store.
+    Tables of schema version 1 are returned unchanged.
+    """
+    for name in SCALED_COLUMNS:
+        if name in table.column_names and pa.types.is_integer(table.schema.field(name).type):
+            values = pc.divide(table[name].cast(pa.float64()), float(SCALE))
+            if name == 'MACD' and {'MA_12', 'MA_26'} <= set(table.column_names):
+                values = pc.subtract(table['MA_12'], table['MA_26'])
+            table = table.set_column(table.schema.get_field_index(name), name, values)
+    return table
+
+
+def to_arrow(df):
+    """Features as an Arrow table in the stored schema, sorted by Ticker and Date, with Dates as microsecond
+    timestamps without a timezone and SCHEMA_VERSION in the schema metadata."""
+    df = df.astype({PARTITION_COLUMN: str}).sort_values([PARTITION_COLUMN, 'Date'], kind='stable')
+    table = pa.Table.from_pandas(df, preserve_index=False).replace_schema_metadata({SCHEMA_VERSION_KEY: str(SCHEMA_VERSION)})
+    table = table.set_column(table.schema.get_field_index('Date'), 'Date', table['Date'].cast(pa.timestamp('us')))
+    return compact(table)
+
+
+def _file_options(file_columns):
+    """Parquet write options of the stored files, whose columns are file_columns in that order."""
+    return ds.ParquetFileFormat().make_write_options(
+        compression='snappy',
+        # a session's bars share one Day, a dictionary turns the column into a run per session
+        use_dictionary=[DAY_COLUMN] if DAY_COLUMN in file_columns else False,
+        column_encoding={name: 'DELTA_BINARY_PACKED' for name in file_columns if name in DELTA_ENCODED_COLUMNS},
+        write_page_index=True,
+        sorting_columns=[pq.SortingColumn(file_columns.index('Date'))],
+    )
+
+
+def write_parquet(df, path, mode='overwrite', interval='1d'):
+    """Write features in the layout of the Spark writer: Ticker=<T>/ partitions sorted by Date.
+
+    overwrite replaces the directory, append adds a part file to each partition it touches.
+    Dates are stored as microsecond timestamps without a timezone, with row-group statistics and
+    page indexes, so readers filtering on Ticker or Date only read the files and pages they need.
+    Intraday intervals also store the trading Day of each bar, whose statistics skip row groups
+    of other sessions.
+    """
+    if mode == 'overwrite' and os.path.exists(path):
+        shutil.rmtree(path)
+
+    table = to_arrow(df)
+    if interval != '1d':
+        days = trading_days(table['Date'].to_numpy())
+        day_array = pa.DictionaryArray.from_arrays(days.codes, days.categories.to_numpy(dtype=object))
+        table = table.append_column(DAY_COLUMN, day_array.cast(pa.string()))
+
+    # the partition column is not stored in the files, Date is the first stored column
+    file_columns = [name for name in table.column_names if name != PARTITION_COLUMN]
+    tickers = pc.count_distinct(table[PARTITION_COLUMN]).as_py()
+    ds.write_dataset(
+        table,
+        path,
+        format='parquet',
+        partitioning=PARTITIONING,
+        file_options=_file_options(file_columns),
+        # one file per ticker of the chunk, whatever the chunk size
+        max_partitions=max(tickers, 1),
+        max_open_files=max(tickers, 1),
+        basename_template=f'part-{uuid.uuid4()}-{{i}}.snappy.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+        preserve_order=True,
+        max_rows_per_group=ROW_GROUP_ROWS,
+        min_rows_per_group=ROW_GROUP_ROWS,
+    )
+
+
+def compact_partitions(path, max_files=COMPACT_AFTER_FILES):
+    """Rewrite each Ticker=<T>/ partition under path holding more than max_files data files as one file.
+
+    The old files are only unlinked from path, versions they are hard-linked into keep them.
+    Returns the number of partitions rewritten.
+    """
+    rewritten = 0
+    for name in os.listdir(path):
+        partition = os.path.join(path, name)
+        if not name.startswith(f'{PARTITION_COLUMN}=') or not os.path.isdir(partition):
+            continue
+        files = sorted(file for file in os.listdir(partition) if not file.startswith(('_', '.')))
+        if len(files) <= max_files:
+            continue
+
+        # Spark's and pyarrow's part files may differ in nullability or metadata
+        tables = [pq.read_table(os.path.join(partition, file), partitioning=None) for file in files]
+        table = pa.concat_tables(tables, promote_options='permissive').sort_by('Date')
+        table = table.replace_schema_metadata({SCHEMA_VERSION_KEY: str(SCHEMA_VERSION)})
+        ds.write_dataset(
+            table,
+            partition,
+            format='parquet',
+            file_options=_file_options(table.column_names),
+            basename_template=f'part-{uuid.uuid4()}-{{i}}.snappy.parquet',
+            existing_data_behavior='overwrite_or_ignore',
+            max_rows_per_group=ROW_GROUP_ROWS,
+            min_rows_per_group=ROW_GROUP_ROWS,
+        )
+        for file in files:
+            os.remove(os.path.join(partition, file))
+            # Spark's checksum of the file, if it wrote one
+            crc = os.path.join(partition, f'.{file}.crc')
+            if os.path.exists(crc):
+                os.remove(crc)
+        rewritten += 1
+    return rewritten
+
+
+def read_table(path, columns=None, filters=None, upcast_columns=False):
+    """Read stored features as an Arrow table, only the partitions and row groups that can match filters.
+
+    filters take the pyarrow form, e.g. [('Ticker', '==', 'AAPL'), ('Date', '>=', start)].
+    Delta tables and versioned Parquet are read at their published version, which later
+    publishes never modify; older unversioned layouts are read as they are. Ticker comes back
+    dictionary-encoded; the other columns keep their stored types unless upcast_columns is set.
+    """
+    read_columns = columns
+    if upcast_columns and columns is not None and 'MACD' in columns:
+        # MACD is recomputed from the moving averages it is the difference of
+        read_columns = columns + [name for name in ['MA_12', 'MA_26'] if name not in columns]
+
+    if not is_delta_table(path):
+        path = current_path(path)
+    layout = partitioning(path)
+    if is_delta_table(path):
+        # imported here, Spark workers load this module without the Delta reader installed
+        from deltalake import DeltaTable
+        dataset = DeltaTable(path).to_pyarrow_dataset()
+        table = dataset.to_table(columns=read_columns, filter=pq.filters_to_expression(filters) if filters else None)
+    else:
+        table = pq.read_table(path, columns=read_columns, filters=filters, partitioning=layout)
+
+    if upcast_columns:
+        table = upcast(table)
+    if PARTITION_COLUMN in table.column_names:
+        tickers = table[PARTITION_COLUMN].cast(pa.string())
+        # a sorted dictionary, so categorical Tickers sort like the strings
+        uniques = pc.unique(tickers)
+        dictionary = pc.take(uniques, pc.array_sort_indices(uniques))
+        codes = pc.index_in(tickers, value_set=dictionary)
+        table = table.set_column(
+            table.schema.get_field_index(PARTITION_COLUMN), PARTITION_COLUMN,
+            pa.DictionaryArray.from_arrays(codes.combine_chunks(), dictionary),
+        )
+    if columns is not None:
+        table = table.select(columns)
+    elif layout is not None:
+        # the partition column comes back last, put it first as in OUTPUT_COLUMNS
+        table = table.select([PARTITION_COLUMN] + [name for name in table.column_names if name != PARTITION_COLUMN])
+    return table
+
+
+def read_parquet(path, columns=None, filters=None):
+    """Read stored features into pandas with the float64 indicators of the engines, see read_table."""
+    table = read_table(path, columns, filters, upcast_columns=True)
+    return table.to_pandas(coerce_temporal_nanoseconds=True)
+
+
+def stored_columns(path):
+    """Column names of the output stored at path, partition columns included."""
+    if is_delta_table(path):
+        from deltalake import DeltaTable
+        return DeltaTable(path).to_pyarrow_dataset().schema.names
+    path = current_path(path)
+    return ds.dataset(path, format='parquet', partitioning=partitioning(path)).schema.names
+
+
+def schema_version(path):
+    """SCHEMA_VERSION of the output stored at path, None when there is none.
+
+    Read from the Delta table properties, the _CURRENT manifest or the Parquet key-value metadata;
+    output written before those recorded it is told apart by its columns.
+    """
+    stored_as = output_format(path)
+    if stored_as is None:
+        return None
+    if stored_as == 'delta':
+        from deltalake import DeltaTable
+        recorded = DeltaTable(path).metadata().configuration.get(SCHEMA_VERSION_KEY)
+    elif stored_as == 'parquet' and 'schema_version' in current_version(path):
+        recorded = current_version(path)['schema_version']
+    else:
+        # Spark's writer adds no metadata of its own, its versions are told by the manifest
+        data_path = current_path(path)
+        metadata = ds.dataset(data_path, format='parquet', partitioning=partitioning(data_path)).schema.metadata or {}
+        recorded = metadata.get(SCHEMA_VERSION_KEY.encode())
+    if recorded is not None:
+        return int(recorded)
+
+    # the versions written before it was recorded differ in their columns
+    names = stored_columns(path)
+    if 'Prev_close' in names:
+        return 1
+    return 2 if 'High_52w' not in names else 3
@@ -0,0 +1,129 @@
+import os
+import uuid
+import argparse
+import functools
+
+from pyspark.sql.functions import col
+from pyspark.sql.streaming.state import GroupStateTimeout
+from pyspark.sql.types import StructType
+
+import indicator_state
+import storage
+from stock_etl import (
+    BARS_SCHEMA, FEATURE_FIELDS, DATA_FILEPATH, PARQUET_OPTIONS, add_worker_modules, compact_columns, create_spark_session,
+    write_landing,
+)
+
+# producers drop daily bar files (BARS_SCHEMA columns, any tickers and days) here, see land_bars
+LANDING_DIR = os.path.join(DATA_FILEPATH, 'landing', 'stream')
+STREAM_PATH = os.path.join(DATA_FILEPATH, 'stock_stream_delta')
+CHECKPOINT_DIR = os.path.join(DATA_FILEPATH, 'checkpoints', 'stream')
+
+OUTPUT_SCHEMA = StructType(BARS_SCHEMA.fields + FEATURE_FIELDS)
+
+# tickers x about 970 doubles of window state, kept off the JVM heap
+STREAM_CONF = {
+    'spark.sql.streaming.stateStore.providerClass':
+        'org.apache.spark.sql.execution.streaming.state.RocksDBStateStoreProvider',
+}
+
+
+def land_bars(bars, landing_dir=LANDING_DIR):
+    """Drop a frame of bars into the landing directory for the stream to pick up.
+
+    The file is written under a dot name, which the stream ignores, and renamed once complete,
+    so a micro-batch never reads a half-written file.
+    """
+    os.makedirs(landing_dir, exist_ok=True)
+    name = f'bars-{uuid.uuid4()}.parquet'
+    tmp = os.path.join(landing_dir, '.' + name)
+    write_landing(bars[BARS_SCHEMA.fieldNames()], tmp)
+    os.replace(tmp, os.path.join(landing_dir, name))
+    return name
+
+
+def stream_features(spark, landing_dir=LANDING_DIR, max_files_per_trigger=100, bootstrap_path=indicator_state.STATE_PATH):
+    """Indicator rows of the bars landing in landing_dir, one per new bar, with the batch engines' columns.
+
+    Each ticker's windows are carried across micro-batches in Spark's state store, so a new bar
+    costs one state update instead of a recompute over the ticker's history.
+    """
+    bars = spark.readStream \
+        .schema(BARS_SCHEMA) \
+        .option('maxFilesPerTrigger', max_files_per_trigger) \
+        .parquet(landing_dir)
+
+    update = functools.partial(indicator_state.update_stream_group, bootstrap_path=bootstrap_path)
+    return bars.groupBy('Ticker').applyInPandasWithState(
+        update,
+        outputStructType=OUTPUT_SCHEMA,
+        stateStructType=indicator_state.STREAM_STATE_SCHEMA,
+        outputMode='append',
+        timeoutConf=GroupStateTimeout.NoTimeout,
+    )
+
+
+def start_stream(features, path=STREAM_PATH, checkpoint_dir=CHECKPOINT_DIR, sink='delta', trigger_seconds=1, once=False):
+    """Append the stream to a Ticker-partitioned table, exactly once through the checkpoint.
+
+    The checkpoint records which landing files each micro-batch read and the sinks commit each
+    batch id once, so a restarted stream neither skips nor duplicates bars.
+    """
+    # the stored schema and Date type of the batch writers
+    writer = compact_columns(features).withColumn('Date', col('Date').cast('timestamp_ntz')) \
+        .writeStream \
+        .format(sink) \
+        .partitionBy(storage.PARTITION_COLUMN) \
+        .outputMode('append') \
+        .option('checkpointLocation', checkpoint_dir)
+    if sink == 'parquet':
+        writer = writer.options(**PARQUET_OPTIONS)
+    if once:
+        writer = writer.trigger(availableNow=True)
+    else:
+        writer = writer.trigger(processingTime=f'{trigger_seconds} seconds')
+    return writer.start(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compute indicators on daily bars as they land in a directory.')
+    parser.add_argument('--landing-dir', default=LANDING_DIR)
+    parser.add_argument('--output', default=STREAM_PATH)
+    parser.add_argument('--checkpoint', default=CHECKPOINT_DIR, help='keep it with the output, it makes the writes exactly-once')
+    parser.add_argument(
+        '--sink', choices=['delta', 'parquet'], default='delta',
+        help='Delta table, or Parquet files through Spark\'s file sink (also exactly-once, no Delta jars needed)'
+    )
+    parser.add_argument('--trigger-seconds', type=float, default=1, help='seconds between micro-batches')
+    parser.add_argument('--max-files-per-trigger', type=int, default=100)
+    parser.add_argument(
+        '--state', default=indicator_state.STATE_PATH,
+        help='indicator state of the batch ETL that tickers new to the stream start from'
+    )
+    parser.add_argument('--once', action='store_true', help='process the files landed so far, then stop')
+    parser.add_argument(
+        '--spark-remote', default=os.environ.get('SPARK_REMOTE'),
+        help='attach to a running Spark Connect server instead of starting local[*]'
+    )
+    parser.add_argument('--offline', action='store_true', help='only use the vendored Delta jars')
+    args = parser.parse_args()
+
+    spark = create_spark_session(args.spark_remote, args.offline)
+    # workers run the state updates of indicator_state
+    add_worker_modules(spark, [indicator_state], remote=bool(args.spark_remote))
+    for key, value in STREAM_CONF.items():
+        spark.conf.set(key, value)
+    # the state store is partitioned like the first run's shuffle, later runs restore that from the checkpoint
+    spark.conf.set('spark.sql.shuffle.partitions', str(os.cpu_count() or 1))
+
+    os.makedirs(args.landing_dir, exist_ok=True)
+    query = start_stream(
+        stream_features(spark, args.landing_dir, args.max_files_per_trigger, args.state),
+        args.output, args.checkpoint, args.sink, args.trigger_seconds, args.once,
+    )
+    print(f'Streaming {args.landing_dir} -> {args.output} ({args.sink}), checkpoint {args.checkpoint}')
+    query.awaitTermination()
+
+
+if __name__ == '__main__':
+    main()
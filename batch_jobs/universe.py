@@ -0,0 +1,58 @@
+import os
+import re
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+UNIVERSE_DIR = os.path.join(PROJECT_ROOT, 'universes')
+DEFAULT_UNIVERSE = 'popular30'
+
+# column holding the symbols in index constituent exports (S&P 500, Russell 3000, ...)
+SYMBOL_COLUMNS = ['Symbol', 'Ticker', 'symbol', 'ticker']
+# US class shares are written BRK.B in constituent exports and BRK-B by Yahoo; the same form with
+# one of Yahoo's one-letter exchange suffixes (London, Tokyo, TSX Venture, Frankfurt) is a listing
+SHARE_CLASS = re.compile(r'^([A-Z]+)\.([A-Z])$')
+EXCHANGE_SUFFIXES = {'L', 'T', 'V', 'F'}
+
+
+def universe_path(name):
+    """A universe file path, or the name of a file in universes/ with or without its extension."""
+    if os.path.exists(name):
+        return name
+    for extension in ['', '.txt', '.csv']:
+        path = os.path.join(UNIVERSE_DIR, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f'No universe {name!r}, expected a file or one of {sorted(os.listdir(UNIVERSE_DIR))}')
+
+
+def yahoo_symbol(symbol):
+    """symbol as Yahoo writes it: BRK.B becomes BRK-B, exchange suffixes such as VOD.L or 7203.T stay."""
+    match = SHARE_CLASS.match(symbol)
+    if match and match.group(2) not in EXCHANGE_SUFFIXES:
+        return f'{match.group(1)}-{match.group(2)}'
+    return symbol
+
+
+def load_universe(name=DEFAULT_UNIVERSE):
+    """Tickers of a universe file, in file order without duplicates.
+
+    .txt files hold one symbol per line with # comments, .csv files a Symbol or Ticker column.
+    US class shares are written the Yahoo way, see yahoo_symbol.
+    """
+    path = universe_path(name)
+    if path.endswith('.csv'):
+        constituents = pd.read_csv(path)
+        column = next(column for column in SYMBOL_COLUMNS if column in constituents.columns)
+        symbols = constituents[column].dropna().astype(str).tolist()
+    else:
+        with open(path, 'r') as f:
+            symbols = [line.split('#')[0] for line in f]
+
+    symbols = [yahoo_symbol(symbol.strip().upper()) for symbol in symbols]
+    return list(dict.fromkeys(symbol for symbol in symbols if symbol))
+
+
+def chunked(tickers, size):
+    """Consecutive slices of at most size tickers."""
+    for start in range(0, len(tickers), size):
+        yield tickers[start:start + size]
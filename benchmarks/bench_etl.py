@@ -0,0 +1,249 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+import psutil
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+import stock_etl
+import features_pandas
+import spark_runtime
+import universe
+from providers import BAR_COLUMNS, SyntheticProvider, flatten_bars, synthetic_tickers
+from run_report import dir_bytes, frame_bytes
+
+RESULTS_DIR = os.path.join(PROJECT_ROOT, 'benchmarks', 'results')
+BASELINE_PATH = os.path.join(PROJECT_ROOT, 'benchmarks', 'baseline_etl.json')
+
+# tickers x years of daily bars
+SCALES = ['30x3', '500x10', '5000x20']
+# a stage is flagged when it is this much slower or bigger than the baseline
+TOLERANCE = 0.2
+
+
+class PeakRss:
+    """Peak resident memory of this process and its children (the Spark JVM) while the block runs."""
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+
+    def _rss(self):
+        process = psutil.Process()
+        total = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                total += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        return total
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self._rss())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak = self._rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._rss())
+
+
+def download_stub(tickers, start_date, end_date, seed=0):
+    """Synthetic bars shaped like yf.download(group_by='ticker'): one row per date, ticker x field columns."""
+    bars = SyntheticProvider(seed=seed).fetch(tickers, start_date, end_date)
+    raw = bars.pivot(index='Date', columns='Ticker', values=BAR_COLUMNS[2:])
+    return raw.swaplevel(axis=1).reindex(columns=pd.MultiIndex.from_product([tickers, BAR_COLUMNS[2:]]))
+
+
+def spark_bytes(spark_df):
+    """Spark's size estimate of a frame, None where the plan is not reachable (Spark Connect)."""
+    try:
+        return int(spark_df._jdf.queryExecution().optimizedPlan().stats().sizeInBytes())
+    except Exception:
+        return None
+
+
+def measure(stage, results, run, *inputs):
+    """Run one stage on inputs, add its wall time and peak RSS to results[stage]; run returns (output, output bytes)."""
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        output, size = run(*inputs)
+        seconds = time.perf_counter() - start
+
+    totals = results.setdefault(stage, {'seconds': 0.0, 'peak_rss_mb': 0.0, 'output_bytes': 0})
+    totals['seconds'] += seconds
+    totals['peak_rss_mb'] = max(totals['peak_rss_mb'], rss.peak / 2 ** 20)
+    if size is None or totals['output_bytes'] is None:
+        totals['output_bytes'] = None
+    else:
+        totals['output_bytes'] += size
+    return output
+
+
+def run_scale(spark, engine, n_tickers, years, chunk_size, workdir):
+    """Run every stage over a synthetic universe chunk by chunk, as stock_etl.py does.
+
+    Lazy Spark stages are materialized and cached before the next stage starts, so each stage
+    is timed on its own. Seconds and bytes are summed over chunks, peak RSS is the largest.
+    Stages get their inputs as arguments, so deleting a chunk's frames really frees them.
+    """
+    start_date, end_date = f'{2025 - years}-01-01', '2025-01-01'
+    target = os.path.join(workdir, f'{n_tickers}x{years}')
+    stages = {}
+    rows = 0
+
+    for chunk in universe.chunked(synthetic_tickers(n_tickers), chunk_size):
+        def download():
+            raw = download_stub(chunk, start_date, end_date)
+            return raw, frame_bytes(raw)
+        raw = measure('download', stages, download)
+
+        def flatten(raw):
+            bars = flatten_bars(raw).dropna(subset=['Close']).astype({'Volume': 'int64'})
+            return bars, frame_bytes(bars)
+        bars = measure('flatten', stages, flatten, raw)
+        del raw
+        rows += len(bars)
+
+        if spark is None:
+            def compute(bars):
+                features = features_pandas.add_features(bars)
+                return features, frame_bytes(features)
+            features = measure('features', stages, compute, bars)
+        else:
+            spark_runtime.apply_profile(spark, spark_runtime.execution_profile(len(bars), len(chunk)))
+
+            def to_spark(bars):
+                spark_df = stock_etl.to_spark(spark, bars).cache()
+                spark_df.count()
+                return spark_df, spark_bytes(spark_df)
+            spark_df = measure('to_spark', stages, to_spark, bars)
+
+            def compute(spark_df):
+                add_features = stock_etl.add_features_fused if engine == 'fused' else stock_etl.add_features
+                features = add_features(spark_df).cache()
+                features.count()
+                return features, spark_bytes(features)
+            features = measure('features', stages, compute, spark_df)
+        del bars
+
+        def write(features):
+            stock_etl.write_features(features, target, 'append')
+            return None, dir_bytes(target)
+        # the written directory grows chunk by chunk, only count what this chunk added
+        before = dir_bytes(target)
+        measure('write', stages, write, features)
+        stages['write']['output_bytes'] -= before
+
+        if spark is not None:
+            features.unpersist()
+            spark_df.unpersist()
+
+    shutil.rmtree(target, ignore_errors=True)
+    return {'tickers': n_tickers, 'years': years, 'rows': rows, 'stages': stages}
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """Stages slower or using more memory than the baseline by more than tolerance."""
+    regressions = []
+    for scale, result in results['scales'].items():
+        base_scale = baseline.get('scales', {}).get(scale)
+        if base_scale is None:
+            continue
+        for stage, metrics in result['stages'].items():
+            base = base_scale['stages'].get(stage)
+            if base is None:
+                continue
+            for metric in ['seconds', 'peak_rss_mb']:
+                if base[metric] and metrics[metric] > base[metric] * (1 + tolerance):
+                    regressions.append(
+                        f'{scale} {stage} {metric}: {metrics[metric]:.2f} vs baseline {base[metric]:.2f} '
+                        f'(+{metrics[metric] / base[metric] - 1:.0%})'
+                    )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark each ETL stage over synthetic universes of increasing size.')
+    parser.add_argument('--scales', nargs='+', default=SCALES, help='tickers x years, e.g. 30x3 500x10 5000x20')
+    parser.add_argument('--engine', choices=['spark', 'fused', 'pandas'], default='spark')
+    parser.add_argument('--chunk-size', type=int, default=stock_etl.CHUNK_SIZE)
+    parser.add_argument('--workdir', default=tempfile.gettempdir(), help='where the write stage puts its output')
+    parser.add_argument('--output', help=f'results file, by default a timestamped file in {RESULTS_DIR}')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    scales = [tuple(int(part) for part in scale.split('x')) for scale in args.scales]
+    spark = None
+    if args.engine != 'pandas':
+        biggest = max(scales, key=lambda scale: min(scale[0], args.chunk_size) * scale[1])
+        spark = stock_etl.create_spark_session(
+            profile=spark_runtime.estimated_profile(min(biggest[0], args.chunk_size), biggest[1])
+        )
+
+    results = {
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'engine': args.engine,
+        'chunk_size': args.chunk_size,
+        'host': {
+            'cpus': os.cpu_count(),
+            'memory_mb': psutil.virtual_memory().total // 2 ** 20,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'scales': {},
+    }
+    print(f"{'scale':>9} {'stage':>9} {'seconds':>9} {'peak RSS':>10} {'output':>10}")
+    for n_tickers, years in scales:
+        result = run_scale(spark, args.engine, n_tickers, years, args.chunk_size, args.workdir)
+        scale = f'{n_tickers}x{years}'
+        results['scales'][scale] = result
+        for stage, metrics in result['stages'].items():
+            size = f"{metrics['output_bytes'] / 2 ** 20:.1f}MB" if metrics['output_bytes'] is not None else '-'
+            print(f"{scale:>9} {stage:>9} {metrics['seconds']:>8.2f}s {metrics['peak_rss_mb']:>8.0f}MB {size:>10}")
+
+    output = args.output or os.path.join(RESULTS_DIR, f"etl-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print(f'Results written to {output}')
+
+    if args.save_baseline:
+        shutil.copyfile(output, args.baseline)
+        print(f'Saved as baseline {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('engine') != args.engine:
+            print(f"Baseline was run with the {baseline.get('engine')} engine, not comparing")
+            return
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+        print(f'No stage regressed more than {args.tolerance:.0%} against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+import os
+import sys
+import time
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+import stock_etl
+from providers import SyntheticProvider, synthetic_tickers
+from bench_handoff import materialize
+
+
+def time_stage(spark_df, add_features):
+    start = time.perf_counter()
+    materialize(add_features(spark_df))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the feature stage: chained window specs vs the fused single pass.')
+    parser.add_argument('--tickers', type=int, nargs='+', default=[30, 500, 5000])
+    parser.add_argument('--years', type=int, default=3)
+    args = parser.parse_args()
+
+    spark = stock_etl.create_spark_session()
+
+    print(f"{'tickers':>8} {'rows':>10} {'windows':>10} {'fused':>10}")
+    for n_tickers in args.tickers:
+        bars = SyntheticProvider().fetch(synthetic_tickers(n_tickers), f'{2025 - args.years}-01-01', '2025-01-01')
+        # cache the input so both plans start from the same in-memory bars
+        spark_df = stock_etl.to_spark(spark, bars, 'landing').cache()
+        materialize(spark_df)
+
+        windows = time_stage(spark_df, stock_etl.add_features)
+        fused = time_stage(spark_df, stock_etl.add_features_fused)
+        print(f'{n_tickers:>8} {len(bars):>10} {windows:>9.2f}s {fused:>9.2f}s')
+
+        spark_df.unpersist()
+
+    spark.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import time
+import argparse
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+import stock_etl
+from providers import SyntheticProvider, synthetic_tickers
+
+# business days in one year of synthetic bars
+DAYS_PER_YEAR = 261
+
+
+def synthetic_bars(rows):
+    """Generate roughly `rows` synthetic bars over one year."""
+    n_tickers = -(-rows // DAYS_PER_YEAR)
+    bars = SyntheticProvider().fetch(synthetic_tickers(n_tickers), '2024-01-01', '2025-01-01')
+    return bars.head(rows)
+
+
+def materialize(spark_df):
+    """Force every row and column of the frame through Spark without writing anything."""
+    spark_df.write.format('noop').mode('overwrite').save()
+
+
+def time_handoff(spark, bars, method):
+    start = time.perf_counter()
+    if method == 'inferred':
+        # the original hand-off: schema inferred from pandas, no Arrow
+        spark.conf.set('spark.sql.execution.arrow.pyspark.enabled', 'false')
+        try:
+            spark_df = spark.createDataFrame(bars.astype({'Ticker': str}))
+            materialize(spark_df)
+        finally:
+            spark.conf.set('spark.sql.execution.arrow.pyspark.enabled', 'true')
+    else:
+        materialize(stock_etl.to_spark(spark, bars, method))
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the pandas -> Spark hand-off of the ETL.')
+    parser.add_argument('--rows', type=int, nargs='+', default=[100_000, 10_000_000])
+    parser.add_argument(
+        '--inferred-max-rows', type=int, default=1_000_000,
+        help='skip the row-by-row inferred hand-off above this size, it takes many minutes'
+    )
+    args = parser.parse_args()
+
+    spark = stock_etl.create_spark_session()
+
+    print(f"{'rows':>12} {'inferred':>10} {'arrow':>10} {'landing':>10}")
+    for rows in args.rows:
+        bars = synthetic_bars(rows)
+        timings = {}
+        for method in ['inferred', 'arrow', 'landing']:
+            if method == 'inferred' and rows > args.inferred_max_rows:
+                timings[method] = '-'
+                continue
+            timings[method] = f'{time_handoff(spark, bars, method):.2f}s'
+        print(f"{rows:>12} {timings['inferred']:>10} {timings['arrow']:>10} {timings['landing']:>10}")
+
+    spark.stop()
+
+
+if __name__ == '__main__':
+    main()
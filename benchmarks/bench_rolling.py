@@ -0,0 +1,128 @@
+import os
+import sys
+import time
+import argparse
+import functools
+
+import numpy as np
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+import rolling
+import features_pandas
+
+WINDOWS = [20, 200, 1000]
+# tickers of the Spark comparison, Spark's sliding frames take O(n * window)
+SPARK_TICKERS = 100
+
+
+def synthetic_closes(n_tickers, bars, seed=0):
+    """Random-walk closes rounded to cents, bars rows per ticker, and the starts of their groups."""
+    rng = np.random.default_rng(seed)
+    walks = rng.normal(0, 0.02, (n_tickers, bars)).cumsum(axis=1)
+    closes = np.round(np.exp(walks) * rng.uniform(5, 500, (n_tickers, 1)), 2).ravel()
+    return closes, features_pandas.group_starts(np.repeat(np.arange(n_tickers), bars))
+
+
+def best_of(repeat, run):
+    """Fastest of repeat runs, in seconds."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def range_kernels(group, window):
+    """applyInPandas body of the Spark comparison, one ticker's rolling max(High) and min(Low)."""
+    group = group.sort_values('Date', kind='stable')
+    starts = np.zeros(len(group), dtype='int64')
+    return pd.DataFrame({
+        'Ticker': group['Ticker'],
+        'Date': group['Date'],
+        'High_max': rolling.rolling_max(group['High'].to_numpy(), starts, window),
+        'Low_min': rolling.rolling_min(group['Low'].to_numpy(), starts, window),
+    })
+
+
+def spark_range(spark, closes, n_tickers, bars, windows, repeat):
+    """Time max(High)/min(Low) over rowsBetween(-(window - 1), 0) against the kernels run per ticker by applyInPandas.
+
+    Both are written to the noop sink, so every row is computed and nothing is stored.
+    """
+    from pyspark.sql import Window
+    from pyspark.sql.functions import col, max as max_, min as min_
+    from bench_handoff import materialize
+
+    frame = pd.DataFrame({
+        'Ticker': np.repeat([f'T{i:05d}' for i in range(n_tickers)], bars),
+        'Date': np.tile(pd.bdate_range('2000-01-03', periods=bars).to_numpy(), n_tickers),
+        'High': closes * 1.01,
+        'Low': closes * 0.99,
+    })
+    spark_df = spark.createDataFrame(frame).repartition('Ticker').cache()
+    spark_df.count()
+
+    print(f"{'window':>7} {'Spark window':>13} {'applyInPandas':>14} {'equal':>6}")
+    for window in windows:
+        ordered = Window.partitionBy('Ticker').orderBy('Date').rowsBetween(-(window - 1), 0)
+        windowed = spark_df.select(
+            'Ticker', 'Date', max_('High').over(ordered).alias('High_max'), min_('Low').over(ordered).alias('Low_min')
+        )
+        grouped = spark_df.groupBy('Ticker').applyInPandas(
+            functools.partial(range_kernels, window=window), schema=windowed.schema
+        )
+
+        timings = [
+            best_of(repeat, lambda: materialize(windowed)),
+            best_of(repeat, lambda: materialize(grouped)),
+        ]
+        joined = windowed.alias('w').join(grouped.alias('g'), ['Ticker', 'Date'])
+        differ = joined.filter((col('w.High_max') != col('g.High_max')) | (col('w.Low_min') != col('g.Low_min'))).count()
+        print(f'{window:>7} {timings[0]:>12.2f}s {timings[1]:>13.2f}s {str(differ == 0):>6}')
+    spark_df.unpersist()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time the rolling kernels for growing windows against in-order sums and Spark windows.')
+    parser.add_argument('--tickers', type=int, default=500)
+    parser.add_argument('--bars', type=int, default=5000, help='bars per ticker (20 years of daily bars)')
+    parser.add_argument('--windows', type=int, nargs='+', default=WINDOWS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--skip-in-order', action='store_true', help='the in-order sums take O(n * window), skip them')
+    parser.add_argument('--spark', action='store_true', help='also compare the max/min kernels with Spark window frames')
+    parser.add_argument('--spark-tickers', type=int, default=SPARK_TICKERS)
+    args = parser.parse_args()
+
+    closes, starts = synthetic_closes(args.tickers, args.bars)
+    print(f'{len(closes):,} rows, {args.tickers} tickers')
+    print(f"{'window':>7} {'sum':>8} {'mean':>8} {'mean 2dp':>9} {'var':>8} {'max':>8} {'min':>8} {'in order':>9}")
+    for window in args.windows:
+        timings = [
+            best_of(args.repeat, lambda: rolling.rolling_sum(closes, starts, window)),
+            best_of(args.repeat, lambda: rolling.rolling_mean(closes, starts, window)),
+            best_of(args.repeat, lambda: rolling.rolling_mean(closes, starts, window, decimals=2)),
+            best_of(args.repeat, lambda: rolling.rolling_var(closes, starts, window)),
+            best_of(args.repeat, lambda: rolling.rolling_max(closes, starts, window)),
+            best_of(args.repeat, lambda: rolling.rolling_min(closes, starts, window)),
+        ]
+        in_order = '-'
+        if not args.skip_in_order:
+            rows = np.arange(len(closes))
+            in_order = f'{best_of(1, lambda: rolling.in_order_sums(closes, starts, window, rows)):.2f}s'
+        print(f'{window:>7} ' + ' '.join(f'{seconds:>7.2f}s' for seconds in timings) + f' {in_order:>9}')
+
+    if args.spark:
+        import stock_etl
+
+        spark = stock_etl.create_spark_session()
+        closes, _ = synthetic_closes(args.spark_tickers, args.bars)
+        print(f'\nSpark, {len(closes):,} rows, {args.spark_tickers} tickers')
+        spark_range(spark, closes, args.spark_tickers, args.bars, args.windows, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
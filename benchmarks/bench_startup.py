@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+import spark_runtime
+
+# runs in a fresh interpreter so every measurement pays the imports and JVM startup of a real run
+CHILD = '''
+import sys, time
+start = time.perf_counter()
+sys.path.insert(0, {batch_jobs!r})
+import spark_runtime
+if {mode!r} == 'ivy':
+    # pretend nothing is vendored, Delta is resolved through Ivy as configure_spark_with_delta_pip does
+    spark_runtime.vendored_jars = lambda jars_dir=None: []
+import stock_etl
+spark = stock_etl.create_spark_session({remote!r})
+spark.range(1).count()
+print(time.perf_counter() - start)
+'''
+
+
+def time_startup(mode, remote=None, timeout=300):
+    """Seconds from interpreter start to the first finished query, and for the whole process."""
+    code = CHILD.format(batch_jobs=os.path.join(PROJECT_ROOT, 'batch_jobs'), mode=mode, remote=remote)
+    start = time.perf_counter()
+    try:
+        # Ivy without network and Connect without a server both retry for a long time
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None, None
+    total = time.perf_counter() - start
+    if result.returncode != 0:
+        return None, None
+    return float(result.stdout.strip().splitlines()[-1]), total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time ETL Spark startup: Ivy-resolved Delta, vendored jars, Spark Connect attach.')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--modes', nargs='+', default=['ivy', 'vendored', 'connect'])
+    parser.add_argument('--remote', default=spark_runtime.CONNECT_URL)
+    parser.add_argument('--timeout', type=int, default=300, help='seconds before a startup counts as failed')
+    args = parser.parse_args()
+
+    print(f"{'mode':>10} {'run':>4} {'session':>10} {'process':>10}")
+    for mode in args.modes:
+        if mode == 'vendored' and not spark_runtime.vendored_jars():
+            print(f'{mode:>10}    - no jars in {spark_runtime.JARS_DIR}, run spark_runtime.py vendor')
+            continue
+        for run in range(1, args.runs + 1):
+            session, total = time_startup(mode, args.remote if mode == 'connect' else None, args.timeout)
+            if session is None:
+                print(f'{mode:>10} {run:>4}     failed')
+                break
+            print(f'{mode:>10} {run:>4} {session:>9.2f}s {total:>9.2f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -21,4 +21,4 @@ pip install -r requirements.txt
 
 # Run the ETL script
 echo "Running ETL job..."
-python3 batch_jobs/stock_etl.py
\ No newline at end of file
+python3 batch_jobs/stock_etl.py --mode incremental --engine pandas
\ No newline at end of file
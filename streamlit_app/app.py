@@ -1,4 +1,5 @@
 import os
+import sys
 import pandas as pd
 import streamlit as st
 import altair
@@ -11,6 +12,18 @@ PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TIMESTAMP_FILE = os.path.join(PROJECT_ROOT, 'last_run_date.txt')
 SETUP_SCRIPT = os.path.join(PROJECT_ROOT, 'setup.sh')
 DATA_FILEPATH = os.path.join(PROJECT_ROOT, 'data', 'stock_data_delta.parquet')
+# intraday datasets written by stock_etl.py --interval
+INTRADAY_FILEPATH = os.path.join(PROJECT_ROOT, 'data', 'stock_bars_{interval}.parquet')
+
+# candles the price chart draws at most, longer date spans switch to weekly then monthly bars
+MAX_CANDLES = 600
+TRADING_DAYS_PER_YEAR = 252
+
+# read the ETL output through the same reader the batch jobs use
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+import gold_tables
+import run_report
+import storage
 
 def run_setup_script():
     """Runs the setup.sh script."""
@@ -44,65 +57,154 @@ check_and_run_setup()
 
 
 @st.cache_data
-def load_data():
-    return pd.read_parquet(DATA_FILEPATH)
+def load_summary(summary_path, modified, data_path):
+    """One row per ticker, as the ETL's summary table holds it; modified keys the cache to the file's mtime.
 
-df = load_data()
+    Output written before the ETL kept a summary table gets one computed from its full history.
+    """
+    if modified is None:
+        summary = gold_tables.build_summary(data_path)
+    else:
+        summary = gold_tables.load_summary(summary_path)
+    return summary.set_index('Ticker', drop=False)
+
+@st.cache_data
+def load_stored_columns(data_path, modified):
+    """Columns of the stored features, looked up once per ETL run; modified is the summary table's mtime."""
+    return storage.stored_columns(data_path)
 
-last_close_date = df['Date'].max()
+@st.cache_data
+def load_rollup(name, modified, ticker):
+    """Weekly or monthly bars of a ticker from the ETL's rollup table; modified keys the cache to the file's mtime."""
+    return gold_tables.load_rollup(name, [ticker]).sort_values('Date')
+
+def chart_resolution(start, end):
+    """Finest of daily, weekly and monthly bars that draws start..end in at most MAX_CANDLES candles."""
+    days = (end - start).days
+    if days * TRADING_DAYS_PER_YEAR / 365 <= MAX_CANDLES:
+        return 'daily'
+    if days / 7 <= MAX_CANDLES:
+        return 'weekly'
+    return 'monthly'
+
+def chart_bars(ticker_df, ticker, start, end):
+    """Bars of the price chart between start and end at the resolution of the span, and that resolution."""
+    resolution = chart_resolution(start, end)
+    if resolution == 'daily':
+        bars = ticker_df
+    elif os.path.exists(gold_tables.ROLLUP_PATHS[resolution]):
+        bars = load_rollup(resolution, os.path.getmtime(gold_tables.ROLLUP_PATHS[resolution]), ticker)
+    else:
+        # output from before the ETL kept rollups
+        bars = gold_tables.rollup(ticker_df, gold_tables.ROLLUP_FREQUENCIES[resolution])
+    dates = bars['Date'].dt.date
+    return bars[(dates >= start) & (dates <= end)], resolution
+
+@st.cache_data
+def load_tickers(data_path, tickers, columns=None):
+    """Rows of the given tickers only, the other Ticker partitions are never opened."""
+    if not tickers:
+        return pd.DataFrame(columns=columns or ['Ticker', 'Date'])
+    df = storage.read_parquet(data_path, columns=columns, filters=[('Ticker', 'in', list(tickers))])
+    return df.sort_values('Date')
+
+@st.cache_data
+def load_intraday(data_path, ticker, sessions):
+    """Bars of the last few trading sessions of a ticker, the row groups of older sessions are skipped."""
+    days = storage.stored_days(data_path, [ticker]).get(ticker, [])
+    if not days:
+        return pd.DataFrame(columns=['Date'])
+    df = storage.read_parquet(
+        data_path,
+        columns=['Date', 'Open', 'High', 'Low', 'Close', 'Volume', 'MA_50', 'MA_200'],
+        filters=[('Ticker', '==', ticker), ('Day', '>=', days[-sessions:][0])],
+    )
+    # bars are stored in UTC, chart them on the exchange's clock
+    df['Date'] = df['Date'].dt.tz_localize('UTC').dt.tz_convert(storage.EXCHANGE_TZ)
+    return df.sort_values('Date')
+
+@st.cache_data
+def load_run_reports(report_path, modified):
+    """Stage totals of the recorded ETL runs, one row per run and stage; modified keys the cache to the file's mtime."""
+    reports = run_report.load_reports(report_path)
+    rows = [
+        dict(run_id=report['run_id'], started_at=pd.Timestamp(report['started_at']), mode=report['mode'],
+             engine=report['engine'], status=report['status'], stage=stage, **{k: v for k, v in total.items() if k != 'groups'})
+        for report in reports
+        for stage, total in report['totals'].items()
+    ]
+    return reports, pd.DataFrame(rows)
+
+# pin the published version for this run, a new publish gets new cache entries
+data_path = storage.current_path(DATA_FILEPATH)
+summary_modified = os.path.getmtime(gold_tables.SUMMARY_PATH) if os.path.exists(gold_tables.SUMMARY_PATH) else None
+summary_df = load_summary(gold_tables.SUMMARY_PATH, summary_modified, data_path)
+
+last_close_date = summary_df['Date'].max()
+tickers = sorted(summary_df['Ticker'].tolist())
 
 
 # set page layout
 st.set_page_config(layout='wide', page_title='Stock Market Analysis')
 
 st.title("📈 Stock Market Dashboard")
-st.markdown(f'Explore stock metrics for 30 popular tickers using three years of historic data')
+st.markdown(f'Explore stock metrics for {len(tickers)} tickers using their stored price history')
 st.markdown("Use the sidebar to explore a ticker. You can compare KPIs and identify trends across different metrics.")
 
 # set sidebar
-tickers = df['Ticker'].unique().tolist()
 selected_ticker = st.sidebar.selectbox('Select a ticker', tickers)
 
-filtered_df = df[df['Ticker'] == selected_ticker]
+filtered_df = load_tickers(data_path, (selected_ticker,))
 
 # show summary metrics 
 st.subheader(f'Summary metrics for {selected_ticker}')
-latest = filtered_df.sort_values('Date').iloc[-1]
+latest = summary_df.loc[selected_ticker]
 
-col1, col2, col3, col4 = st.columns(4)
+col1, col2, col3, col4, col5, col6 = st.columns(6)
 col1.metric('Latest Close', f"${latest['Close']:.2f}")
 col2.metric('Cumulative Return', f"{latest['Cumulative_Return']:.2f}%")
 col3.metric('7-Day Momentum', f"{latest['Momentum_7d']}%")
-col4.metric('Last Refresh Date', last_close_date.strftime('%Y-%m-%d'))
+col4.metric('52-Week High', f"${latest['High_52w']:.2f}", f"{latest['From_High_52w']:.2f}% from high")
+col5.metric('52-Week Low', f"${latest['Low_52w']:.2f}")
+col6.metric('Last Refresh Date', last_close_date.strftime('%Y-%m-%d'))
+
+col1, col2, col3 = st.columns(3)
+col1.metric('52-Week Return', f"{latest['Return_52w']:.2f}%")
+col2.metric('52-Week Volatility', f"{latest['Volatility_52w']:.2f}%", help='standard deviation of the daily returns')
+col3.metric('52-Week Avg Volume', f"{latest['Avg_Volume_52w']:,}")
 
 st.subheader("📊 Visual Metrics")
 
 tab1, tab2, tab3, tab4 = st.tabs(["📉 Price & Averages", "📈 Returns & Momentum", "📊 Volatility", "🧮 Technical Indicators"])
 
 with tab1:
-    st.markdown("**Candlestick Chart with Moving Averages**")
+    first_date, last_date = filtered_df['Date'].iloc[0].date(), filtered_df['Date'].iloc[-1].date()
+    start, end = st.slider('Date range', min_value=first_date, max_value=last_date, value=(first_date, last_date))
+    chart_df, resolution = chart_bars(filtered_df, selected_ticker, start, end)
+
+    st.markdown(f"**Candlestick Chart with Moving Averages** ({resolution} bars)")
     fig = go.Figure()
 
     fig.add_trace(go.Candlestick(
-        x=filtered_df['Date'],
-        open=filtered_df['Open'],
-        high=filtered_df['High'],
-        low=filtered_df['Low'],
-        close=filtered_df['Close'],
+        x=chart_df['Date'],
+        open=chart_df['Open'],
+        high=chart_df['High'],
+        low=chart_df['Low'],
+        close=chart_df['Close'],
         name='Candlestick'
     ))
 
     fig.add_trace(go.Scatter(
-        x=filtered_df['Date'],
-        y=filtered_df['MA_50'],
+        x=chart_df['Date'],
+        y=chart_df['MA_50'],
         mode='lines',
         line=dict(color='green', width=1),
         name='MA 50'
     ))
 
     fig.add_trace(go.Scatter(
-        x=filtered_df['Date'],
-        y=filtered_df['MA_200'],
+        x=chart_df['Date'],
+        y=chart_df['MA_200'],
         mode='lines',
         line=dict(color='orange', width=1),
         name='MA 200'
@@ -156,14 +258,61 @@ with tab4:
 
     st.altair_chart(draw_down_chart)
 
+# === Intraday Section ===
+intraday_paths = {
+    interval: storage.current_path(INTRADAY_FILEPATH.format(interval=interval))
+    for interval in ['1h', '5m', '1m']
+    if os.path.exists(INTRADAY_FILEPATH.format(interval=interval))
+}
+if intraday_paths:
+    st.subheader(f"⏱️ Intraday bars for {selected_ticker}")
+
+    col1, col2 = st.columns(2)
+    selected_interval = col1.selectbox('Bar interval', list(intraday_paths))
+    sessions = col2.slider('Trading sessions', min_value=1, max_value=20, value=5)
+
+    intraday_df = load_intraday(intraday_paths[selected_interval], selected_ticker, sessions)
+    if intraday_df.empty:
+        st.info(f'No {selected_interval} bars stored for {selected_ticker}')
+    else:
+        fig = go.Figure()
+        fig.add_trace(go.Candlestick(
+            x=intraday_df['Date'],
+            open=intraday_df['Open'],
+            high=intraday_df['High'],
+            low=intraday_df['Low'],
+            close=intraday_df['Close'],
+            name='Candlestick'
+        ))
+        for column, color in [('MA_50', 'green'), ('MA_200', 'orange')]:
+            fig.add_trace(go.Scatter(
+                x=intraday_df['Date'],
+                y=intraday_df[column],
+                mode='lines',
+                line=dict(color=color, width=1),
+                name=f'MA {column[3:]} bars'
+            ))
+        fig.update_layout(
+            xaxis_title='Time (exchange)',
+            yaxis_title='Price',
+            xaxis_rangeslider_visible=False,
+            # hide nights and weekends, the market is closed
+            xaxis_rangebreaks=[dict(bounds=['sat', 'mon']), dict(bounds=[16, 9.5], pattern='hour')],
+            height=500
+        )
+        st.plotly_chart(fig, use_container_width=True)
+
 # === KPI Comparison Section ===
 st.subheader("📌 Compare KPIs Across Tickers")
 
 kpi_options = ['Close', 'Volume', 'Daily_return', 'Volatility', 'Momentum_7d', 'Cumulative_Return']
+# output stored before the 52 week range was computed has no such columns
+stored_columns = load_stored_columns(data_path, summary_modified)
+kpi_options += [column for column in ['From_High_52w', 'Max_DrawDown_52w'] if column in stored_columns]
 selected_kpi = st.selectbox("Select KPI to Compare", kpi_options)
 
 tickers_to_compare = st.multiselect("Select Tickers to Compare", tickers, default=[selected_ticker])
-compare_df = df[df['Ticker'].isin(tickers_to_compare)]
+compare_df = load_tickers(data_path, tuple(tickers_to_compare), columns=['Ticker', 'Date', selected_kpi])
 
 kpi_chart = altair.Chart(compare_df).mark_line().encode(
     x='Date:T',
@@ -177,14 +326,72 @@ st.altair_chart(kpi_chart, use_container_width=True)
 # === Leaderboard Section ===
 st.subheader("🏆 Top Performers Snapshot")
 
-latest_df = df.sort_values('Date').groupby('Ticker').tail(1)
-
-col1, col2 = st.columns(2)
+col1, col2, col3 = st.columns(3)
 
 with col1:
     st.markdown("**Top 5 by 7-Day Momentum**")
-    st.dataframe(latest_df.sort_values('Momentum_7d', ascending=False).head(5)[['Ticker', 'Momentum_7d']])
+    st.dataframe(summary_df.nlargest(5, 'Momentum_7d')[['Ticker', 'Momentum_7d']], hide_index=True)
 
 with col2:
     st.markdown("**Top 5 by Volatility**")
-    st.dataframe(latest_df.sort_values('Volatility', ascending=False).head(5)[['Ticker', 'Volatility']])
+    st.dataframe(summary_df.nlargest(5, 'Volatility')[['Ticker', 'Volatility']], hide_index=True)
+
+with col3:
+    st.markdown("**Top 5 by 52-Week Return**")
+    st.dataframe(summary_df.nlargest(5, 'Return_52w')[['Ticker', 'Return_52w']], hide_index=True)
+
+
+# === Pipeline Health Section ===
+st.subheader("🩺 Pipeline health")
+
+if not os.path.exists(run_report.REPORT_PATH):
+    st.info('No run report yet, it is written by each run of batch_jobs/stock_etl.py')
+else:
+    reports, stages_df = load_run_reports(run_report.REPORT_PATH, os.path.getmtime(run_report.REPORT_PATH))
+    last_run = reports[-1]
+
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric('Last run', last_run['started_at'].replace('T', ' '))
+    col2.metric('Status', last_run['status'])
+    col3.metric('Duration', f"{last_run['seconds']:.1f}s")
+    col4.metric('Mode / engine', f"{last_run['mode']} / {last_run['engine']}")
+
+    # compare with the previous run that did the same work
+    previous = [
+        report for report in reports[:-1]
+        if (report['mode'], report['engine'], report['interval']) == (last_run['mode'], last_run['engine'], last_run['interval'])
+    ]
+    stage_table = pd.DataFrame(last_run['totals']).T.reindex(columns=['seconds', 'rows', 'bytes', 'chunks', 'spark_jobs'])
+    if previous:
+        previous_seconds = pd.Series({stage: total['seconds'] for stage, total in previous[-1]['totals'].items()})
+        stage_table['previous_seconds'] = previous_seconds
+        stage_table['change'] = stage_table['seconds'] / stage_table['previous_seconds'] - 1
+    st.markdown("**Stages of the last run**")
+    st.dataframe(stage_table.style.format({'change': '{:+.0%}'}, na_rep=''))
+
+    st.markdown("**Stage time across runs**")
+    history_chart = altair.Chart(stages_df).mark_line(point=True).encode(
+        x='started_at:T',
+        y=altair.Y('seconds:Q', title='Seconds'),
+        color='stage:N',
+        tooltip=['run_id', 'mode', 'engine', 'status', 'stage', 'seconds', 'rows']
+    ).properties(height=300)
+    st.altair_chart(history_chart, use_container_width=True)
+
+    groups = last_run['totals'].get('features', {}).get('groups')
+    if groups:
+        st.markdown("**Indicator groups of the last run**")
+        st.bar_chart(pd.Series(groups, name='seconds'))
+
+    spark_stages = pd.DataFrame([
+        dict(stage=entry['stage'], chunk=entry['chunk'], job_id=job['job_id'], **spark_stage)
+        for entry in last_run['stages']
+        for job in entry.get('spark_jobs', [])
+        for spark_stage in job['stages']
+    ])
+    if not spark_stages.empty:
+        with st.expander('Spark jobs and stages of the last run'):
+            st.dataframe(spark_stages)
+    for name, plan in last_run['plans'].items():
+        with st.expander(f'Physical plan: {name}'):
+            st.code(plan)
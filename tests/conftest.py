@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pandas as pd
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, 'batch_jobs'))
+
+
+def by_ticker_and_date(features):
+    """Features with string Tickers, sorted by Ticker and Date and indexed from 0, to compare frames."""
+    features = features.astype({'Ticker': str}).sort_values(['Ticker', 'Date'], kind='stable')
+    return features.reset_index(drop=True)
+
+
+def assert_same_features(actual, expected):
+    pd.testing.assert_frame_equal(by_ticker_and_date(actual), by_ticker_and_date(expected), check_exact=True)
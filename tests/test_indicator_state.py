@@ -0,0 +1,74 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import indicator_state
+from conftest import assert_same_features
+from features_pandas import OUTPUT_COLUMNS, add_features
+from providers import SyntheticProvider, synthetic_tickers
+from stock_etl import STATE_COLUMNS
+
+# the state is built from the bars before SPLIT and updated with the 14 months after it, longer
+# than the 52 week window, so peaks leave the windows of the range and of the drawdown
+SPLIT = pd.Timestamp('2024-01-01')
+END = '2025-03-01'
+
+
+def daily_bars():
+    """Bars of tickers with long histories and of one listed shortly before SPLIT, whose windows are padded."""
+    provider = SyntheticProvider(seed=7)
+    tickers = synthetic_tickers(4)
+    bars = pd.concat([
+        provider.fetch(tickers[:3], '2021-06-01', END).astype({'Ticker': str}),
+        provider.fetch(tickers[3:], '2023-11-15', END).astype({'Ticker': str}),
+    ], ignore_index=True)
+    return bars
+
+
+def state_and_new_bars():
+    bars = daily_bars()
+    history = add_features(bars[bars['Date'] < SPLIT])
+    return indicator_state.build_state(history[STATE_COLUMNS]), bars[bars['Date'] >= SPLIT], add_features(bars)
+
+
+def test_update_matches_full_recompute():
+    state, new_bars, expected = state_and_new_bars()
+    features = state.update(new_bars)
+    assert_same_features(features, expected.loc[expected['Date'] >= SPLIT, OUTPUT_COLUMNS])
+
+
+def test_update_day_by_day_through_saved_states(tmp_path):
+    state, new_bars, expected = state_and_new_bars()
+    path = str(tmp_path / 'indicator_state.parquet')
+    parts = []
+    for _, day in new_bars.groupby('Date'):
+        indicator_state.save_state(state, path)
+        state = indicator_state.load_state(path)
+        parts.append(state.update(day))
+    assert_same_features(pd.concat(parts), expected.loc[expected['Date'] >= SPLIT, OUTPUT_COLUMNS])
+
+
+def test_stream_state_round_trip_keeps_updates_exact():
+    state, new_bars, expected = state_and_new_bars()
+    ticker = state.tickers[3]
+    row = indicator_state.to_stream_state(indicator_state.ticker_state(state, ticker))
+    single = indicator_state.from_stream_state(ticker, row)
+    features = single.update(new_bars[new_bars['Ticker'] == ticker])
+    expected = expected[(expected['Date'] >= SPLIT) & (expected['Ticker'] == ticker)]
+    assert_same_features(features, expected[OUTPUT_COLUMNS])
+
+
+def test_state_saved_with_other_windows_is_not_loaded(tmp_path):
+    state, _, _ = state_and_new_bars()
+    path = str(tmp_path / 'indicator_state.parquet')
+    indicator_state.save_state(state, path)
+    assert indicator_state.load_state(path) is not None
+
+    # as saved before the closes covered the 52 week window, when MA_200 was the longest
+    table = pq.read_table(path)
+    closes = table['Closes'].combine_chunks().flatten().to_numpy().reshape(table.num_rows, -1)[:, -200:]
+    table = table.set_column(
+        table.schema.get_field_index('Closes'), 'Closes', pa.FixedSizeListArray.from_arrays(pa.array(closes.ravel()), 200)
+    )
+    pq.write_table(table, path)
+    assert indicator_state.load_state(path) is None
@@ -0,0 +1,75 @@
+import argparse
+
+import pytest
+
+import ingest_ledger
+import run_report
+import stock_etl
+import storage
+from conftest import assert_same_features
+from features_pandas import add_features
+from providers import MarketDataProvider, SyntheticProvider, synthetic_tickers
+
+START, END = '2024-01-01', '2025-03-01'
+
+
+class FlakyProvider(MarketDataProvider):
+    """Synthetic bars, with the tickers in failing left out and listed in failed as a rate-limited source does."""
+
+    def __init__(self, failing=()):
+        super().__init__()
+        self.synthetic = SyntheticProvider(seed=5)
+        self.failing = set(failing)
+
+    def fetch(self, tickers, start_date, end_date):
+        self.failed = {ticker: 'HTTP 429' for ticker in tickers if ticker in self.failing}
+        return self.synthetic.fetch([t for t in tickers if t not in self.failing], start_date, end_date)
+
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    monkeypatch.setattr(stock_etl, 'DATA_FILEPATH', str(tmp_path))
+    monkeypatch.setattr(stock_etl, 'OUTPUT_PATH', str(tmp_path / 'stock_data.parquet'))
+    return stock_etl.OUTPUT_PATH
+
+
+def test_record_fetch_statuses():
+    tickers = synthetic_tickers(3)
+    bars = SyntheticProvider().fetch(tickers[:1], '2025-03-03', '2025-03-08')
+    ledger = ingest_ledger.record_fetch({}, tickers, bars, {tickers[2]: 'timeout'}, '2025-03-03', '2025-03-08')
+
+    assert [ledger[ticker]['status'] for ticker in tickers] == [ingest_ledger.OK, ingest_ledger.EMPTY, ingest_ledger.ERROR]
+    assert (ledger[tickers[0]]['rows'], ledger[tickers[0]]['last_date']) == (5, '2025-03-07')
+    assert ledger[tickers[2]]['error'] == 'timeout'
+    assert ingest_ledger.pending_tickers(ledger, tickers + ['NEW']) == tickers[1:] + ['NEW']
+
+
+def test_no_bars_over_a_weekend_is_not_empty():
+    ledger = ingest_ledger.record_fetch({}, ['SYN00001'], None, {}, '2025-03-08', '2025-03-10')
+    assert ledger['SYN00001']['status'] == ingest_ledger.OK
+
+
+def test_resume_refetches_failed_tickers_into_the_output(output, tmp_path):
+    tickers = synthetic_tickers(4)
+    args = argparse.Namespace(
+        mode='full', resume=False, no_state=False, interval='1d', engine='pandas', chunk_size=2, sink='parquet', handoff='arrow'
+    )
+    ledger = {}
+    stock_etl.run_full(None, args, tickers, START, END, FlakyProvider(failing=[tickers[2]]), ledger)
+    assert ledger[tickers[2]]['status'] == ingest_ledger.ERROR
+    assert storage.stored_tickers(output) == [tickers[0], tickers[1], tickers[3]]
+
+    # the ledger survives the run, as main saves it
+    ingest_ledger.save_ledger(ledger, str(tmp_path / 'ingest_ledger.json'))
+    ledger = ingest_ledger.load_ledger(str(tmp_path / 'ingest_ledger.json'))
+    pending = ingest_ledger.pending_tickers(ledger, tickers)
+    assert pending == [tickers[2]]
+
+    args.mode, args.resume = 'incremental', True
+    state, restated = stock_etl.run(args, pending, START, END, 425, FlakyProvider(), ledger, run_report.RunReport())
+
+    assert restated == []
+    assert ingest_ledger.pending_tickers(ledger, tickers) == []
+    expected = add_features(SyntheticProvider(seed=5).fetch(tickers, START, END))
+    assert_same_features(storage.read_parquet(output)[storage.STORED_COLUMNS], expected[storage.STORED_COLUMNS])
+    assert stock_etl.state_matches(state, output)
@@ -0,0 +1,87 @@
+import os
+
+import pandas as pd
+
+import publish
+import storage
+from conftest import assert_same_features
+from features_pandas import add_features
+from providers import SyntheticProvider, synthetic_tickers
+
+TICKERS = synthetic_tickers(2)
+
+FEATURES = add_features(SyntheticProvider(seed=11).fetch(TICKERS, '2025-01-01', '2025-03-01'))[storage.STORED_COLUMNS]
+
+
+def daily_features(start_date, end_date):
+    """Features of the bars in [start_date, end_date), as the runs of those days would append them."""
+    return FEATURES[(FEATURES['Date'] >= start_date) & (FEATURES['Date'] < end_date)]
+
+
+def read_version(path, manifest):
+    """Features of a published version, read from its directory as a reader that opened it earlier would."""
+    return storage.read_parquet(os.path.join(path, manifest['path']))[storage.STORED_COLUMNS]
+
+
+def publish_append(path, features):
+    staging = publish.stage(path, carry_over=True)
+    storage.write_parquet(features, staging, mode='append')
+    publish.publish(path, staging)
+
+
+def test_readers_see_the_previous_version_until_publish(tmp_path):
+    path = str(tmp_path / 'stock_data.parquet')
+    first = daily_features('2025-01-01', '2025-02-01')
+    staging = publish.stage(path)
+    storage.write_parquet(first, staging)
+    publish.publish(path, staging)
+
+    second = daily_features('2025-02-01', '2025-02-08')
+    staging = publish.stage(path, carry_over=True)
+    storage.write_parquet(second, staging, mode='append')
+    assert_same_features(storage.read_parquet(path)[storage.STORED_COLUMNS], first)
+
+    publish.publish(path, staging)
+    assert storage.current_version(path)['version'] == 2
+    assert_same_features(storage.read_parquet(path)[storage.STORED_COLUMNS], pd.concat([first, second]))
+
+
+def test_prune_keeps_the_current_and_recent_versions(tmp_path):
+    path = str(tmp_path / 'stock_data.parquet')
+    staging = publish.stage(path)
+    storage.write_parquet(daily_features('2025-01-01', '2025-01-06'), staging)
+    publish.publish(path, staging)
+    days = pd.date_range('2025-01-06', '2025-01-14', freq='B').strftime('%Y-%m-%d')
+    for start_date, end_date in zip(days[:-1], days[1:]):
+        publish_append(path, daily_features(start_date, end_date))
+    # a run that died after staging its version
+    failed = int(os.path.basename(publish.stage(path)))
+
+    publish_append(path, daily_features(days[-1], '2025-01-16'))
+
+    manifest = storage.current_version(path)
+    published = [number for number in range(1, manifest['version'] + 1) if number != failed]
+    assert manifest['history'] == published[-publish.KEEP_VERSIONS:]
+    versions = os.listdir(os.path.join(path, storage.VERSIONS_DIR))
+    assert sorted(int(name) for name in versions) == manifest['history']
+    assert_same_features(storage.read_parquet(path)[storage.STORED_COLUMNS], daily_features('2025-01-01', '2025-01-16'))
+
+
+def test_compaction_leaves_the_versions_readers_hold_intact(tmp_path):
+    path = str(tmp_path / 'stock_data.parquet')
+    staging = publish.stage(path)
+    storage.write_parquet(daily_features('2025-01-01', '2025-01-06'), staging)
+    publish.publish(path, staging)
+    days = pd.date_range('2025-01-06', periods=storage.COMPACT_AFTER_FILES + 1, freq='B').strftime('%Y-%m-%d')
+    for start_date, end_date in zip(days[:-2], days[1:-1]):
+        publish_append(path, daily_features(start_date, end_date))
+    before = storage.current_version(path)
+    partition = os.path.join(path, before['path'], f'Ticker={TICKERS[0]}')
+    assert len(os.listdir(partition)) == storage.COMPACT_AFTER_FILES
+
+    publish_append(path, daily_features(days[-2], days[-1]))
+
+    current = storage.current_path(path)
+    assert all(len(os.listdir(os.path.join(current, f'Ticker={ticker}'))) == 1 for ticker in TICKERS)
+    assert_same_features(storage.read_parquet(path)[storage.STORED_COLUMNS], daily_features('2025-01-01', days[-1]))
+    assert_same_features(read_version(path, before), daily_features('2025-01-01', days[-2]))
@@ -0,0 +1,127 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import rolling
+from features_pandas import group_starts, range_columns, spark_round
+
+# windows shorter and longer than the groups, which hold 1 to 300 rows
+WINDOWS = [1, 2, 9, 50, 400]
+
+
+# values sprinkled into the prices, 'nan' also puts a run of NaN at the start of a group
+NONFINITE = [None, 'nan', 'inf']
+
+
+def make_groups(seed, nonfinite=None, offset=0.0):
+    """Prices of groups of random length, optionally sprinkled with NaN or with inf and -inf."""
+    rng = np.random.default_rng(seed)
+    lengths = np.r_[1, 2, rng.integers(1, 300, size=12)]
+    codes = np.repeat(np.arange(len(lengths)), lengths)
+    values = offset + np.round(100 + np.cumsum(rng.normal(0, 1, codes.size)), 2)
+    picks = rng.choice(codes.size, size=20, replace=False)
+    if nonfinite == 'nan':
+        values[picks] = np.nan
+        values[3:6] = np.nan
+    elif nonfinite == 'inf':
+        values[picks[:10]] = np.inf
+        values[picks[10:]] = -np.inf
+    return values, codes
+
+
+def expected_rolling(values, codes, window, reduce):
+    """reduce over each row's window within its group, partial windows included, as Spark's sliding frame.
+
+    pandas.rolling turns inf into NaN before reducing, windows holding one are reduced row by row.
+    """
+    if not np.isinf(values).any():
+        grouped = pd.Series(values).groupby(codes).rolling(window, min_periods=1)
+        return grouped.apply(reduce, raw=True).to_numpy()
+    starts = group_starts(codes)
+    return np.array([reduce(values[max(starts[i], i - window + 1):i + 1]) for i in range(len(values))])
+
+
+def in_order_sum(window):
+    # cumsum adds oldest to newest like Spark; np.sum adds pairwise
+    return np.cumsum(window)[-1]
+
+
+def sample_var(window):
+    return np.var(window, ddof=1) if len(window) > 1 else np.nan
+
+
+@pytest.mark.parametrize('nonfinite', NONFINITE)
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_sum(window, nonfinite):
+    values, codes = make_groups(1, nonfinite)
+    expected = expected_rolling(values, codes, window, in_order_sum)
+    np.testing.assert_allclose(rolling.rolling_sum(values, group_starts(codes), window), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('nonfinite', NONFINITE)
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_mean(window, nonfinite):
+    values, codes = make_groups(2, nonfinite)
+    expected = expected_rolling(values, codes, window, lambda w: in_order_sum(w) / len(w))
+    np.testing.assert_allclose(rolling.rolling_mean(values, group_starts(codes), window), expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_mean_rounds_like_in_order_sums(window, seed):
+    values, codes = make_groups(seed)
+    expected = spark_round(expected_rolling(values, codes, window, lambda w: in_order_sum(w) / len(w)))
+    means = spark_round(rolling.rolling_mean(values, group_starts(codes), window, decimals=2))
+    np.testing.assert_array_equal(means, expected)
+
+
+@pytest.mark.parametrize('offset', [0.0, 1e6])
+@pytest.mark.parametrize('nonfinite', NONFINITE)
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_var(window, nonfinite, offset):
+    values, codes = make_groups(3, nonfinite, offset)
+    expected = expected_rolling(values, codes, window, sample_var)
+    np.testing.assert_allclose(rolling.rolling_var(values, group_starts(codes), window), expected, rtol=1e-9, atol=1e-9)
+
+
+@pytest.mark.parametrize('kernel, reduce', [(rolling.rolling_max, np.nanmax), (rolling.rolling_min, np.nanmin)])
+@pytest.mark.parametrize('nonfinite', NONFINITE)
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_extremes(kernel, reduce, window, nonfinite):
+    values, codes = make_groups(4, nonfinite)
+    # the kernels skip NaN like pandas does, and give NaN for windows of NaN only
+    expected = expected_rolling(values, codes, window, lambda w: reduce(w) if not np.isnan(w).all() else np.nan)
+    np.testing.assert_array_equal(kernel(values, group_starts(codes), window), expected)
+
+
+def max_drawdown(window):
+    peaks = np.fmax.accumulate(window)
+    falls = (window - peaks) / peaks * 100
+    return np.nan if np.isnan(falls).all() else np.nanmin(falls)
+
+
+@pytest.mark.parametrize('nonfinite', [None, 'nan'])
+@pytest.mark.parametrize('window', WINDOWS)
+def test_rolling_max_drawdown(window, nonfinite):
+    values, codes = make_groups(5, nonfinite)
+    expected = expected_rolling(values, codes, window, max_drawdown)
+    np.testing.assert_array_equal(rolling.rolling_max_drawdown(values, group_starts(codes), window), expected)
+
+
+def test_max_drawdown_52w_falls_from_close_peaks_within_the_window():
+    # a year of steady gains, a crash to half, then a flat year
+    close = np.r_[np.linspace(100, 200, 252), np.full(300, 100.0)]
+    starts = np.zeros(len(close), dtype='int64')
+    columns = range_columns(close, close * 1.01, close * 0.99, starts, 252)
+    drawdowns = columns['Max_DrawDown_52w']
+    assert (drawdowns[:252] == 0).all()
+    assert drawdowns[252] == -50
+    assert drawdowns[-1] == 0
+
+
+def test_nonfinite_values_stay_in_their_windows():
+    values = np.array([1.0, 2.0, np.nan, 4.0, 5.0, 6.0, np.inf, 8.0])
+    starts = np.array([0, 0, 0, 0, 4, 4, 4, 4])
+    np.testing.assert_array_equal(rolling.rolling_var(values, starts, 2), [np.nan, 0.5, np.nan, np.nan, np.nan, 0.5, np.nan, np.nan])
+    np.testing.assert_array_equal(rolling.rolling_sum(values, starts, 2), [1.0, 3.0, np.nan, np.nan, 5.0, 11.0, np.inf, np.inf])
+    np.testing.assert_array_equal(rolling.rolling_max(values, starts, 2), [1.0, 2.0, 2.0, 4.0, 5.0, 6.0, np.inf, np.inf])
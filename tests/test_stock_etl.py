@@ -0,0 +1,109 @@
+import argparse
+
+import pandas as pd
+import pytest
+
+import stock_etl
+import storage
+from conftest import assert_same_features
+from features_pandas import add_features
+from providers import MarketDataProvider, SyntheticProvider, synthetic_tickers
+
+START = '2023-01-01'
+ARGS = argparse.Namespace(engine='pandas', sink='parquet', handoff='arrow', chunk_size=2, interval='1d')
+
+
+class AdjustedProvider(MarketDataProvider):
+    """Synthetic bars, those of tickers in factors dated before `before` scaled as a split adjusts them."""
+
+    def __init__(self):
+        super().__init__()
+        self.synthetic = SyntheticProvider(seed=3)
+        self.factors = {}
+        self.before = None
+        self.calls = []
+
+    def fetch(self, tickers, start_date, end_date):
+        self.calls.append((list(tickers), start_date))
+        bars = self.synthetic.fetch(tickers, start_date, end_date)
+        if bars is None or not self.factors:
+            return bars
+        factors = bars['Ticker'].astype(str).map(self.factors).fillna(1.0).where(bars['Date'] < self.before, 1.0)
+        for column in ['Open', 'High', 'Low', 'Close']:
+            bars[column] = bars[column] * factors
+        return bars
+
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    monkeypatch.setattr(stock_etl, 'DATA_FILEPATH', str(tmp_path))
+    monkeypatch.setattr(stock_etl, 'OUTPUT_PATH', str(tmp_path / 'stock_data.parquet'))
+    return stock_etl.OUTPUT_PATH
+
+
+def stored(path):
+    return storage.read_parquet(path)[storage.STORED_COLUMNS]
+
+
+def recompute(provider, tickers, end_date):
+    return add_features(provider.fetch(tickers, START, end_date))[storage.STORED_COLUMNS]
+
+
+@pytest.mark.parametrize('from_state', [True, False])
+def test_restated_tickers_are_rewritten_in_full(output, from_state):
+    provider = AdjustedProvider()
+    tickers = synthetic_tickers(4)
+    ledger = {}
+    stock_etl.run_full(None, ARGS, tickers, START, '2025-03-01', provider, ledger)
+
+    # a 2:1 split on 2025-03-05: the provider now serves every earlier bar of the ticker halved
+    provider.factors, provider.before = {tickers[1]: 0.5}, pd.Timestamp('2025-03-05')
+    if from_state:
+        state, restated = stock_etl.run_incremental_from_state(
+            stock_etl.rebuild_state(ARGS.chunk_size), tickers, START, '2025-03-20', provider, ledger, chunk_size=ARGS.chunk_size
+        )
+        assert stock_etl.state_matches(state, output)
+    else:
+        restated = stock_etl.run_incremental(None, ARGS, tickers, START, '2025-03-20', provider, ledger)
+
+    assert restated == [tickers[1]]
+    assert_same_features(stored(output), recompute(provider, tickers, '2025-03-20'))
+
+
+def test_unadjusted_tickers_are_appended(output):
+    provider = AdjustedProvider()
+    tickers = synthetic_tickers(3)
+    stock_etl.run_full(None, ARGS, tickers, START, '2025-03-01', provider, {})
+    restated = stock_etl.run_incremental(None, ARGS, tickers, START, '2025-03-20', provider, {})
+
+    assert restated == []
+    assert_same_features(stored(output), recompute(provider, tickers, '2025-03-20'))
+
+
+def test_known_tickers_are_refetched_from_their_own_last_day():
+    provider = AdjustedProvider()
+    tickers = synthetic_tickers(4)
+    last_dates = pd.Series(pd.Timestamp('2025-03-13'), index=tickers)
+    last_dates[tickers[0]] = pd.Timestamp('2024-03-13')
+
+    new_bars, restated = stock_etl.fetch_new_bars(last_dates, tickers, START, '2025-03-15', provider, {})
+
+    assert provider.calls == [([tickers[0]], '2024-03-13'), (tickers[1:], '2025-03-13')]
+    assert restated == []
+    assert (new_bars['Date'] > new_bars['Ticker'].astype(str).map(last_dates)).all()
+    assert new_bars.groupby('Ticker', observed=True).size()[tickers[1:]].tolist() == [1, 1, 1]
+
+
+def test_state_behind_the_output_is_rebuilt(output):
+    provider = AdjustedProvider()
+    tickers = synthetic_tickers(3)
+    stock_etl.run_full(None, ARGS, tickers, START, '2025-03-01', provider, {})
+    stale = stock_etl.rebuild_state(ARGS.chunk_size)
+    assert stock_etl.state_matches(stale, output)
+
+    # a run stopped after publishing its bars, before saving its state
+    stock_etl.run_incremental_from_state(
+        stock_etl.rebuild_state(ARGS.chunk_size), tickers, START, '2025-03-20', provider, {}, chunk_size=ARGS.chunk_size
+    )
+    assert not stock_etl.state_matches(stale, output)
+    assert stock_etl.state_matches(stock_etl.rebuild_state(ARGS.chunk_size), output)